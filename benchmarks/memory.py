@@ -0,0 +1,45 @@
+"""Report the memory held per cached player.
+
+    python -m benchmarks.memory [--players N]
+
+Measures players that have only been looked up (eg., from a country's
+player list) and players whose profile, stats and clubs have been fetched.
+"""
+import argparse
+import tracemalloc
+import gc
+
+import chesscom
+from .stub_server import StubServer
+
+
+def bytes_per_player(n, fetch):
+    keys = [f"player-{i}" for i in range(n)]
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    players = [chesscom.lookup_player(key) for key in keys]
+    if fetch:
+        chesscom.prefetch(players, parts=fetch)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / n
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--players', type=int, default=10000)
+    args = parser.parse_args()
+
+    with StubServer() as server:
+        chesscom.set_transport(chesscom.Transport(base_url=server.base_url))
+        for fetch in [(), ('profile', 'stats', 'clubs')]:
+            chesscom.player.Player._instance_cache.clear()
+            size = bytes_per_player(args.players, fetch)
+            label = '+'.join(fetch) or 'looked up'
+            print(f"{label:>20}: {size:8.0f} bytes/player")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+"""A local stand-in for the Chess.com Public API.
+
+Serves synthetic, deterministic JSON shaped like the real endpoints, so that
+benchmarks can run without touching (or being throttled by) api.chess.com.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import argparse
+import random
+import calendar
+import hashlib
+import json
+import time
+import zlib
+
+EPOCH = 1500000000
+
+
+def _seed(key):
+    # Unlike hash(), the same in every run
+    return zlib.crc32(key.encode())
+
+
+def player_profile(username):
+    return {
+        'url': f"https://www.chess.com/member/{username}",
+        'username': username.lower(),
+        'player_id': _seed(username) % 10 ** 8,
+        'status': 'basic',
+        'name': f"Player {username}",
+        'country': "https://api.chess.com/pub/country/XX",
+        'joined': EPOCH,
+        'last_online': EPOCH + 86400,
+        'followers': 7,
+        'is_streamer': False,
+    }
+
+
+def player_stats(username):
+    def category(rating):
+        return {'last': {'date': EPOCH, 'rating': rating, 'rd': 50},
+                'record': {'win': 10, 'loss': 5, 'draw': 2}}
+
+    seed = _seed(username) % 1000
+    return {'chess_blitz': category(1000 + seed),
+            'chess_bullet': category(900 + seed),
+            'chess_rapid': category(1100 + seed)}
+
+
+def player_clubs(username):
+    return {'clubs': [{'url': "https://www.chess.com/club/club-0",
+                       'joined': EPOCH, 'last_activity': EPOCH + 3600}]}
+
+
+def club_profile(key):
+    return {
+        'name': f"Club {key}", 'club_id': _seed(key) % 10 ** 6,
+        'country': "https://api.chess.com/pub/country/XX",
+        'created': EPOCH, 'last_activity': EPOCH + 3600,
+        'visibility': 'public',
+        'join_request': f"https://www.chess.com/club/join/{key}",
+        'admin': ["https://api.chess.com/pub/player/player-0"],
+    }
+
+
+def recent_months(n):
+    """The last `n` (year, month)s, up to the current one."""
+    now = time.gmtime()
+    index = now.tm_year * 12 + now.tm_mon - 1
+    return [divmod(i, 12) for i in range(index - n + 1, index + 1)]
+
+
+def player_games(username, year, month, n):
+    start = calendar.timegm((year, month + 1, 1, 0, 0, 0))
+    next_year, next_month = divmod(year * 12 + month + 1, 12)
+    end = min(calendar.timegm((next_year, next_month + 1, 1, 0, 0, 0)),
+              time.time())
+    step = max(1, (end - start) // (n + 1))
+
+    def side(name, result):
+        return {'rating': 1200, 'result': result, 'username': name,
+                '@id': f"https://api.chess.com/pub/player/{name}"}
+
+    return {'games': [{
+        'url': f"https://www.chess.com/game/live/{start + i * step}",
+        'pgn': f'[Event "Live Chess"]\n[White "{username}"]\n\n1. e4 e5 1-0',
+        'time_control': '180', 'end_time': int(start + i * step),
+        'rated': True, 'fen': '8/8/8/8/8/8/8/8 w - -',
+        'time_class': 'blitz', 'rules': 'chess',
+        'white': side(username, 'win'),
+        'black': side('opponent', 'resigned'),
+    } for i in range(1, n + 1) if start + i * step <= end]}
+
+
+class StubAPI(object):
+    """Routes endpoints to synthetic payloads and counts requests.
+
+    Each request takes `latency` seconds, plus up to `jitter` more (drawn
+    uniformly), before it is answered."""
+
+    def __init__(self, latency=0.0, list_size=100, max_age=None, months=12,
+                 games_per_month=20, jitter=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.list_size = list_size
+        self.max_age = max_age
+        self.months = months
+        self.games_per_month = games_per_month
+        self.calls = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+
+    def _players(self):
+        return [f"player-{i}" for i in range(self.list_size)]
+
+    def route(self, path):
+        parts = path.strip('/').split('/')
+        if parts and parts[0] == 'pub':
+            parts = parts[1:]
+        if len(parts) == 2 and parts[0] == 'player':
+            return player_profile(parts[1])
+        if len(parts) == 3 and parts[0] == 'player':
+            if parts[2] == 'stats':
+                return player_stats(parts[1])
+            if parts[2] == 'clubs':
+                return player_clubs(parts[1])
+            if parts[2] == 'is-online':
+                return {'online': False}
+        if len(parts) == 4 and parts[0] == 'player' and parts[2] == 'games' \
+                and parts[3] == 'archives':
+            return {'archives': [
+                f"https://api.chess.com/pub/player/{parts[1]}/games/"
+                f"{year:04}/{month + 1:02}"
+                for year, month in recent_months(self.months)]}
+        if len(parts) == 5 and parts[0] == 'player' and parts[2] == 'games':
+            year, month = int(parts[3]), int(parts[4]) - 1
+            if (year, month) not in recent_months(self.months):
+                return None
+            return player_games(parts[1], year, month, self.games_per_month)
+        if len(parts) == 2 and parts[0] == 'club':
+            return club_profile(parts[1])
+        if len(parts) == 3 and parts[0] == 'club' and parts[2] == 'members':
+            return {'weekly': [], 'monthly': [],
+                    'all_time': [{'username': u, 'joined': EPOCH}
+                                 for u in self._players()]}
+        if len(parts) == 2 and parts[0] == 'country':
+            return {'name': f"Country {parts[1]}", 'code': parts[1]}
+        if len(parts) == 3 and parts[0] == 'country':
+            if parts[2] == 'players':
+                return {'players': self._players()}
+            if parts[2] == 'clubs':
+                return {'clubs': [f"https://api.chess.com/pub/club/club-{i}"
+                                  for i in range(self.list_size)]}
+        if len(parts) == 2 and parts[0] == 'titled':
+            return {'players': self._players()}
+        return None
+
+    def handle(self, path):
+        with self._lock:
+            self.calls += 1
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+        return self.route(path)
+
+
+def make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        # HTTP/1.1 so that clients can keep connections alive
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            d = api.handle(self.path)
+            body = json.dumps(d).encode() if d is not None else b'{}'
+            etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+            if d is None:
+                self.send_response(404)
+            elif self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                body = b''
+            else:
+                self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            if d is not None:
+                self.send_header('ETag', etag)
+                if api.max_age is not None:
+                    self.send_header('Cache-Control',
+                                     f"public, max-age={api.max_age}")
+            self.end_headers()
+            self.wfile.write(body)
+            with api._lock:
+                api.bytes_sent += len(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Many clients connect at once (the default backlog of 5 makes the
+    # others retry their connection a second later)
+    request_queue_size = 128
+
+
+class StubServer(object):
+    """Runs a `StubAPI` on a local port in a background thread."""
+
+    def __init__(self, api=None, host='127.0.0.1', port=0):
+        self.api = api or StubAPI()
+        self.httpd = _HTTPServer((host, port), make_handler(self.api))
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/pub/"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def main():
+    """Serve the stub API until interrupted."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--list-size', type=int, default=100)
+    parser.add_argument('--max-age', type=int, default=None)
+    args = parser.parse_args()
+
+    api = StubAPI(latency=args.latency, jitter=args.jitter,
+                  list_size=args.list_size, max_age=args.max_age)
+    with StubServer(api, port=args.port) as server:
+        print(f"Serving on {server.base_url}")
+        try:
+            server.thread.join()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+"""Run benchmark scenarios against the stub server, and report them as JSON.
+
+    python -m benchmarks.suite [--scenario NAME ...] [--latency SECONDS]
+                               [--list-size N] [--output FILE]
+                               [--compare FILE]
+
+Each scenario runs in a fresh process, so that its caches start cold and its
+peak memory is its own, against a stub server run by this process. For each
+scenario the report gives the number of operations timed, the throughput
+(operations per second), the p50 and p99 latency of an operation (in
+seconds), the calls made to the API and the bytes received while timing, and
+the peak RSS of the process (in bytes). With `--compare`, the throughput and
+latencies are also compared with those of an earlier report.
+
+Scenarios:
+
+    cold        read the name and blitz rating of players, fetching each
+    warm        the same, once the players have been fetched
+    disk        the same, with only a filled disk cache (as after a restart)
+    scan        fetch the stats of all the players of a country
+    graphql     deep GraphQL queries (clubs of a country, their members, and
+                the clubs of those), with empty caches each time
+    concurrent  many clients making small GraphQL queries at the same time
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+import multiprocessing
+import tempfile
+import platform
+import argparse
+import random
+import json
+import time
+import sys
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import chesscom
+from chesscom import metrics
+from chesscom.player import Player
+from chesscom.club import Club
+from chesscom.country import Country
+from .stub_server import StubServer, StubAPI
+
+Options = Dict[str, Any]
+
+
+def _clear_caches() -> None:
+    for cls in (Player, Club, Country):
+        cls._instance_cache.clear()
+
+
+def _timed(fn: Callable[[], Any]) -> float:
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def _players(options: Options) -> List[Player]:
+    return [chesscom.lookup_player(f"player-{i}")
+            for i in range(options['players'])]
+
+
+def read_players(options: Options) -> List[float]:
+    return [_timed(lambda: (player.name(), player.rating('chess_blitz')))
+            for player in _players(options)]
+
+
+def fill_disk_cache(options: Options) -> None:
+    chesscom.set_response_cache(chesscom.DiskCache(tempfile.mkdtemp()))
+    read_players(options)
+    _clear_caches()
+
+
+def scan_country(options: Options) -> List[float]:
+    def scan():
+        players = list(chesscom.lookup_country('XX').iter_players())
+        chesscom.prefetch(players, parts=['stats'])
+        return [player.rating('chess_blitz') for player in players]
+
+    latencies = []
+    for _ in range(options['repeat']):
+        _clear_caches()
+        latencies.append(_timed(scan))
+    return latencies
+
+
+DEEP_QUERY = '''{
+  country(code: "XX") {
+    clubs(first: 10) { edges { node {
+      name
+      members(first: 10) { totalCount edges { node {
+        name rating(category: "chess_blitz") clubs { name }
+      } } }
+    } } }
+  }
+}'''
+
+PLAYER_QUERY = '''query($username: String!) {
+  player(username: $username) { name rating(category: "chess_blitz") }
+}'''
+
+
+def _execute(backend, query: str, **kwargs):
+    from cgqlbridge.schema import schema
+
+    document = backend.document_from_string(schema, query)
+    result = document.execute(context_value={}, **kwargs)
+    if result.errors:
+        raise result.errors[0]
+    return result
+
+
+def deep_graphql(options: Options) -> List[float]:
+    from cgqlbridge.planner import PlanningBackend
+
+    backend = PlanningBackend()
+    latencies = []
+    for _ in range(options['repeat']):
+        _clear_caches()
+        latencies.append(_timed(lambda: _execute(backend, DEEP_QUERY)))
+    return latencies
+
+
+def concurrent_clients(options: Options) -> List[float]:
+    from cgqlbridge.planner import PlanningBackend
+    from cgqlbridge.caching import CachingBackend
+
+    backend = CachingBackend(PlanningBackend())
+    # Clients ask for players from the same pool, so that some of their
+    # requests overlap (as they would for popular players)
+    rng = random.Random(0)
+    usernames = [f"player-{rng.randrange(options['players'])}"
+                 for _ in range(options['clients'] * options['requests'])]
+
+    def request(username):
+        return _timed(lambda: _execute(backend, PLAYER_QUERY,
+                                       variable_values={'username': username}))
+
+    with ThreadPoolExecutor(options['clients']) as pool:
+        return list(pool.map(request, usernames))
+
+
+SCENARIOS = {
+    # name: (prepare, run)
+    'cold': (None, read_players),
+    'warm': (read_players, read_players),
+    'disk': (fill_disk_cache, read_players),
+    'scan': (None, scan_country),
+    'graphql': (None, deep_graphql),
+    'concurrent': (None, concurrent_clients),
+}
+
+
+def percentile(values: List[float], q: float) -> float:
+    """The `q` quantile of some values (nearest rank)."""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def peak_rss() -> Optional[int]:
+    """The peak resident set size of this process, in bytes."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes, except on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_scenario(name: str, base_url: str, options: Options) -> Options:
+    """Run a scenario in this process, and report on it."""
+    prepare, run = SCENARIOS[name]
+    chesscom.set_transport(chesscom.Transport(base_url=base_url))
+    if prepare is not None:
+        prepare(options)
+
+    calls = metrics.UPSTREAM_REQUESTS.total()
+    received = metrics.UPSTREAM_BYTES.total()
+    start = time.perf_counter()
+    latencies = run(options)
+    seconds = time.perf_counter() - start
+    return {'operations': len(latencies),
+            'seconds': seconds,
+            'throughput': len(latencies) / seconds,
+            'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99),
+            'upstream_calls': metrics.UPSTREAM_REQUESTS.total() - calls,
+            'upstream_bytes': metrics.UPSTREAM_BYTES.total() - received,
+            'peak_rss': peak_rss()}
+
+
+def _run_in_child(name, base_url, options, queue):
+    try:
+        queue.put(run_scenario(name, base_url, options))
+    except Exception as e:
+        queue.put({'error': repr(e)})
+
+
+def run_isolated(name: str, base_url: str, options: Options) -> Options:
+    """Run a scenario in a new process, and report on it."""
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_run_in_child,
+                              args=(name, base_url, options, queue))
+    process.start()
+    report = queue.get()
+    process.join()
+    return report
+
+
+def compare(report: Options, baseline: Options) -> None:
+    """Print how the scenarios of a report fare against an earlier one."""
+    print(f"{'scenario':>12} {'throughput':>11} {'p50':>8} {'p99':>8}",
+          file=sys.stderr)
+    for name, result in report['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if not before or 'error' in before or 'error' in result:
+            continue
+        changes = [result[key] / before[key] - 1 if before[key] else 0.0
+                   for key in ('throughput', 'p50', 'p99')]
+        print(f"{name:>12} " + ' '.join(f"{change:+8.1%}".rjust(width)
+                                        for change, width
+                                        in zip(changes, (11, 8, 8))),
+              file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help="scenario to run (default: all)")
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help="seconds the stub server takes to answer")
+    parser.add_argument('--jitter', type=float, default=0.005,
+                        help="extra seconds it may take, at random")
+    parser.add_argument('--list-size', type=int, default=100,
+                        help="players of countries, members of clubs, etc.")
+    parser.add_argument('--players', type=int, default=200,
+                        help="players read by the cold/warm/disk scenarios")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="times to run the scan and graphql scenarios")
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=50,
+                        help="requests per client")
+    parser.add_argument('--output', help="file to write the report to")
+    parser.add_argument('--compare', help="earlier report to compare with")
+    args = parser.parse_args()
+
+    options = {'players': args.players, 'repeat': args.repeat,
+               'clients': args.clients, 'requests': args.requests}
+    api = StubAPI(latency=args.latency, jitter=args.jitter,
+                  list_size=args.list_size)
+    report = {'config': dict(options, latency=args.latency,
+                             jitter=args.jitter, list_size=args.list_size),
+              'environment': {'python': platform.python_version(),
+                              'platform': platform.platform()},
+              'scenarios': {}}
+    with StubServer(api) as server:
+        for name in args.scenario or SCENARIOS:
+            print(f"Running {name}...", file=sys.stderr)
+            report['scenarios'][name] = run_isolated(name, server.base_url,
+                                                     options)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""Compare requests/sec of unpooled `requests.get` and the pooled `Transport`.
+
+    python -m benchmarks.transport [--requests N] [--threads N]
+"""
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import time
+
+import requests
+
+from chesscom.rest import Transport
+from .stub_server import StubServer
+
+
+def run(get, n, threads):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        for r in pool.map(get, (f"player/player-{i}" for i in range(n))):
+            assert r.status_code == 200
+    return n / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+
+    with StubServer() as server:
+        def unpooled(endpoint):
+            return requests.get(server.base_url + endpoint)
+
+        pooled = Transport(base_url=server.base_url).get
+
+        for name, get in [('requests.get', unpooled), ('Transport', pooled)]:
+            rate = run(get, args.requests, args.threads)
+            print(f"{name:>14}: {rate:8.1f} requests/s")
+
+
+if __name__ == '__main__':
+    main()
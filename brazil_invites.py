@@ -57,6 +57,7 @@ if __name__ == '__main__':
 
     # Get and filter Brazilian players
     brazil = chesscom.lookup_country('BR')
+    chesscom.prefetch(brazil.players(), parts=['profile'])
     for player in brazil.players():
         if player.username() not in inviteds and is_potential_invite(player):
             new_inviteds.append(player)
@@ -1,20 +1,42 @@
-import os
-from flask import Flask
-from flask_graphql import GraphQLView
+"""Serve the bridge on port 5000 (or `GRAPHQL_BRIDGE_PORT`).
+
+By default with Flask's development server, which also serves GraphiQL.
+With `GRAPHQL_BRIDGE_SERVER=asgi`, the ASGI application (`cgqlbridge.asgi`)
+is served with `uvicorn` instead, in `GRAPHQL_BRIDGE_WORKERS` processes.
+Set `EXPOSE_GRAPHQL_BRIDGE=YES` to listen on all interfaces.
+"""
+from flask import Flask, Response
+from chesscom import metrics
 from .schema import schema
+from .config import configure, make_backend, HOST, PORT, SERVER, WORKERS, \
+    MAX_CONNECTIONS
+from .persisted import PersistedQueries, PersistedQueryView
+
+if SERVER == 'asgi':
+    import uvicorn
+
+    # Each worker sets itself up when importing the application
+    uvicorn.run('cgqlbridge.asgi:app', host=HOST, port=PORT, workers=WORKERS,
+                limit_concurrency=MAX_CONNECTIONS)
+else:
+    configure()
 
-app = Flask(__name__)
+    app = Flask(__name__)
 
-app.add_url_rule(
-    '/graphql',
-    view_func=GraphQLView.as_view(
-        'graphql',
-        schema=schema,
-        graphiql=True  # for having the GraphiQL interface
+    app.add_url_rule(
+        '/graphql',
+        view_func=PersistedQueryView.as_view(
+            'graphql',
+            schema=schema,
+            backend=make_backend(),
+            persisted_queries=PersistedQueries(),
+            graphiql=True  # for having the GraphiQL interface
+        )
     )
-)
 
-if os.getenv('EXPOSE_GRAPHQL_BRIDGE', 'NO') == 'YES':
-    app.run(host='0.0.0.0', port=5000)
-else:
-    app.run(port=5000)
+    @app.route('/metrics')
+    def serve_metrics():
+        return Response(metrics.exposition(),
+                        mimetype='text/plain; version=0.0.4')
+
+    app.run(host=HOST, port=PORT)
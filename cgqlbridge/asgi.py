@@ -0,0 +1,246 @@
+"""An ASGI application serving the GraphQL bridge (requires `aiohttp`).
+
+For production; run it with an ASGI server, eg.
+
+    uvicorn cgqlbridge.asgi:app --workers 4
+
+or with `GRAPHQL_BRIDGE_SERVER=asgi python -m cgqlbridge` (see there).
+Queries are executed on the event loop: the parts they need are requested
+with the asyncio client, so that a query waiting on the Chess.com API does
+not hold a thread, and a worker can have many in flight at once.
+
+Serves queries on `/graphql` (GET and POST, with persisted queries and
+incremental delivery, but without GraphiQL) and the metrics on `/metrics`.
+Configured by the same environment variables as the development server
+(see `config`).
+"""
+from typing import AsyncIterator, Optional, Tuple, List, Union
+from urllib.parse import parse_qsl
+import asyncio
+import inspect
+
+from graphql.execution import ExecutionResult
+from graphql_server import HttpQueryError, default_format_error, \
+    encode_execution_results, get_graphql_params, json_encode, \
+    load_json_body
+
+from chesscom import aio
+from chesscom import metrics
+from chesscom.rest import Scheduler, set_scheduler
+from .schema import schema
+from .config import configure, make_backend, MAX_QUERIES, \
+    UPSTREAM_CONCURRENCY
+from .incremental import Encoding, accepted_encoding, uses_incremental
+from .persisted import PersistedQueries
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+Response = Tuple[int, List[Tuple[bytes, bytes]],
+                 Union[bytes, AsyncIterator[bytes]]]
+
+
+class GraphQLApp(object):
+    """Executes GraphQL queries from HTTP requests, as an ASGI application.
+
+    Like `PersistedQueryView`, but with a backend executing on the event
+    loop (see `config.make_backend`), and executing at most `max_queries`
+    queries at once (queries delivered incrementally count until their last
+    payload)."""
+
+    def __init__(self, schema, backend, persisted_queries=None,
+                 max_queries: Optional[int] = None):
+        self.schema = schema
+        self.backend = backend
+        self.persisted_queries = persisted_queries or PersistedQueries()
+        self.max_queries = max_queries
+        self._slots = None  # type: Optional[asyncio.Semaphore]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        path = scope['path'].rstrip('/')
+        if path == '/graphql':
+            status, headers, body = await self._graphql(scope, receive)
+        elif path == '/metrics':
+            status, headers, body = (
+                200, [(b'content-type', b'text/plain; version=0.0.4')],
+                metrics.exposition().encode())
+        else:
+            status, headers, body = (
+                404, [(b'content-type', b'text/plain')], b'Not Found')
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': headers})
+        if isinstance(body, bytes):
+            await send({'type': 'http.response.body', 'body': body})
+            return
+        async for part in body:
+            await send({'type': 'http.response.body', 'body': part,
+                        'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await aio.get_transport().close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _graphql(self, scope, receive) -> Response:
+        method = scope['method'].lower()
+        try:
+            if method not in ('get', 'post'):
+                raise HttpQueryError(
+                    405, "GraphQL only supports GET and POST requests.",
+                    headers={'Allow': 'GET, POST'})
+            query_data = dict(parse_qsl(scope['query_string'].decode()))
+            if method == 'get':
+                data = query_data
+            else:
+                data = _parse_body(_content_type(scope),
+                                   await _read_body(receive))
+            if isinstance(data, list):
+                raise HttpQueryError(
+                    400, "Batch GraphQL requests are not enabled.")
+
+            params = get_graphql_params(
+                self.persisted_queries.resolve(data), query_data)
+            encoding = accepted_encoding(_header(scope, b'accept'))
+            if encoding is not None:
+                document = self._incremental_document(params)
+                if document is not None:
+                    return 200, [(b'content-type',
+                                  encoding.content_type.encode())], \
+                        self._deliver(document, params, encoding)
+            result = await self._execute(params, method == 'get')
+            body, status = encode_execution_results([result])
+            headers = {}
+        except HttpQueryError as e:
+            body = json_encode({'errors': [default_format_error(e)]})
+            status, headers = e.status_code, e.headers or {}
+
+        headers = dict(headers, **{'Content-Type': 'application/json'})
+        return status, [(name.lower().encode(), value.encode())
+                        for name, value in headers.items()], body.encode()
+
+    async def _execute(self, params, allow_only_query: bool):
+        """Execute a query, like `graphql_server.execute_graphql_request`."""
+        if not params.query:
+            raise HttpQueryError(400, "Must provide query string.")
+        try:
+            document = self.backend.document_from_string(self.schema,
+                                                         params.query)
+        except Exception as e:
+            return ExecutionResult(errors=[e], invalid=True)
+
+        if allow_only_query:
+            operation_type = document.get_operation_type(
+                params.operation_name)
+            if operation_type and operation_type != 'query':
+                raise HttpQueryError(
+                    405, f"Can only perform a {operation_type} operation "
+                    f"from a POST request.", headers={'Allow': 'POST'})
+
+        if self._slots is None and self.max_queries:
+            self._slots = asyncio.Semaphore(self.max_queries)
+        try:
+            if self._slots is None:
+                return await self._result(document, params)
+            async with self._slots:
+                return await self._result(document, params)
+        except Exception as e:
+            return ExecutionResult(errors=[e], invalid=True)
+
+    def _incremental_document(self, params):
+        """The document of a query to deliver incrementally, if it is one
+        (only queries can be, and as such may be sent with GET)."""
+        if not params.query or \
+                not hasattr(self.backend, 'execute_incremental'):
+            return None
+        try:
+            document = self.backend.document_from_string(self.schema,
+                                                         params.query)
+        except Exception:
+            return None
+        if not uses_incremental(document.document_ast,
+                                params.operation_name):
+            return None
+        return document
+
+    async def _deliver(self, document, params,
+                       encoding: Encoding) -> AsyncIterator[bytes]:
+        if self._slots is None and self.max_queries:
+            self._slots = asyncio.Semaphore(self.max_queries)
+        if self._slots is not None:
+            await self._slots.acquire()
+        try:
+            async for payload in self.backend.execute_incremental(
+                    self.schema, document.document_ast,
+                    variable_values=params.variables,
+                    operation_name=params.operation_name):
+                yield encoding.part(payload)
+            yield encoding.end
+        finally:
+            if self._slots is not None:
+                self._slots.release()
+
+    @staticmethod
+    async def _result(document, params):
+        result = document.execute(operation_name=params.operation_name,
+                                  variable_values=params.variables,
+                                  context_value={})
+        if isinstance(result, asyncio.Future):
+            # Possibly shared with other requests (see `CachingBackend`):
+            # not to be cancelled if this one is
+            return await asyncio.shield(result)
+        if inspect.isawaitable(result):
+            return await result
+        return result
+
+
+def _header(scope, name: bytes) -> str:
+    for header, value in scope['headers']:
+        if header == name:
+            return value.decode('latin-1')
+    return ''
+
+
+def _content_type(scope) -> str:
+    return _header(scope, b'content-type').split(';')[0].strip()
+
+
+async def _read_body(receive) -> bytes:
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+def _parse_body(content_type: str, body: bytes):
+    """The parameters of a query posted, like `GraphQLView.parse_body`."""
+    if content_type == 'application/graphql':
+        return {'query': body.decode('utf8')}
+    if content_type == 'application/json':
+        return load_json_body(body.decode('utf8'))
+    if content_type == 'application/x-www-form-urlencoded':
+        return dict(parse_qsl(body.decode('utf8')))
+    return {}
+
+
+configure()
+# Requests of both clients are paced by the shared scheduler
+set_scheduler(Scheduler(max_in_flight=UPSTREAM_CONCURRENCY))
+aio.set_transport(aio.AsyncTransport(concurrency=UPSTREAM_CONCURRENCY))
+
+app = GraphQLApp(schema, make_backend(asynchronous=True),
+                 max_queries=MAX_QUERIES)
@@ -0,0 +1,146 @@
+from collections import OrderedDict
+from functools import partial
+from typing import Any, Dict
+import threading
+import asyncio
+import inspect
+import json
+import time
+
+from graphql.backend.base import GraphQLBackend, GraphQLDocument
+from graphql.execution import ExecutionResult
+from graphql.language.printer import print_ast
+
+from chesscom.cache import SingleFlight
+from chesscom.rest import tracking_expiry, Expiry, DEFAULT_TTL
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class CachingBackend(GraphQLBackend):
+    """Keeps documents, and the results of executing queries.
+
+    Wraps another backend (eg., a `PlanningBackend`), keeping the last
+    `max_documents` documents it made by their text, so that repeated
+    queries are not parsed and validated again. The results of queries
+    are kept by their normalized document, operation and variables until
+    the earliest expiry of the data they used (or at most `max_ttl`
+    seconds), so that they are never staler than the properties they were
+    made from. Results with errors are not kept. Identical queries being
+    executed at the same time share one execution.
+
+    If the wrapped backend executes on an event loop (eg., an
+    `AsyncPlanningBackend`), executing a query returns either a result kept
+    or a future of one.
+    """
+
+    def __init__(self, backend: GraphQLBackend, max_documents: int = 1000,
+                 max_results: int = 10000, max_ttl: float = DEFAULT_TTL):
+        self.backend = backend
+        self.max_documents = max_documents
+        self.max_results = max_results
+        self.max_ttl = max_ttl
+        self._lock = threading.Lock()
+        self._documents = OrderedDict()
+        self._results = OrderedDict()
+        self._flights = SingleFlight()
+        self._pending = {}  # type: Dict[Any, asyncio.Future]
+        self.hits = 0
+        self.misses = 0
+
+    def document_from_string(self, schema, document_string):
+        key = (schema, document_string)
+        with self._lock:
+            document = self._documents.get(key)
+            if document is not None:
+                self._documents.move_to_end(key)
+                return document
+
+        inner = self.backend.document_from_string(schema, document_string)
+        document = GraphQLDocument(
+            schema=schema,
+            document_string=inner.document_string,
+            document_ast=inner.document_ast,
+            execute=partial(self._execute, inner,
+                            print_ast(inner.document_ast)))
+        with self._lock:
+            self._documents[key] = document
+            while len(self._documents) > self.max_documents:
+                self._documents.popitem(last=False)
+        return document
+
+    def _execute(self, document: GraphQLDocument, normalized: str,
+                 *args, **kwargs):
+        operation_name = kwargs.get('operation_name')
+        if document.get_operation_type(operation_name) != 'query':
+            return document.execute(*args, **kwargs)
+
+        key = (document.schema, normalized, operation_name,
+               json.dumps(kwargs.get('variable_values') or {},
+                          sort_keys=True))
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is not None:
+                expires, result = entry
+                if time.time() < expires:
+                    self._results.move_to_end(key)
+                    self.hits += 1
+                    return result
+                del self._results[key]
+            self.misses += 1
+            pending = self._pending.get(key)
+        if pending is not None:
+            return pending
+
+        return self._flights.run(
+            key, lambda: self._execute_and_keep(key, document, *args,
+                                                **kwargs))
+
+    def _execute_and_keep(self, key, document: GraphQLDocument,
+                          *args, **kwargs):
+        with tracking_expiry() as expiry:
+            result = document.execute(*args, **kwargs)
+            if inspect.isawaitable(result):
+                # The task runs in a copy of this context, so it still
+                # tracks the expiry of what it uses
+                future = asyncio.ensure_future(
+                    self._keep_awaited(key, expiry, result))
+                with self._lock:
+                    self._pending[key] = future
+                future.add_done_callback(
+                    lambda _: self._pending.pop(key, None))
+                return future
+        return self._keep(key, expiry, result)
+
+    async def _keep_awaited(self, key, expiry: Expiry, result):
+        return self._keep(key, expiry, await result)
+
+    def _keep(self, key, expiry: Expiry, result):
+        expires = min(expiry.expires, time.time() + self.max_ttl)
+        if not isinstance(result, ExecutionResult) or result.errors or \
+                result.invalid or expires <= time.time():
+            return result
+        with self._lock:
+            self._results[key] = (expires, result)
+            while len(self._results) > self.max_results:
+                self._results.popitem(last=False)
+        logger.debug("Keeping result for %.0fs", expires - time.time())
+        return result
+
+    def execute_incremental(self, schema, document_ast, **kwargs):
+        """Execute a query with the wrapped backend, delivering it
+        incrementally (the result is not kept)."""
+        return self.backend.execute_incremental(schema, document_ast,
+                                                **kwargs)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._results.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {'documents': len(self._documents),
+                'results': len(self._results),
+                'hits': self.hits,
+                'misses': self.misses}
@@ -0,0 +1,111 @@
+"""Configuration of the bridge from environment variables.
+
+Shared by the development server (`python -m cgqlbridge`) and the ASGI
+application (`cgqlbridge.asgi`), which may run in several worker processes.
+"""
+import os
+
+from chesscom import DiskCache, set_response_cache
+from chesscom import metrics
+from chesscom.cache import configure_instance_caches, \
+    set_stale_while_revalidate
+from chesscom.entity import set_negative_ttl
+from chesscom.sharedcache import TieredCache, shared_cache
+from chesscom.warmer import CacheWarmer
+from .planner import PlanningBackend, AsyncPlanningBackend
+from .caching import CachingBackend
+
+HOST = '0.0.0.0' if os.getenv('EXPOSE_GRAPHQL_BRIDGE', 'NO') == 'YES' \
+    else '127.0.0.1'
+
+PORT = int(os.getenv('GRAPHQL_BRIDGE_PORT', '5000'))
+
+
+def _optional_int(name):
+    value = os.getenv(name)
+    return int(value) if value else None
+
+
+# Serving with the ASGI application (see `cgqlbridge.asgi`)
+
+SERVER = os.getenv('GRAPHQL_BRIDGE_SERVER', 'flask')
+"""'flask' (the development server) or 'asgi'."""
+
+WORKERS = int(os.getenv('GRAPHQL_BRIDGE_WORKERS', '1'))
+"""Worker processes."""
+
+MAX_CONNECTIONS = _optional_int('GRAPHQL_BRIDGE_MAX_CONNECTIONS')
+"""Connections served at once per worker, others being answered 503."""
+
+MAX_QUERIES = _optional_int('GRAPHQL_BRIDGE_MAX_QUERIES')
+"""Queries executed at once per worker, others waiting their turn."""
+
+UPSTREAM_CONCURRENCY = int(
+    os.getenv('GRAPHQL_BRIDGE_UPSTREAM_CONCURRENCY', '16'))
+"""Requests to the API in flight at once per worker."""
+
+
+def configure() -> None:
+    """Set up the caches of the API client."""
+    # Keep the identity caches bounded, as the bridge runs indefinitely
+    configure_instance_caches(
+        max_size=int(os.getenv('GRAPHQL_BRIDGE_CACHE_SIZE', '50000')),
+        max_age=float(os.getenv('GRAPHQL_BRIDGE_CACHE_AGE', '86400')),
+        weak=True)
+
+    # Optionally serve expired data while refreshing it in the background
+    set_stale_while_revalidate(
+        float(os.getenv('GRAPHQL_BRIDGE_STALE_GRACE', '0')))
+
+    # Remember missing entities (eg. closed accounts) for so many seconds,
+    # rather than asking for them in every query
+    set_negative_ttl(float(os.getenv('GRAPHQL_BRIDGE_NEGATIVE_TTL', '900')))
+
+    # Optionally refresh the most read entities before they expire, making
+    # up to so many calls to the API per hour
+    calls_per_hour = float(os.getenv('GRAPHQL_BRIDGE_WARM_CALLS', '0'))
+    if calls_per_hour > 0:
+        CacheWarmer(calls_per_hour=calls_per_hour).start()
+
+    # Optionally keep responses on disk, so that restarts start warm (and
+    # the workers of a host share them)
+    cache = None
+    if os.getenv('GRAPHQL_BRIDGE_CACHE_DIR'):
+        cache = DiskCache(
+            os.getenv('GRAPHQL_BRIDGE_CACHE_DIR'),
+            max_bytes=int(os.getenv('GRAPHQL_BRIDGE_CACHE_BYTES',
+                                    str(1 << 30))))
+
+    # Optionally share responses between hosts, through cache servers
+    # (comma-separated URLs), each endpoint being fetched by one host only
+    urls = [url for url in
+            os.getenv('GRAPHQL_BRIDGE_SHARED_CACHE', '').split(',') if url]
+    if urls:
+        shared = shared_cache(urls, local_entries=0 if cache else int(
+            os.getenv('GRAPHQL_BRIDGE_LOCAL_CACHE_SIZE', '10000')))
+        cache = TieredCache(cache, shared) if cache else shared
+    if cache is not None:
+        set_response_cache(cache)
+
+
+def make_backend(asynchronous: bool = False) -> CachingBackend:
+    """The backend executing queries (on an event loop if `asynchronous`).
+
+    Rejects queries that would make too many calls to the API, prefetches
+    what the others need, and keeps results until their data expires."""
+    planning = AsyncPlanningBackend if asynchronous else PlanningBackend
+    backend = CachingBackend(
+        planning(budget=float(
+            os.getenv('GRAPHQL_BRIDGE_QUERY_BUDGET', '2000'))),
+        max_results=int(
+            os.getenv('GRAPHQL_BRIDGE_RESULT_CACHE_SIZE', '10000')))
+
+    metrics.Gauge('cgqlbridge_result_cache_entries',
+                  "Results kept by the result cache",
+                  read=lambda: {(): backend.stats()['results']})
+    metrics.Gauge('cgqlbridge_result_cache_total',
+                  "Executions of queries, by outcome: 'hit' (result kept) "
+                  "or 'miss'", ('outcome',),
+                  lambda: {('hit',): backend.hits, ('miss',): backend.misses},
+                  kind='counter')
+    return backend
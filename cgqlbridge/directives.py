@@ -0,0 +1,49 @@
+"""The `@defer` and `@stream` directives, for incremental delivery.
+
+Declared in the schema so that queries using them are valid; executing a
+query normally ignores them (see `incremental` for what they do).
+"""
+from typing import Any, Dict, Optional
+
+from graphql import GraphQLArgument, GraphQLBoolean, GraphQLInt, \
+    GraphQLString
+from graphql.execution.values import get_argument_values
+from graphql.type.directives import GraphQLDirective, DirectiveLocation, \
+    specified_directives
+
+DeferDirective = GraphQLDirective(
+    name='defer',
+    description="Delivers the fragment after the rest of the result.",
+    args={'if': GraphQLArgument(GraphQLBoolean, default_value=True),
+          'label': GraphQLArgument(GraphQLString)},
+    locations=[DirectiveLocation.FRAGMENT_SPREAD,
+               DirectiveLocation.INLINE_FRAGMENT])
+
+StreamDirective = GraphQLDirective(
+    name='stream',
+    description="Delivers the items of a list after the first "
+                "`initialCount` ones, as they are resolved.",
+    args={'if': GraphQLArgument(GraphQLBoolean, default_value=True),
+          'label': GraphQLArgument(GraphQLString),
+          'initialCount': GraphQLArgument(GraphQLInt, default_value=0)},
+    locations=[DirectiveLocation.FIELD])
+
+DIRECTIVES = list(specified_directives) + [DeferDirective, StreamDirective]
+
+
+def directive_args(directive: GraphQLDirective, node,
+                   variables: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """The arguments of the directive on a node, if it is there (and not
+    turned off with `if: false`)."""
+    for applied in node.directives or ():
+        if applied.name.value == directive.name:
+            args = get_argument_values(directive.args, applied.arguments,
+                                       variables)
+            return args if args.get('if', True) else None
+    return None
+
+
+def initial_count(field, variables: Dict[str, Any]) -> Optional[int]:
+    """The items of a list field delivered at first, if it is streamed."""
+    args = directive_args(StreamDirective, field, variables)
+    return None if args is None else max(0, args.get('initialCount', 0))
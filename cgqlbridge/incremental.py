@@ -0,0 +1,553 @@
+"""Incremental delivery of query results, with `@defer` and `@stream`.
+
+A query for a long list is only answered once every item of it has been
+resolved. Delivered incrementally, the first items are sent right away, and
+the others as they are resolved, eg. with
+
+    country(code: "BR") {
+      players(first: 1000) {
+        edges @stream(initialCount: 10) { node { name avatar } }
+      }
+    }
+
+the first payload has the first 10 players, and the others follow in later
+payloads as their profiles are fetched. Fragments marked `@defer` are left
+out of the first payload and follow once resolved. Payloads are in the
+format of the GraphQL incremental delivery proposal:
+
+    {"data": {...}, "hasNext": true}
+    {"incremental": [{"items": [...], "path": [..., 10]}], "hasNext": true}
+    {"incremental": [{"data": {...}, "path": [...]}], "hasNext": false}
+
+They are sent as a `multipart/mixed` body or as server-sent events (see
+`Encoding`) to clients asking for either in their `Accept` header, and only
+for queries using the directives; other requests are answered as usual.
+Results delivered incrementally are not kept by the `CachingBackend`.
+
+Only the first items of streamed lists are prefetched before the first
+payload, but the whole query counts towards the budget. The rest of a
+streamed list is resolved item by item (up to `max_workers` at a time), and
+the items are delivered in order, as soon as those before them have been.
+"""
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, \
+    Tuple
+import asyncio
+import copy
+
+from graphql import GraphQLError
+from graphql.execution import ExecutionResult, execute
+from graphql.execution.base import ExecutionContext
+from graphql.execution.executor import complete_value_catching_error, \
+    execute_fields
+from graphql.execution.executors.asyncio import AsyncioExecutor
+from graphql.execution.executors.sync import SyncExecutor
+from graphql.execution.middleware import MiddlewareManager
+from graphql.execution.values import get_variable_values
+from graphql.language import ast
+from graphql.type.definition import GraphQLList, GraphQLNonNull
+from graphql.validation import validate
+from graphql_server import default_format_error, json_encode
+from promise import Promise
+
+from chesscom.entity import request_parts
+
+from .directives import DeferDirective, StreamDirective, directive_args, \
+    initial_count
+from .loader import MAX_WORKERS
+from .planner import DEFAULT_BUDGET, _OverBudget, _operation, _rejected, \
+    _rounds, plan_query
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+Payload = Dict[str, Any]
+
+
+class Encoding(object):
+    """How payloads are sent in the body of a response."""
+
+    def __init__(self, media_type: str, content_type: str, before: bytes,
+                 after: bytes, end: bytes):
+        self.media_type = media_type
+        self.content_type = content_type
+        self.before = before
+        self.after = after
+        self.end = end
+
+    def part(self, payload: Payload) -> bytes:
+        return self.before + json_encode(payload).encode() + self.after
+
+
+MULTIPART = Encoding(
+    'multipart/mixed', 'multipart/mixed; boundary="-"; deferSpec=20220824',
+    b'\r\n---\r\nContent-Type: application/json; charset=utf-8\r\n\r\n',
+    b'', b'\r\n-----\r\n')
+
+EVENT_STREAM = Encoding('text/event-stream', 'text/event-stream',
+                        b'event: next\ndata: ', b'\n\n',
+                        b'event: complete\ndata:\n\n')
+
+
+def accepted_encoding(accept: str) -> Optional[Encoding]:
+    """The encoding of incremental payloads a client accepts, if any."""
+    media_types = [media_type.split(';')[0].strip()
+                   for media_type in (accept or '').split(',')]
+    for encoding in (MULTIPART, EVENT_STREAM):
+        if encoding.media_type in media_types:
+            return encoding
+    return None
+
+
+def uses_incremental(document_ast, operation_name=None) -> bool:
+    """Check if the query uses `@defer` or `@stream` (anywhere)."""
+    operation, fragments = _operation(document_ast, operation_name)
+    if operation is None or operation.operation != 'query':
+        return False
+    names = (DeferDirective.name, StreamDirective.name)
+    nodes = [operation.selection_set, *(fragment.selection_set
+                                        for fragment in fragments.values())]
+    while nodes:
+        selection_set = nodes.pop()
+        for selection in selection_set.selections:
+            if any(directive.name.value in names
+                   for directive in selection.directives or ()):
+                return True
+            if getattr(selection, 'selection_set', None) is not None:
+                nodes.append(selection.selection_set)
+    return False
+
+
+def _without_defer(node):
+    copied = copy.copy(node)
+    copied.directives = [directive for directive in node.directives
+                         if directive.name.value != DeferDirective.name]
+    return copied
+
+
+def _nullable(return_type):
+    if isinstance(return_type, GraphQLNonNull):
+        return return_type.of_type
+    return return_type
+
+
+class _Deferred(object):
+    """A deferred fragment, to complete on the value at a path."""
+
+    def __init__(self, label: Optional[str], info, return_type, path: list,
+                 value, fragment):
+        self.label = label
+        self.info = info
+        self.return_type = _nullable(return_type)
+        self.path = path
+        self.value = value
+        self.fragment = fragment
+
+
+class _Stream(object):
+    """The items of a streamed list left to deliver.
+
+    Completed items are kept until those before them have been delivered,
+    along with what they deferred in turn."""
+
+    def __init__(self, label: Optional[str], info, path: list, items: list,
+                 start: int, deferred: list):
+        self.label = label
+        self.info = info
+        self.item_type = _nullable(_nullable(info.return_type).of_type)
+        self.path = path
+        self.items = items
+        self.start = start
+        self.deferred = deferred
+        self.next = start
+        self._ready = {}  # type: Dict[int, Tuple[Any, list, list]]
+
+    def receive(self, index: int, item, errors: list,
+                records: list) -> Tuple[List[Payload], list]:
+        """Take a completed item, giving the items now ready to deliver (if
+        any) and the records they release."""
+        self._ready[index] = (item, errors, records)
+        items, item_errors, released = [], [], []
+        while self.next in self._ready:
+            item, errors, records = self._ready.pop(self.next)
+            items.append(item)
+            item_errors.extend(errors)
+            released.extend(records)
+            for label, fragment in self.deferred:
+                released.append(_Deferred(
+                    label, self.info, self.item_type,
+                    self.path + [self.next], self.items[self.next -
+                                                        self.start],
+                    fragment))
+            self.next += 1
+        if not items:
+            return [], []
+        return [_entry({'items': items,
+                        'path': self.path + [self.next - len(items)]},
+                       self.label, item_errors)], released
+
+
+def _entry(entry: Payload, label: Optional[str], errors: list) -> Payload:
+    if label is not None:
+        entry['label'] = label
+    if errors:
+        entry['errors'] = [default_format_error(error) for error in errors]
+    return entry
+
+
+class _Collector(object):
+    """Middleware noting what a (partial) execution leaves for later.
+
+    Streamed lists are cut down to their first items, and the values of
+    fields with deferred fragments are kept to complete these later."""
+
+    def __init__(self, query: '_Query'):
+        self.query = query
+        self.records = []
+
+    def resolve(self, next, root, info, **args):
+        result = next(root, info, **args)
+        field = info.field_asts[0]
+        count = initial_count(field, self.query.variables)
+        deferred = self.query.deferred_in(field)
+        if count is None and not deferred:
+            return result
+        return Promise.resolve(result).then(
+            lambda value: self._split(info, count, deferred, value))
+
+    def _split(self, info, count: Optional[int], deferred: list, value):
+        if value is None:
+            return value
+        if count is not None:
+            items = list(value)
+            value = items[:count]
+            if len(items) > count:
+                args = directive_args(StreamDirective, info.field_asts[0],
+                                      self.query.variables)
+                self.records.append(_Stream(args.get('label'), info,
+                                            list(info.path), items[count:],
+                                            count, deferred))
+        for label, fragment in deferred:
+            self.records.append(_Deferred(label, info, info.return_type,
+                                          list(info.path), value, fragment))
+        return value
+
+
+class _Query(object):
+    """A query being delivered incrementally.
+
+    Keeps a copy of the document with the deferred fragments taken out, and
+    those by the selection set they were taken from."""
+
+    def __init__(self, schema, document_ast, root_value, variable_values,
+                 operation_name):
+        self.schema = schema
+        self.root_value = root_value
+        self.variable_values = variable_values or {}
+        self.operation_name = operation_name
+        operation, _ = _operation(document_ast, operation_name)
+        self.variables = get_variable_values(
+            schema, operation.variable_definitions or [],
+            self.variable_values)
+        self._deferred = {}  # type: Dict[int, list]
+        self.document = ast.Document(
+            definitions=[self._strip(definition)
+                         for definition in document_ast.definitions],
+            loc=document_ast.loc)
+        _, self.fragments = _operation(self.document, operation_name)
+        self._owned = {}  # type: Dict[int, list]
+
+    def _strip(self, node):
+        selection_set = getattr(node, 'selection_set', None)
+        if selection_set is None:
+            return node
+        kept, deferred = [], []
+        for selection in selection_set.selections:
+            args = None
+            if isinstance(selection, (ast.InlineFragment,
+                                      ast.FragmentSpread)):
+                args = directive_args(DeferDirective, selection,
+                                      self.variables)
+            if args is None:
+                kept.append(self._strip(selection))
+            else:
+                deferred.append((args.get('label'),
+                                 self._strip(_without_defer(selection))))
+        copied = copy.copy(node)
+        copied.selection_set = ast.SelectionSet(selections=kept,
+                                                loc=selection_set.loc)
+        if deferred:
+            self._deferred[id(copied.selection_set)] = deferred
+        return copied
+
+    def _deferred_under(self, selection_set) -> list:
+        """The fragments deferred in a selection set, or in the fragments
+        it includes."""
+        deferred = list(self._deferred.get(id(selection_set), ()))
+        for selection in selection_set.selections:
+            if isinstance(selection, ast.InlineFragment):
+                deferred.extend(self._deferred_under(selection.selection_set))
+            elif isinstance(selection, ast.FragmentSpread):
+                fragment = self.fragments.get(selection.name.value)
+                if fragment is not None:
+                    deferred.extend(
+                        self._deferred_under(fragment.selection_set))
+        return deferred
+
+    def deferred_in(self, field) -> list:
+        """The (label, fragment) pairs deferred in the selection of a field
+        (of the stripped document)."""
+        if field.selection_set is None:
+            return []
+        deferred = self._owned.get(id(field))
+        if deferred is None:
+            deferred = self._owned[id(field)] = \
+                self._deferred_under(field.selection_set)
+        return deferred
+
+    def root_deferred(self) -> list:
+        operation, _ = _operation(self.document, self.operation_name)
+        return self._deferred_under(operation.selection_set)
+
+    def _context(self, executor, collector) -> ExecutionContext:
+        # A context of its own, so that it has a loader of its own
+        return ExecutionContext(self.schema, self.document, self.root_value,
+                                {}, self.variable_values,
+                                self.operation_name, executor,
+                                MiddlewareManager(collector), False)
+
+    def execute_initial(self, executor=None, **kwargs):
+        """Execute the query without what is left for later."""
+        collector = _Collector(self)
+        result = execute(self.schema, self.document, self.root_value, {},
+                         self.variable_values, self.operation_name,
+                         executor=executor, middleware=[collector], **kwargs)
+        return result, collector
+
+    def start(self, task, executor=None):
+        """Start completing a deferred fragment, or a streamed item.
+
+        Returns a promise of its data, the execution context (for errors)
+        and what it left for later."""
+        record, index, value = task
+        collector = _Collector(self)
+        context = self._context(executor or SyncExecutor(), collector)
+        if isinstance(record, _Stream):
+            completed = complete_value_catching_error(
+                context, record.item_type, record.info.field_asts,
+                record.info, record.path + [index], value)
+            return Promise.resolve(completed), context, collector
+
+        # The field the fragment was deferred in, selecting only it
+        field = copy.copy(record.info.field_asts[0])
+        field.selection_set = ast.SelectionSet(selections=[record.fragment])
+        if isinstance(record.info, _RootInfo):
+            # Completing a None root value would give None
+            completed = Promise.resolve(None).then(
+                lambda _: execute_fields(
+                    context, record.return_type, value,
+                    context.get_sub_fields(record.return_type, [field]),
+                    [], None)).catch(
+                lambda e: context.report_error(e) or None)
+        else:
+            completed = complete_value_catching_error(
+                context, record.return_type, [field], record.info,
+                record.path, value)
+        return Promise.resolve(completed), context, collector
+
+    def initial_records(self, collector) -> list:
+        records = list(collector.records)
+        info = _RootInfo(self.schema)
+        for label, fragment in self.root_deferred():
+            records.append(_Deferred(label, info, info.return_type, [],
+                                     self.root_value, fragment))
+        return records
+
+
+class _RootInfo(object):
+    """Stands in for the info of a field, for fragments deferred at the
+    root of the query."""
+
+    def __init__(self, schema):
+        self.field_asts = [ast.Field(name=ast.Name(value='__root'))]
+        self.return_type = schema.get_query_type()
+        self.path = []
+
+
+def _tasks(records: list) -> list:
+    """The (record, index, value) to complete, for records to deliver."""
+    tasks = []
+    for record in records:
+        if isinstance(record, _Deferred):
+            tasks.append((record, None, record.value))
+        else:
+            tasks.extend((record, record.start + i, item)
+                         for i, item in enumerate(record.items))
+    return tasks
+
+
+def _deferred_entries(record: _Deferred, data,
+                      errors: list) -> List[Payload]:
+    """The entries delivering a deferred fragment, one per item of a
+    list."""
+    if isinstance(record.return_type, GraphQLList) and data is not None:
+        entries = []
+        for i, item in enumerate(data):
+            path = record.path + [i]
+            entries.append(_entry(
+                {'data': item, 'path': path}, record.label,
+                [error for error in errors
+                 if list(getattr(error, 'path', None) or ())[
+                     :len(path)] == path]))
+        return entries
+    return [_entry({'data': data or {}, 'path': record.path},
+                   record.label, errors)]
+
+
+def _receive(task, data, errors: list,
+             records: list) -> Tuple[List[Payload], list]:
+    """The entries to deliver for a completed task, and the records it
+    releases (once delivered)."""
+    record, index, _ = task
+    if isinstance(record, _Stream):
+        return record.receive(index, data, errors, records)
+    return _deferred_entries(record, data, errors), records
+
+
+def _initial_payload(result: ExecutionResult, has_next: bool) -> Payload:
+    payload = {'data': result.data}
+    if result.errors:
+        payload['errors'] = [default_format_error(error)
+                             for error in result.errors]
+    payload['hasNext'] = has_next
+    return payload
+
+
+def _prepare(schema, document_ast, budget, root_value, variable_values,
+             operation_name):
+    """The query to deliver, or the payload rejecting it."""
+    errors = validate(schema, document_ast)
+    if errors:
+        return None, _initial_payload(
+            ExecutionResult(errors=errors, invalid=True), False)
+    try:
+        query = _Query(schema, document_ast, root_value, variable_values,
+                       operation_name)
+    except (GraphQLError, ValueError) as e:
+        # Invalid variables (which graphql-core may fail to coerce)
+        return None, _initial_payload(
+            ExecutionResult(errors=[e], invalid=True), False)
+    # The whole query counts towards the budget
+    plan = plan_query(schema, document_ast, operation_name, variable_values)
+    if plan is not None and plan.calls > budget:
+        logger.info("Rejected query estimated at %d calls", plan.calls)
+        return None, _initial_payload(_rejected(plan.calls, budget), False)
+    return query, None
+
+
+def execute_incremental(schema, document_ast, budget: float = DEFAULT_BUDGET,
+                        max_workers: int = MAX_WORKERS, root_value=None,
+                        variable_values=None,
+                        operation_name=None) -> Iterator[Payload]:
+    """Execute a query, yielding its result in payloads as it is resolved.
+
+    Like `execute_planned`, but delivering streamed items and deferred
+    fragments after the rest. Streamed items are resolved by up to
+    `max_workers` threads."""
+    query, rejected = _prepare(schema, document_ast, budget, root_value,
+                               variable_values, operation_name)
+    if query is None:
+        yield rejected
+        return
+    try:
+        for jobs in _rounds(schema, query.document, budget, operation_name,
+                            variable_values, streaming=True):
+            request_parts(jobs, max_workers)
+    except _OverBudget as e:
+        yield _initial_payload(_rejected(e.args[0], budget), False)
+        return
+
+    result, collector = query.execute_initial()
+    records = query.initial_records(collector)
+    yield _initial_payload(result, bool(records))
+
+    def run(task):
+        promise, context, collector = query.start(task)
+        context.executor.wait_until_finished()
+        return promise.get(), context.errors, collector.records
+
+    pool = ThreadPoolExecutor(max_workers=max_workers,
+                              thread_name_prefix='incremental')
+    try:
+        running = {pool.submit(run, task): task for task in _tasks(records)}
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            entries = []
+            for future in done:
+                task = running.pop(future)
+                entries_, released = _receive(task, *future.result())
+                entries.extend(entries_)
+                for task in _tasks(released):
+                    running[pool.submit(run, task)] = task
+            if entries or not running:
+                yield {'incremental': entries, 'hasNext': bool(running)}
+    finally:
+        # Without waiting for the tasks left if the client went away (and
+        # the generator was closed), nor starting those still queued
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def execute_incremental_async(
+        schema, document_ast, budget: float = DEFAULT_BUDGET,
+        root_value=None, variable_values=None,
+        operation_name=None) -> AsyncIterator[Payload]:
+    """Execute a query like `execute_incremental`, on the event loop.
+
+    Parts are requested with the asyncio client (requires `aiohttp`), and
+    streamed items are all resolved concurrently (as far as the transport
+    allows)."""
+    from chesscom import aio
+
+    query, rejected = _prepare(schema, document_ast, budget, root_value,
+                               variable_values, operation_name)
+    if query is None:
+        yield rejected
+        return
+    try:
+        for jobs in _rounds(schema, query.document, budget, operation_name,
+                            variable_values, streaming=True):
+            await aio.request_parts(jobs)
+    except _OverBudget as e:
+        yield _initial_payload(_rejected(e.args[0], budget), False)
+        return
+
+    executor = AsyncioExecutor(asyncio.get_running_loop())
+    result, collector = query.execute_initial(executor, return_promise=True)
+    result = await result
+    records = query.initial_records(collector)
+    yield _initial_payload(result, bool(records))
+
+    async def run(task):
+        promise, context, collector = query.start(task, executor)
+        return await promise, context.errors, collector.records
+
+    running = {asyncio.ensure_future(run(task)): task
+               for task in _tasks(records)}
+    try:
+        while running:
+            done, _ = await asyncio.wait(running,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            entries = []
+            for future in done:
+                task = running.pop(future)
+                entries_, released = _receive(task, *future.result())
+                entries.extend(entries_)
+                for task in _tasks(released):
+                    running[asyncio.ensure_future(run(task))] = task
+            if entries or not running:
+                yield {'incremental': entries, 'hasNext': bool(running)}
+    finally:
+        # The client went away
+        for future in running:
+            future.cancel()
@@ -0,0 +1,103 @@
+from functools import wraps
+from typing import Optional
+import contextvars
+import asyncio
+
+from promise import Promise
+from promise.dataloader import DataLoader
+
+from chesscom.entity import request_parts
+
+MAX_WORKERS = 8
+
+
+class PartLoader(DataLoader):
+    """Batches the entity parts needed while executing a query.
+
+    Resolvers at the same level of a query (eg., the names of all members of
+    a club) register the parts they need instead of requesting them one at
+    a time; the loader then dedupes them and requests the whole batch
+    concurrently before any of the resolvers continue.
+
+    Keys are (entity, part) pairs. A new loader is used for every query.
+    When executing on an event loop (see `cgqlbridge.asgi`), the batch is
+    requested through the asyncio client instead of a pool of threads.
+    """
+
+    def __init__(self, max_workers=MAX_WORKERS):
+        super().__init__()
+        self.max_workers = max_workers
+
+    def batch_load_fn(self, keys):
+        jobs = [(entity, part) for entity, part in keys
+                if not entity._has_data(part) and
+                not entity._has_error(part)]
+
+        def results(errors):
+            errors = dict(zip(jobs, errors))
+            return [errors.get(key) for key in keys]
+
+        if running_loop() is not None:
+            from chesscom import aio
+            return Promise.resolve(asyncio.ensure_future(
+                aio.request_parts(jobs))).then(results)
+        return Promise.resolve(results(request_parts(jobs, self.max_workers)))
+
+
+def running_loop() -> Optional[asyncio.AbstractEventLoop]:
+    """The event loop the query is executed on, if any."""
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+def off_loop(fn, *args) -> Promise:
+    """Call a blocking function, in a thread if executing on an event loop.
+
+    For resolvers that make calls not covered by the loader; returns a
+    promise of the result either way. The thread runs in a copy of the
+    context, so that the expiry of the data it uses is tracked for the
+    query (see `chesscom.rest.tracking_expiry`)."""
+    loop = running_loop()
+    if loop is None:
+        return Promise.resolve(fn(*args))
+    return Promise.resolve(loop.run_in_executor(
+        None, contextvars.copy_context().run, fn, *args))
+
+
+def part_loader(info):
+    """The loader for the query being executed, if any."""
+    context = info.context
+    if context is None:
+        return None
+    if isinstance(context, dict):
+        return context.setdefault('part_loader', PartLoader())
+    loader = getattr(context, 'part_loader', None)
+    if loader is None:
+        loader = PartLoader()
+        setattr(context, 'part_loader', loader)
+    return loader
+
+
+def loads(part):
+    """Decorate a resolver that reads the given part of its entity.
+
+    Unless the part has data already (or stale data that may be served while
+    it is refreshed, or was found missing), the resolver is deferred until
+    the part has been loaded as part of a batch.
+    """
+
+    def decorator(resolver):
+        @wraps(resolver)
+        def wrapper(entity, info, **kwargs):
+            loader = part_loader(info)
+            if loader is None or entity._is_known(part):
+                return resolver(entity, info, **kwargs)
+            return loader.load((entity, part)).then(
+                lambda _: resolver(entity, info, **kwargs))
+
+        wrapper.part = part
+        return wrapper
+
+    return decorator
@@ -0,0 +1,81 @@
+from base64 import b64encode, b64decode
+from typing import Any, Callable, Optional, Sequence
+
+import graphene
+from graphene import relay
+from graphql import GraphQLError
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+class CountedConnection(relay.Connection):
+    """A Relay connection that also has the total number of items."""
+
+    class Meta:
+        abstract = True
+
+    total_count = graphene.Int(required=True)
+
+
+def connection_field(connection, **kwargs):
+    """A field for a page of the given connection type."""
+    return graphene.Field(connection, required=True,
+                          first=graphene.Int(default_value=DEFAULT_PAGE_SIZE),
+                          after=graphene.String(), **kwargs)
+
+
+def _cursor(offset: int, key: str) -> str:
+    return b64encode(f"{offset}:{key}".encode()).decode()
+
+
+def _start(items: Sequence, key: Callable[[Any], str],
+           after: Optional[str]) -> int:
+    """The offset of the item following the cursor.
+
+    The cursor holds both the offset and the key of its item, so that it
+    keeps pointing at the same item should the list have been refreshed
+    (and the item moved) in between pages."""
+    if after is None:
+        return 0
+    try:
+        offset, _, after_key = b64decode(after).decode().partition(':')
+        offset = int(offset)
+    except ValueError:
+        raise GraphQLError(f"Invalid cursor: {after!r}") from None
+    if 0 <= offset < len(items) and key(items[offset]) == after_key:
+        return offset + 1
+    for offset, item in enumerate(items):
+        if key(item) == after_key:
+            return offset + 1
+    raise GraphQLError(f"Cursor no longer in list: {after!r}")
+
+
+def page_start(items: Sequence, first: int, after: Optional[str] = None,
+               key: Callable[[Any], str] = lambda entity: entity.key) -> int:
+    """The offset of the page requested by `first` and `after`."""
+    if not 0 <= first <= MAX_PAGE_SIZE:
+        raise GraphQLError(f"`first` must be between 0 and {MAX_PAGE_SIZE}")
+    return _start(items, key, after)
+
+
+def paginate(connection, items: Sequence, first: int,
+             after: Optional[str] = None,
+             key: Callable[[Any], str] = lambda entity: entity.key,
+             node: Callable[[Any], Any] = lambda item: item):
+    """Make the page of `items` requested by `first` and `after`.
+
+    Only the items on the page are turned into nodes (with `node`), so only
+    they get resolved further."""
+    start = page_start(items, first, after, key)
+    page = items[start:start + first]
+    edges = [connection.Edge(node=node(item),
+                             cursor=_cursor(start + i, key(item)))
+             for i, item in enumerate(page)]
+    page_info = relay.PageInfo(
+        has_previous_page=start > 0,
+        has_next_page=start + len(page) < len(items),
+        start_cursor=edges[0].cursor if edges else None,
+        end_cursor=edges[-1].cursor if edges else None)
+    return connection(edges=edges, page_info=page_info,
+                      total_count=len(items))
@@ -0,0 +1,135 @@
+from collections import OrderedDict
+from hashlib import sha256
+from typing import Optional
+import threading
+import json
+
+from flask import Response, request
+from flask_graphql import GraphQLView
+from graphql_server import HttpQueryError, get_graphql_params
+
+from .incremental import Encoding, accepted_encoding, uses_incremental
+
+
+class PersistedQueries(object):
+    """Keeps query documents by their SHA-256 hash (the last `max_size`)."""
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._queries = OrderedDict()
+
+    def get(self, query_hash: str) -> Optional[str]:
+        with self._lock:
+            query = self._queries.get(query_hash)
+            if query is not None:
+                self._queries.move_to_end(query_hash)
+            return query
+
+    def put(self, query_hash: str, query: str) -> None:
+        if sha256(query.encode()).hexdigest() != query_hash:
+            raise HttpQueryError(400, "provided sha does not match query")
+        with self._lock:
+            self._queries[query_hash] = query
+            while len(self._queries) > self.max_size:
+                self._queries.popitem(last=False)
+
+    def resolve(self, data):
+        """Fill in the query of a request sending its hash.
+
+        Requests sending the query along with its hash have it kept."""
+        if not isinstance(data, dict):
+            return data
+        extensions = data.get('extensions') or {}
+        if isinstance(extensions, str):
+            try:
+                extensions = json.loads(extensions)
+            except ValueError:
+                raise HttpQueryError(400, "Extensions are invalid JSON.")
+        persisted = extensions.get('persistedQuery')
+        if not persisted:
+            return data
+        if persisted.get('version') != 1:
+            raise HttpQueryError(400, "Unsupported persisted query version")
+        query_hash = persisted.get('sha256Hash')
+        if not isinstance(query_hash, str):
+            raise HttpQueryError(400, "Persisted query without sha256Hash")
+
+        if data.get('query'):
+            self.put(query_hash, data['query'])
+            return data
+        query = self.get(query_hash)
+        if query is None:
+            # Tells the client to send the query along with its hash
+            raise HttpQueryError(200, "PersistedQueryNotFound")
+        return dict(data, query=query)
+
+
+class PersistedQueryView(GraphQLView):
+    """A `GraphQLView` that also takes hashes of queries sent before.
+
+    Follows the automatic persisted queries protocol of Apollo: a request
+    may carry `{"persistedQuery": {"version": 1, "sha256Hash": ...}}` in its
+    `extensions` instead of the query. If the hash is unknown, the request
+    fails with `PersistedQueryNotFound`, and the client sends the query along
+    with its hash, which is then kept for later requests.
+
+    Queries using `@defer` or `@stream` are delivered incrementally to
+    clients accepting it (see `incremental`), if the backend can.
+    """
+    persisted_queries = None  # type: PersistedQueries
+
+    def parse_body(self):
+        data = super().parse_body()
+        if request.method.lower() == 'get' and 'extensions' in request.args:
+            data = dict(request.args.items())
+        if isinstance(data, list):
+            return [self.persisted_queries.resolve(entry) for entry in data]
+        return self.persisted_queries.resolve(data)
+
+    def dispatch_request(self):
+        encoding = accepted_encoding(request.headers.get('Accept', ''))
+        if encoding is not None and \
+                hasattr(self.get_backend(), 'execute_incremental'):
+            try:
+                response = self._incremental(encoding)
+            except HttpQueryError:
+                # Reported as usual
+                response = None
+            if response is not None:
+                return response
+        return super().dispatch_request()
+
+    def _incremental(self, encoding: Encoding) -> Optional[Response]:
+        """A response delivering the query incrementally, if it uses the
+        directives for it."""
+        if request.method.lower() not in ('get', 'post'):
+            return None
+        data = self.parse_body()
+        if isinstance(data, list):
+            return None
+        params = get_graphql_params(data, request.args)
+        if not params.query:
+            return None
+        backend = self.get_backend()
+        try:
+            document = backend.document_from_string(self.schema,
+                                                    params.query)
+        except Exception:
+            return None
+        if not uses_incremental(document.document_ast,
+                                params.operation_name):
+            return None
+
+        payloads = backend.execute_incremental(
+            self.schema, document.document_ast,
+            root_value=self.get_root_value(),
+            variable_values=params.variables,
+            operation_name=params.operation_name)
+
+        def body():
+            for payload in payloads:
+                yield encoding.part(payload)
+            yield encoding.end
+
+        return Response(body(), content_type=encoding.content_type)
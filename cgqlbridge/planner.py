@@ -0,0 +1,411 @@
+from functools import partial
+from typing import Any, Callable, Dict, Iterable, List, Optional, \
+    Tuple
+import asyncio
+
+from graphene import relay
+from graphql import GraphQLError
+from graphql.backend.core import GraphQLCoreBackend
+from graphql.backend.base import GraphQLDocument
+from graphql.execution import ExecutionResult, execute
+from graphql.execution.executors.asyncio import AsyncioExecutor
+from graphql.execution.values import get_argument_values, \
+    get_variable_values
+from graphql.language import ast
+from graphql.type.definition import GraphQLList, GraphQLNonNull, \
+    get_named_type
+from graphql.validation import validate
+
+from chesscom.cache import Requested
+from chesscom.entity import request_parts
+
+from .directives import initial_count
+from .loader import MAX_WORKERS
+from .pagination import page_start
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUDGET = 2000
+
+# Assumed length of lists (that are not paginated) not received yet
+DEFAULT_LIST_SIZE = 10
+
+# Prefetching stops after this many levels of the query
+MAX_ROUNDS = 10
+
+
+def looks_up(resolver):
+    """Mark a resolver as only looking up entities, without any requests.
+
+    The planner calls these to find the entities a query starts from."""
+    resolver.looks_up = True
+    return resolver
+
+
+def calls(n: int):
+    """Mark a resolver as making `n` upstream calls of its own."""
+
+    def decorator(resolver):
+        resolver.calls = n
+        return resolver
+
+    return decorator
+
+
+def pages(name: str, node: Callable[[str], Any]):
+    """Mark a connection resolver as paginating the keys kept in the given
+    property of its entity, only turning those of the page into nodes (with
+    `node`), so that the planner does the same."""
+
+    def decorator(resolver):
+        resolver.pages = (name, node)
+        return resolver
+
+    return decorator
+
+
+class Plan(object):
+    """The upstream calls needed to execute a query.
+
+    `calls` is the estimated number of calls, and `jobs` the (entity, part)
+    pairs known to be needed (for entities that are known already, ie.,
+    those looked up directly by the query, and those in lists that have
+    been received). With `streaming` set, only the first items of streamed
+    lists are planned for (see `incremental`).
+    """
+    calls: float
+    jobs: List[Tuple[Any, str]]
+
+    def __init__(self, schema, operation: ast.OperationDefinition,
+                 fragments: Dict[str, ast.FragmentDefinition],
+                 variables: Dict[str, Any], streaming: bool = False):
+        self.calls = 0
+        self.jobs = []
+        self._fragments = fragments
+        self._variables = variables
+        self._streaming = streaming
+        self._selection(schema.get_query_type(), [None], 1,
+                        operation.selection_set)
+
+    def _fields(self, selection_set) -> Iterable[ast.Field]:
+        """The fields selected, including those of fragments."""
+        for selection in selection_set.selections:
+            if isinstance(selection, ast.Field):
+                yield selection
+            elif isinstance(selection, ast.InlineFragment):
+                yield from self._fields(selection.selection_set)
+            elif isinstance(selection, ast.FragmentSpread):
+                fragment = self._fragments[selection.name.value]
+                yield from self._fields(fragment.selection_set)
+
+    def _selection(self, object_type, entities: Optional[list],
+                   count: float, selection_set) -> None:
+        """Plan the selection of fields of `count` objects.
+
+        `entities` are the objects themselves if known, otherwise None."""
+        parts = set()
+        children = []
+        for field in self._fields(selection_set):
+            name = field.name.value
+            if name.startswith('__'):
+                continue
+            definition = object_type.fields[name]
+            resolver = definition.resolver
+            part = getattr(resolver, 'part', None)
+            if part is not None:
+                parts.add(part)
+            self.calls += getattr(resolver, 'calls', 0) * count
+            if field.selection_set is not None:
+                args = get_argument_values(definition.args, field.arguments,
+                                           self._variables)
+                children.append((field, definition, args))
+
+        for part in parts:
+            if entities is None:
+                self.calls += count
+                continue
+            for entity in entities:
+                if not entity._is_known(part):
+                    self.calls += 1
+                    self.jobs.append((entity, part))
+
+        for field, definition, args in children:
+            self._child(field, definition, entities, count, args)
+
+    def _initial_count(self, field) -> Optional[int]:
+        if not self._streaming:
+            return None
+        return initial_count(field, self._variables)
+
+    def _child(self, field, definition, entities: Optional[list],
+               count: float, args: dict) -> None:
+        """Plan the selection of an object (or list) valued field."""
+        selection_set = field.selection_set
+        field_type = definition.type
+        if isinstance(field_type, GraphQLNonNull):
+            field_type = field_type.of_type
+        named_type = get_named_type(field_type)
+        graphene_type = getattr(named_type, 'graphene_type', None)
+        is_connection = graphene_type is not None and \
+            issubclass(graphene_type, relay.Connection)
+        first = args.get('first')
+        # Only the first items of a streamed list are needed at first
+        if is_connection:
+            counts = [self._initial_count(edges)
+                      for edges in self._fields(selection_set)
+                      if edges.name.value == 'edges']
+            limit = None if not counts or None in counts else min(counts)
+        else:
+            limit = self._initial_count(field)
+
+        values = self._values(definition.resolver, entities, args,
+                              is_connection, limit)
+        if values is not None:
+            children = [value for value in dict.fromkeys(values)
+                        if value is not None]
+            child_count = len(children)
+        elif is_connection:
+            children, child_count = None, count * first
+        elif isinstance(field_type, GraphQLList):
+            children, child_count = None, count * DEFAULT_LIST_SIZE
+        else:
+            children, child_count = None, count
+        if values is None and limit is not None:
+            child_count = min(child_count, count * limit)
+
+        if is_connection:
+            node_type = named_type.fields['edges'].type
+            node_type = get_named_type(node_type).fields['node'].type
+            for edges in self._fields(selection_set):
+                if edges.name.value != 'edges':
+                    continue
+                for node in self._fields(edges.selection_set):
+                    if node.name.value == 'node':
+                        self._selection(get_named_type(node_type), children,
+                                        child_count, node.selection_set)
+        else:
+            self._selection(named_type, children, child_count,
+                            selection_set)
+
+    def _values(self, resolver, entities: Optional[list], args: dict,
+                is_connection: bool,
+                limit: Optional[int] = None) -> Optional[list]:
+        """The values of a field, if they are known without requests.
+
+        Only the first `limit` items of each list, if given."""
+        if entities is None:
+            return None
+
+        if getattr(resolver, 'looks_up', False):
+            try:
+                return [resolver(entity, None, **args)
+                        for entity in entities]
+            except Exception:
+                return None
+
+        part = getattr(resolver, 'part', None)
+        if part is None or \
+                not all(entity._can_serve(part) for entity in entities):
+            return None
+        name, node = getattr(resolver, 'pages', None) or \
+            (resolver.__name__[len('resolve_'):], None)
+        values = []
+        for entity in entities:
+            requested = getattr(entity, name, None)
+            if not isinstance(requested, Requested):
+                return None
+            value = requested.data
+            if is_connection:
+                try:
+                    if node is None:
+                        start = page_start(value, args['first'],
+                                           args.get('after'))
+                    else:
+                        start = page_start(value, args['first'],
+                                           args.get('after'), key=str)
+                except GraphQLError:
+                    start = 0
+                end = start + args['first']
+                if limit is not None:
+                    end = min(end, start + limit)
+                page = value[start:end]
+                values.extend(page if node is None else map(node, page))
+            elif isinstance(value, list):
+                values.extend(value if limit is None else value[:limit])
+            else:
+                values.append(value)
+        return values
+
+
+def _operation(document_ast, operation_name):
+    fragments = {}
+    operation = None
+    for definition in document_ast.definitions:
+        if isinstance(definition, ast.FragmentDefinition):
+            fragments[definition.name.value] = definition
+        elif isinstance(definition, ast.OperationDefinition):
+            if operation_name is None or (
+                    definition.name and
+                    definition.name.value == operation_name):
+                operation = definition
+    return operation, fragments
+
+
+def plan_query(schema, document_ast, operation_name=None,
+               variable_values=None, streaming: bool = False) \
+        -> Optional[Plan]:
+    """Plan the upstream calls of a (valid) query.
+
+    Returns None if the operation is not a query, or if its variables are
+    invalid (to be reported when executing it)."""
+    operation, fragments = _operation(document_ast, operation_name)
+    if operation is None or operation.operation != 'query':
+        return None
+    try:
+        variables = get_variable_values(
+            schema, operation.variable_definitions or [], variable_values)
+    except GraphQLError:
+        return None
+    return Plan(schema, operation, fragments, variables, streaming)
+
+
+class _OverBudget(Exception):
+    pass
+
+
+def _rounds(schema, document_ast, budget, operation_name, variable_values,
+            streaming: bool = False):
+    """Yield the jobs to request before planning the next round.
+
+    Raises `_OverBudget` (with the estimate) if the query would make more
+    than `budget` calls."""
+    made = 0
+    tried = set()
+    for _ in range(MAX_ROUNDS):
+        plan = plan_query(schema, document_ast, operation_name,
+                          variable_values, streaming)
+        if plan is None:
+            return
+        estimate = made + plan.calls
+        if estimate > budget:
+            logger.info("Rejected query estimated at %d calls", estimate)
+            raise _OverBudget(estimate)
+        jobs = [job for job in dict.fromkeys(plan.jobs) if job not in tried]
+        if not jobs:
+            return
+        tried.update(jobs)
+        made += len(jobs)
+        yield jobs
+
+
+def _rejected(estimate: float, budget: float) -> ExecutionResult:
+    return ExecutionResult(errors=[GraphQLError(
+        f"Query would make about {estimate:.0f} calls to the Chess.com API, "
+        f"more than the budget of {budget:.0f}; ask for fewer items (eg., "
+        f"with `first`) or fewer nested fields")], invalid=True)
+
+
+def execute_planned(schema, document_ast, budget: float = DEFAULT_BUDGET,
+                    max_workers: int = MAX_WORKERS, *args, **kwargs):
+    """Execute a (valid) query, unless it would make too many upstream calls.
+
+    The parts of the entities the query needs are prefetched concurrently
+    first, one level of the query at a time (as the lists of a level are
+    needed to know the entities of the next), and the estimate is updated
+    as lists are received. Rejects the query with an error as soon as the
+    estimated total exceeds `budget`.
+    """
+    try:
+        for jobs in _rounds(schema, document_ast, budget,
+                            kwargs.get('operation_name'),
+                            kwargs.get('variable_values')):
+            request_parts(jobs, max_workers)
+    except _OverBudget as e:
+        return _rejected(e.args[0], budget)
+
+    return execute(schema, document_ast, *args, **kwargs)
+
+
+async def execute_planned_async(schema, document_ast,
+                                budget: float = DEFAULT_BUDGET,
+                                *args, **kwargs):
+    """Execute a (valid) query like `execute_planned`, on the event loop.
+
+    Parts are prefetched with the asyncio client, and the query is executed
+    with an `AsyncioExecutor`, so that no thread waits on the API (requires
+    `aiohttp`)."""
+    from chesscom import aio
+
+    try:
+        for jobs in _rounds(schema, document_ast, budget,
+                            kwargs.get('operation_name'),
+                            kwargs.get('variable_values')):
+            await aio.request_parts(jobs)
+    except _OverBudget as e:
+        return _rejected(e.args[0], budget)
+
+    return await execute(schema, document_ast, *args,
+                         executor=AsyncioExecutor(asyncio.get_running_loop()),
+                         return_promise=True, **kwargs)
+
+
+def _invalid(errors, *args, **kwargs):
+    return ExecutionResult(errors=errors, invalid=True)
+
+
+class PlanningBackend(GraphQLCoreBackend):
+    """Executes queries with `execute_planned`.
+
+    Documents are validated when made, so that a document that is kept (see
+    `CachingBackend`) is only validated once. Use as the backend of a
+    `GraphQLView`."""
+
+    def __init__(self, budget: float = DEFAULT_BUDGET,
+                 max_workers: int = MAX_WORKERS, executor=None):
+        super().__init__(executor)
+        self.budget = budget
+        self.max_workers = max_workers
+
+    def document_from_string(self, schema, document_string):
+        document = super().document_from_string(schema, document_string)
+        errors = validate(schema, document.document_ast)
+        if errors:
+            execute = partial(_invalid, errors)
+        else:
+            execute = self._planned(schema, document.document_ast)
+        return GraphQLDocument(
+            schema=schema,
+            document_string=document.document_string,
+            document_ast=document.document_ast,
+            execute=execute)
+
+    def _planned(self, schema, document_ast):
+        return partial(execute_planned, schema, document_ast, self.budget,
+                       self.max_workers, **self.execute_params)
+
+    def execute_incremental(self, schema, document_ast, **kwargs):
+        """Execute a query with `@defer` or `@stream`, giving an iterator
+        of its payloads (see `incremental`)."""
+        from .incremental import execute_incremental
+        return execute_incremental(schema, document_ast, self.budget,
+                                   self.max_workers, **kwargs)
+
+
+class AsyncPlanningBackend(PlanningBackend):
+    """Executes queries with `execute_planned_async`.
+
+    Executing a document returns an awaitable of the result, to be awaited
+    on the event loop (as `cgqlbridge.asgi` does)."""
+
+    def _planned(self, schema, document_ast):
+        return partial(execute_planned_async, schema, document_ast,
+                       self.budget)
+
+    def execute_incremental(self, schema, document_ast, **kwargs):
+        """Execute a query with `@defer` or `@stream`, giving an async
+        iterator of its payloads."""
+        from .incremental import execute_incremental_async
+        return execute_incremental_async(schema, document_ast, self.budget,
+                                         **kwargs)
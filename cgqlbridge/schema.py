@@ -1,106 +1,164 @@
 import graphene
 import chesscom
 
+from .directives import DIRECTIVES
+from .loader import loads, off_loop
+from .pagination import CountedConnection, connection_field, paginate
+from .planner import looks_up, calls, pages
+
 Title = graphene.Enum.from_enum(chesscom.Title)
 Status = graphene.Enum.from_enum(chesscom.Status)
 
 
+def found(entity):
+    """The entity, or None if it was found missing (eg. a closed account).
+
+    Only known once its profile has been requested (as the planner does
+    before executing a query), so this never calls the API itself."""
+    return None if entity._has_error('profile') else entity
+
+
+def existing(entities):
+    """The entities not found missing, eg. leaving out renamed admins."""
+    return [entity for entity in entities if found(entity) is not None]
+
+
 class Player(graphene.ObjectType):
     url = graphene.String(required=True)
 
+    @loads('profile')
     def resolve_url(self, info):
         return self.url()
 
     username = graphene.String(required=True)
 
+    @loads('profile')
     def resolve_username(self, info):
         return self.original_username()
 
     player_id = graphene.Int(required=True)
 
+    @loads('profile')
     def resolve_player_id(self, info):
         return self.player_id()
 
     title = graphene.Field(Title)
 
+    @loads('profile')
     def resolve_title(self, info):
         return self.title()
 
     status = graphene.Field(Status, required=True)
 
+    @loads('profile')
     def resolve_status(self, info):
         return self.status()
 
     name = graphene.String()
 
+    @loads('profile')
     def resolve_name(self, info):
         return self.name()
 
     avatar = graphene.String()
 
+    @loads('profile')
     def resolve_avatar(self, info):
         return self.avatar()
 
     location = graphene.String()
 
+    @loads('profile')
     def resolve_location(self, info):
         return self.location()
 
     country = graphene.Field(lambda: Country, required=True)
 
+    @loads('profile')
     def resolve_country(self, info):
         return self.country()
 
     joined = graphene.DateTime(required=True)
 
+    @loads('profile')
     def resolve_joined(self, info):
         return self.joined()
 
     last_online = graphene.DateTime(required=True)
 
+    @loads('profile')
     def resolve_last_online(self, info):
         return self.last_online()
 
     followers = graphene.Int(required=True)
 
+    @loads('profile')
     def resolve_followers(self, info):
         return self.followers()
 
     is_streamer = graphene.Boolean(required=True)
 
+    @loads('profile')
     def resolve_is_streamer(self, info):
         return self.is_streamer()
 
     twitch_url = graphene.String()
 
+    @loads('profile')
     def resolve_twitch_url(self, info):
         return self.twitch_url()
 
     clubs = graphene.List(graphene.NonNull(lambda: Club), required=True)
 
+    @loads('clubs')
     def resolve_clubs(self, info):
-        return self.clubs()
+        return existing(self.clubs())
 
     joined_club = graphene.DateTime(key=graphene.String())
 
+    @loads('clubs')
     def resolve_joined_club(self, info, key):
         return self.joined_club(key)
 
     last_active_in_club = graphene.DateTime(key=graphene.String())
 
+    @loads('clubs')
     def resolve_last_active_in_club(self, info, key):
         return self.last_active_in_club(key)
 
     rating = graphene.Int(category=graphene.String())
 
+    @loads('stats')
     def resolve_rating(self, info, category):
         return self.rating(category)
 
     is_online = graphene.Boolean(required=True)
 
+    @loads('online')
     def resolve_is_online(self, info):
         return self.is_online()
 
+    archives = graphene.List(graphene.NonNull(lambda: Month), required=True)
+
+    @loads('archives')
+    def resolve_archives(self, info):
+        return self.archives()
+
+    games = connection_field(lambda: GameConnection,
+                             year=graphene.Int(required=True),
+                             month=graphene.Int(required=True))
+
+    @calls(1)
+    def resolve_games(self, info, year, month, first, after=None):
+        return off_loop(self.games, year, month).then(
+            lambda games: paginate(GameConnection, games, first, after,
+                                   key=lambda game: game.url))
+
+
+class PlayerConnection(CountedConnection):
+    class Meta:
+        node = Player
+
 
 class Club(graphene.ObjectType):
     key = graphene.String(required=True)
@@ -110,97 +168,164 @@ class Club(graphene.ObjectType):
 
     name = graphene.String(required=True)
 
+    @loads('profile')
     def resolve_name(self, info):
         return self.name()
 
     club_id = graphene.Int(required=True)
 
+    @loads('profile')
     def resolve_club_id(self, info):
         return self.club_id()
 
     icon = graphene.String()
 
+    @loads('profile')
     def resolve_icon(self, info):
         return self.icon()
 
     country = graphene.Field(lambda: Country, required=True)
 
+    @loads('profile')
     def resolve_country(self, info):
         return self.country()
 
     created = graphene.DateTime(required=True)
 
+    @loads('profile')
     def resolve_created(self, info):
         return self.created()
 
     last_activity = graphene.DateTime(required=True)
 
+    @loads('profile')
     def resolve_last_activity(self, info):
         return self.last_activity()
 
     join_request = graphene.String(required=True)
 
+    @loads('profile')
     def resolve_join_request(self, info):
         return self.join_request()
 
     admin = graphene.List(graphene.NonNull(Player), required=True)
 
+    @loads('profile')
     def resolve_admin(self, info):
-        return self.admin()
+        return existing(self.admin())
 
     description = graphene.String()
 
+    @loads('profile')
     def resolve_description(self, info):
         return self.description()
 
-    members = graphene.List(graphene.NonNull(Player), required=True)
+    members = connection_field(PlayerConnection)
+
+    @pages('member_keys', chesscom.lookup_player)
+    @loads('members')
+    def resolve_members(self, info, first, after=None):
+        return paginate(PlayerConnection, self.member_keys(), first, after,
+                        key=str, node=chesscom.lookup_player)
+
 
-    def resolve_members(self, info):
-        return self.members()
+class ClubConnection(CountedConnection):
+    class Meta:
+        node = Club
 
 
 class Country(graphene.ObjectType):
     name = graphene.String(required=True)
 
+    @loads('profile')
     def resolve_name(self, info):
         return self.name()
 
     code = graphene.String(required=True)
 
+    @loads('profile')
     def resolve_code(self, info):
         return self.code()
 
-    players = graphene.List(graphene.NonNull(Player), required=True)
+    players = connection_field(PlayerConnection)
 
-    def resolve_players(self, info):
-        return self.players()
+    @pages('player_keys', chesscom.lookup_player)
+    @loads('players')
+    def resolve_players(self, info, first, after=None):
+        return paginate(PlayerConnection, self.player_keys(), first, after,
+                        key=str, node=chesscom.lookup_player)
 
-    clubs = graphene.List(graphene.NonNull(lambda: Club), required=True)
+    clubs = connection_field(ClubConnection)
 
-    def resolve_clubs(self, info):
-        return self.clubs()
+    @loads('clubs')
+    def resolve_clubs(self, info, first, after=None):
+        return paginate(ClubConnection, self.clubs(), first, after)
+
+
+class Month(graphene.ObjectType):
+    year = graphene.Int(required=True)
+
+    def resolve_year(self, info):
+        return self[0]
+
+    month = graphene.Int(required=True)
+
+    def resolve_month(self, info):
+        return self[1]
+
+
+class GamePlayer(graphene.ObjectType):
+    player = graphene.Field(Player, required=True)
+    rating = graphene.Int(required=True)
+    result = graphene.String(required=True)
+
+
+class Game(graphene.ObjectType):
+    url = graphene.String(required=True)
+    pgn = graphene.String()
+    time_control = graphene.String(required=True)
+    end_time = graphene.DateTime(required=True)
+    rated = graphene.Boolean(required=True)
+    fen = graphene.String()
+    time_class = graphene.String(required=True)
+    rules = graphene.String(required=True)
+    white = graphene.Field(GamePlayer, required=True)
+    black = graphene.Field(GamePlayer, required=True)
+
+
+class GameConnection(CountedConnection):
+    class Meta:
+        node = Game
 
 
 class Query(graphene.ObjectType):
     player = graphene.Field(Player, username=graphene.String())
 
+    @looks_up
     def resolve_player(self, info, username):
-        return chesscom.lookup_player(username)
+        return found(chesscom.lookup_player(username))
 
-    titled_players = graphene.List(graphene.NonNull(Player), title=Title())
+    titled_players = connection_field(PlayerConnection, title=Title())
 
-    def resolve_titled_players(self, info, title):
-        return chesscom.titled_players(chesscom.Title(title))
+    @calls(1)
+    def resolve_titled_players(self, info, title, first, after=None):
+        return off_loop(chesscom.titled_players, chesscom.Title(title),
+                        True).then(
+            lambda usernames: paginate(PlayerConnection, usernames, first,
+                                       after, key=str,
+                                       node=chesscom.lookup_player))
 
     club = graphene.Field(Club, key=graphene.String())
 
+    @looks_up
     def resolve_club(self, info, key):
-        return chesscom.lookup_club(key)
+        return found(chesscom.lookup_club(key))
 
     country = graphene.Field(Country, code=graphene.String())
 
+    @looks_up
     def resolve_country(self, info, code):
-        return chesscom.lookup_country(code)
+        return found(chesscom.lookup_country(code))
 
 
-schema = graphene.Schema(query=Query)
+schema = graphene.Schema(query=Query, directives=DIRECTIVES)
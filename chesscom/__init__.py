@@ -1,3 +1,8 @@
 from .player import lookup_player, Title, Status, titled_players
 from .country import lookup_country
 from .club import lookup_club
+from .rest import APIError, NotFound, Gone, RateLimited, UpstreamError, \
+    Transport, set_transport, set_response_cache
+from .diskcache import DiskCache
+from .entity import prefetch, override_ttl, set_negative_ttl
+from .game import Game, GameSync
@@ -0,0 +1,363 @@
+"""Asyncio client for the Chess.com Public API (requires `aiohttp`).
+
+The entities here are awaitable counterparts of `Player`, `Club` and
+`Country`: every property is a coroutine function instead of a blocking
+call, eg.
+
+    club = chesscom.aio.lookup_club('chess-com-developer-community')
+    members = await club.members()
+    names = await asyncio.gather(*(member.name() for member in members))
+
+Each one wraps the blocking entity with the same key, so they share both the
+`@cached` identity and the received values: whatever is fetched through one
+client is available to the other, and a part being requested by one is
+not requested again by the other meanwhile. Requests made through the
+asyncio client are capped at `AsyncTransport.concurrency` in flight at a
+time.
+"""
+from typing import Optional, Iterable, List, Dict, Tuple, Union
+from functools import partial
+from datetime import datetime
+import asyncio
+import logging
+import time
+
+import aiohttp
+
+from . import player, club, country
+from .rest import BASE_URL, APIError, Retrying, prepare_request, \
+    complete_request, get_response_cache, api_error, LOCK_TIMEOUT, \
+    LOCK_POLL, Scheduler, _count_response, get_scheduler, record_response, \
+    replayed_response, UpstreamError, max_age, used_until, DEFAULT_TTL
+from .cache import cached, note_read
+from .entity import Entity, _flights
+from .metrics import endpoint_family, UPSTREAM_REQUESTS, UPSTREAM_RETRIES
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncTransport(Retrying):
+    """Performs GET requests against the API from an event loop.
+
+    Shares the retry policy of the blocking `Transport`, and is paced by the
+    same `Scheduler` (the given one, or the shared one): requests wait for
+    a slot of it (in order of priority), and a 429 pauses the requests of
+    both clients. The underlying session is created on first use, so the
+    transport must be used from a single event loop, and should be closed
+    with `close()` when done.
+    """
+
+    def __init__(self, base_url=BASE_URL, concurrency=16, timeout=30.0,
+                 scheduler: Optional[Scheduler] = None, **retrying):
+        super().__init__(**retrying)
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.scheduler = scheduler
+        self._session = None  # type: Optional[aiohttp.ClientSession]
+        self._semaphore = None  # type: Optional[asyncio.Semaphore]
+
+    def _ensure_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.concurrency)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={'Accept-Encoding': 'gzip, deflate'})
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._session
+
+    async def get(self, endpoint: str,
+                  headers=None) -> aiohttp.ClientResponse:
+        """Get the endpoint (with its body read), retrying if needed."""
+        session = self._ensure_session()
+        scheduler = self.scheduler or get_scheduler()
+        family = endpoint_family(endpoint)
+        attempt = 0
+        while True:
+            try:
+                async with self._semaphore, scheduler.async_slot():
+                    start = time.perf_counter()
+                    async with session.get(self.base_url + endpoint,
+                                           headers=headers) as r:
+                        body = await r.read()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                UPSTREAM_REQUESTS.inc(family, 'error')
+                if attempt >= self.retries:
+                    raise
+                delay = self._backoff(attempt)
+                logger.info("Retrying %s in %.2fs after %r", endpoint, delay,
+                            e)
+            else:
+                _count_response(family, r.status, r.headers,
+                                time.perf_counter() - start, body)
+                delay = self._retry_after(r.headers)
+                if delay is None:
+                    delay = self._backoff(attempt)
+                if r.status == 429:
+                    # Pauses all requests, including the retry below
+                    scheduler.throttle(delay)
+                    delay = 0
+                else:
+                    scheduler.succeeded()
+                if r.status not in self.RETRY_STATUS or \
+                        attempt >= self.retries:
+                    return r
+                logger.info("Retrying %s in %.2fs after status %d", endpoint,
+                            delay, r.status)
+            UPSTREAM_RETRIES.inc(family)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+_transport = None  # type: Optional[AsyncTransport]
+
+
+def get_transport() -> AsyncTransport:
+    """Return the transport used by `request_json`, creating it if needed."""
+    global _transport
+    if _transport is None:
+        _transport = AsyncTransport()
+    return _transport
+
+
+def set_transport(transport: Optional[AsyncTransport]) -> None:
+    """Replace the transport used by `request_json` (None to reset)."""
+    global _transport
+    _transport = transport
+
+
+async def request_json(endpoint: str) -> dict:
+    """Call the given endpoint and return the response as a dict.
+
+    Raises `APIError` if no successful response could be had."""
+    replayed = replayed_response(endpoint)
+    if replayed is not None:
+        return replayed.data
+    logger.debug("Getting endpoint: %s", endpoint)
+    r = await get_transport().get(endpoint)
+    if r.status != 200:
+        record_response(endpoint, r.status, None)
+        raise api_error(endpoint, r.status)
+    d = await r.json(content_type=None)
+    assert type(d) is dict
+    record_response(endpoint, 200, d)
+    ttl = max_age(r.headers)
+    used_until(time.time() + (DEFAULT_TTL if ttl is None else ttl))
+    return d
+
+
+class AsyncEntity(object):
+    """Awaitable counterpart of a blocking entity with the same key.
+
+    Properties of the wrapped entity are available as coroutine functions
+    of the same name. Concurrent requests for the same endpoint are
+    coalesced into a single call.
+    """
+    _entity_class = None
+
+    def __init__(self, key):
+        self.key = key
+        self.entity = self._entity_class(key)
+        self._pending = {}  # type: Dict[str, asyncio.Future]
+
+    def __getattr__(self, name):
+        try:
+            self._entity_class._part_of(name)
+        except KeyError:
+            raise AttributeError(name) from None
+        return partial(self._get, name)
+
+    async def _get(self, name):
+        requested = getattr(self.entity, name)
+        part = self._entity_class._part_of(name)
+        if requested.has_data():
+            note_read(self.entity, part, 'hit')
+            return _counterpart(requested.data)
+        if requested.has_error():
+            note_read(self.entity, part, 'negative')
+            raise self.entity._record(part).error
+        if requested.is_stale():
+            # Serve it while refreshing in the background
+            asyncio.ensure_future(self._fetch(part))
+            note_read(self.entity, part, 'stale')
+            return _counterpart(requested.data)
+        outcome = 'miss' if requested.data is None else 'expired'
+        before = self.entity._record(part).received
+        await self._fetch(part)
+        # Like `Requested.__call__` (which would block the loop), without
+        # checking freshness again: a response with a max-age of 0 is
+        # expired as soon as received
+        record = self.entity._record(part)
+        if record.data is None or record.error is not None or \
+                record.received == before:
+            raise UpstreamError(self.entity._endpoint(part))
+        note_read(self.entity, part, outcome)
+        return _counterpart(requested.data)
+
+    async def _fetch(self, part: str) -> None:
+        pending = self._pending.get(part)
+        if pending is None:
+            pending = asyncio.ensure_future(self._request(part))
+            self._pending[part] = pending
+            pending.add_done_callback(
+                lambda _: self._pending.pop(part, None))
+        # Shielded so that one cancelled caller does not cancel the others
+        await asyncio.shield(pending)
+
+    async def _request(self, part: str) -> None:
+        # Shares a request for the same part made by either client
+        await _flights.run_async((self.entity, part),
+                                 partial(self._request_part, part))
+
+    async def _request_part(self, part: str) -> None:
+        entity = self.entity
+        endpoint = entity._endpoint(part)
+        validators = entity._validators(part)
+        try:
+            fetched, stale, headers = prepare_request(endpoint, validators)
+        except APIError as e:
+            # Recorded in the snapshot being replayed
+            entity._receive_error(part, e)
+            raise
+        if fetched is None:
+            cache, token, waited = await _lock(endpoint)
+            try:
+                if waited:
+                    fetched, stale, headers = prepare_request(endpoint,
+                                                              validators)
+                if fetched is None:
+                    logger.debug("Getting endpoint: %s", endpoint)
+                    r = await get_transport().get(endpoint, headers)
+                    d = await r.json(content_type=None) \
+                        if r.status == 200 else None
+                    fetched = complete_request(endpoint, r.status, r.headers,
+                                               d, entity._ttls.get(part),
+                                               stale)
+            except APIError as e:
+                entity._receive_error(part, e)
+                raise
+            finally:
+                if token is not None:
+                    cache.release(endpoint, token)
+        entity._receive_fetched(part, fetched)
+
+
+async def _lock(endpoint: str):
+    """Lock an endpoint in a shared response cache, like `rest.fetching`.
+
+    Returns the cache, the token to release the lock with (None if there is
+    no lock) and whether another process held it."""
+    cache = get_response_cache()
+    acquire = getattr(cache, 'acquire', None)
+    if acquire is None:
+        return cache, None, False
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    token = acquire(endpoint, LOCK_TIMEOUT)
+    waited = token is None
+    while token is None and time.monotonic() < deadline:
+        await asyncio.sleep(LOCK_POLL)
+        token = acquire(endpoint, LOCK_TIMEOUT)
+    return cache, token, waited
+
+
+@cached
+class Player(AsyncEntity):
+    _entity_class = player.Player
+
+    async def joined_club(self, key: str) -> Optional[datetime]:
+        """Timestamp of joining club."""
+        activity = (await self._get('_activity')).get(key)
+        if activity:
+            return activity.joined
+        else:
+            return None
+
+    async def last_active_in_club(self, key: str) -> Optional[datetime]:
+        """Timestamp for last activity in club."""
+        activity = (await self._get('_activity')).get(key)
+        if activity:
+            return activity.last_activity
+        else:
+            return None
+
+    async def rating(self, category: str) -> Optional[int]:
+        stats = await self._get('_stats')
+        if category not in stats:
+            return None
+
+        return stats[category].rating
+
+
+@cached
+class Club(AsyncEntity):
+    _entity_class = club.Club
+
+    async def members(self) -> List[Player]:
+        """Members of the club"""
+        return list(map(Player, await self._get('member_keys')))
+
+
+@cached
+class Country(AsyncEntity):
+    _entity_class = country.Country
+
+    async def players(self) -> List[Player]:
+        """List of active players in this country."""
+        return list(map(Player, await self._get('player_keys')))
+
+
+_counterparts = {cls._entity_class: cls for cls in [Player, Club, Country]}
+
+
+def _counterpart(value):
+    """Replace blocking entities in a received value by their counterparts."""
+    if type(value) in _counterparts:
+        return _counterparts[type(value)](value.key)
+    if isinstance(value, list):
+        return list(map(_counterpart, value))
+    if isinstance(value, dict):
+        return {k: _counterpart(v) for k, v in value.items()}
+    return value
+
+
+async def request_parts(
+        jobs: Iterable[Tuple[Entity, str]]) -> List[Optional[Exception]]:
+    """Request the given (blocking entity, part) pairs concurrently.
+
+    The asyncio counterpart of `chesscom.entity.request_parts`. Returns, for
+    each pair, the exception raised when requesting it, or None if it
+    succeeded."""
+    async def run(entity, part):
+        try:
+            await _counterparts[type(entity)](entity.key)._fetch(part)
+        except Exception as e:
+            logger.info("Failed to request %s: %r", entity._endpoint(part), e)
+            return e
+        return None
+
+    return await asyncio.gather(*(run(entity, part)
+                                  for entity, part in jobs))
+
+
+async def titled_players(title: player.Title,
+                         keys: bool = False) -> List[Union[Player, str]]:
+    d = await request_json(f"titled/{title.value}")
+    return d['players'] if keys else list(map(Player, d['players']))
+
+
+def lookup_player(key: str) -> Player:
+    return Player(key)
+
+
+def lookup_club(key: str) -> Club:
+    return Club(key)
+
+
+def lookup_country(key: str) -> Country:
+    return Country(key)
@@ -1,5 +1,232 @@
-from typing import TypeVar, Generic, Callable, Optional
+from typing import TypeVar, Generic, Callable, Optional, Dict, Any, Tuple, \
+    Awaitable, List
 from datetime import datetime, timedelta
+from collections import OrderedDict
+from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import itertools
+import asyncio
+import threading
+import weakref
+import time
+import sys
+
+from .rest import priority, used_until, UpstreamError, BACKGROUND, \
+    _wake
+from .metrics import Gauge, REQUESTED
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class InstanceCache(object):
+    """Identity cache keeping the unique instances of a `@cached` class.
+
+    Unbounded by default. When bounded, the least recently used instances
+    are evicted once there are more than `max_size` of them, or once they
+    have not been looked up for `max_age` seconds. With `weak` set, evicted
+    instances are still found for as long as they are referenced elsewhere,
+    so that an entity never loses its identity while in use.
+
+    Safe to use from several threads; `lock` is held by `@cached` while
+    looking up or creating an instance, so that only one is ever created per
+    key.
+    """
+
+    def __init__(self, max_size: Optional[int] = None,
+                 max_age: Optional[float] = None, weak: bool = False):
+        self.lock = threading.RLock()
+        self.max_size = max_size
+        self.max_age = max_age
+        self.weak = weak
+        # Least recently used first, with the time of last lookup
+        self._instances = OrderedDict()  # type: OrderedDict
+        self._evicted = weakref.WeakValueDictionary()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def configure(self, max_size: Optional[int] = None,
+                  max_age: Optional[float] = None,
+                  weak: bool = False) -> None:
+        """Change the bounds, evicting instances as needed."""
+        with self.lock:
+            self.max_size = max_size
+            self.max_age = max_age
+            self.weak = weak
+            if not weak:
+                self._evicted.clear()
+            self._evict()
+
+    def get(self, key):
+        """Return the instance with the given key, or None."""
+        with self.lock:
+            return self._get(key)
+
+    def _get(self, key):
+        now = time.monotonic()
+        entry = self._instances.get(key)
+        if entry is not None and not self._is_expired(entry, now):
+            self._instances.move_to_end(key)
+            self._instances[key] = (entry[0], now)
+            self.hits += 1
+            return entry[0]
+
+        if entry is not None:
+            # Expired
+            del self._instances[key]
+            self.evictions += 1
+            instance = entry[0]
+        else:
+            instance = self._evicted.get(key)
+        if instance is not None and self.weak:
+            # Still in use somewhere: bring it back
+            self._put(key, instance)
+            self.hits += 1
+            return instance
+
+        self.misses += 1
+        return None
+
+    def put(self, key, instance) -> None:
+        """Keep an instance under the given key."""
+        with self.lock:
+            self._put(key, instance)
+
+    def _put(self, key, instance) -> None:
+        self._evicted.pop(key, None)
+        self._instances[key] = (instance, time.monotonic())
+        self._instances.move_to_end(key)
+        self._evict()
+
+    def _is_expired(self, entry, now) -> bool:
+        return self.max_age is not None and now - entry[1] > self.max_age
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        while self._instances:
+            key, entry = next(iter(self._instances.items()))
+            if not (self.max_size is not None and
+                    len(self._instances) > self.max_size) and \
+                    not self._is_expired(entry, now):
+                break
+            del self._instances[key]
+            if self.weak:
+                self._evicted[key] = entry[0]
+            self.evictions += 1
+
+    def clear(self) -> None:
+        with self.lock:
+            self._instances.clear()
+            self._evicted.clear()
+
+    def __len__(self) -> int:
+        return len(self._instances)
+
+    def __contains__(self, key) -> bool:
+        return key in self._instances
+
+    def memory_estimate(self, sample_size: int = 100) -> int:
+        """Estimate the bytes used by the instances (from a sample)."""
+        with self.lock:
+            size = len(self._instances)
+            sample = [instance for instance, _ in itertools.islice(
+                reversed(self._instances.values()), sample_size)]
+        if not sample:
+            return 0
+        average = sum(map(_sizeof, sample)) / len(sample)
+        return int(average * size)
+
+    def stats(self) -> Dict[str, Any]:
+        return {'size': len(self._instances),
+                'weak': len(self._evicted),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'memory': self.memory_estimate()}
+
+
+def _sizeof(instance) -> int:
+    """Approximate size of an instance, not counting other instances."""
+    seen = set()
+    stack = [instance]
+    size = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, (type, Enum)) or \
+                (obj is not instance and type(obj) in _cached_classes):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif getattr(obj, '__closure__', None):
+            stack.extend(cell.cell_contents for cell in obj.__closure__)
+        else:
+            if hasattr(obj, '__dict__'):
+                stack.append(obj.__dict__)
+            for cls in type(obj).__mro__:
+                for slot in getattr(cls, '__slots__', ()):
+                    if slot != '__weakref__' and hasattr(obj, slot):
+                        stack.append(getattr(obj, slot))
+    return size
+
+
+_cached_classes = []
+
+
+def configure_instance_caches(max_size: Optional[int] = None,
+                              max_age: Optional[float] = None,
+                              weak: bool = False) -> None:
+    """Set the bounds of the identity caches of all `@cached` classes."""
+    for cls in _cached_classes:
+        cls._instance_cache.configure(max_size, max_age, weak)
+
+
+def instance_cache_stats() -> Dict[str, Dict[str, Any]]:
+    """Counters and size estimates of the identity caches, per class."""
+    return {_class_name(cls): cls._instance_cache.stats()
+            for cls in _cached_classes}
+
+
+def _class_name(cls) -> str:
+    # Qualified, as the asyncio entities have the names of the blocking ones
+    return f"{cls.__module__}.{cls.__qualname__}"
+
+
+def _instance_cache_entries() -> Dict[Tuple[str, str], int]:
+    entries = {}
+    for cls in _cached_classes:
+        cache = cls._instance_cache
+        entries[(_class_name(cls), 'kept')] = len(cache._instances)
+        entries[(_class_name(cls), 'weak')] = len(cache._evicted)
+    return entries
+
+
+def _instance_cache_counts(name: str) -> Dict[Tuple[str], int]:
+    return {(_class_name(cls),): getattr(cls._instance_cache, name)
+            for cls in _cached_classes}
+
+
+Gauge('chesscom_instance_cache_entries',
+      "Instances in the identity caches, by (qualified) class and state: "
+      "'kept', or 'weak' (evicted but still in use)", ('entity', 'state'),
+      _instance_cache_entries)
+Gauge('chesscom_instance_cache_hits_total',
+      "Lookups of instances found in the identity caches, by class",
+      ('entity',), partial(_instance_cache_counts, 'hits'), kind='counter')
+Gauge('chesscom_instance_cache_misses_total',
+      "Lookups of instances not in the identity caches, by class",
+      ('entity',), partial(_instance_cache_counts, 'misses'), kind='counter')
+Gauge('chesscom_instance_cache_evictions_total',
+      "Instances evicted from the identity caches, by class",
+      ('entity',), partial(_instance_cache_counts, 'evictions'),
+      kind='counter')
 
 
 def cached(decorated_cls):
@@ -8,78 +235,358 @@ def cached(decorated_cls):
     A decorated class keeps a unique instance per key. This is a bit overly
     complicated, but is convenient while developing the API since we don't need
     to add separate `lookup_*` functions until we are sure which ones we want.
+
+    The instances are kept in an `InstanceCache`, unbounded unless
+    configured otherwise (see `configure_instance_caches`).
     """
 
     def __cached_new(cls, key):
         # Consistent use of lower case for string keys
         lookup_key = key.lower() if isinstance(key, str) else key
 
-        if lookup_key in cls._instance_cache:
-            return cls._instance_cache[lookup_key]
+        with cls._instance_cache.lock:
+            instance = cls._instance_cache.get(lookup_key)
+            if instance is not None:
+                return instance
 
-        instance = super(decorated_cls, cls).__new__(cls)
-        # Use original key when creating instance. Mainly for debugging,
-        # need to make an API call to get proper capitalization, or to even
-        # check if the entity exists — and we want to postpone calling the API
-        # for as long as possible!
-        cls._initializer(instance, key)
+            instance = super(decorated_cls, cls).__new__(cls)
+            # Use original key when creating instance. Mainly for debugging,
+            # need to make an API call to get proper capitalization, or to
+            # even check if the entity exists — and we want to postpone
+            # calling the API for as long as possible!
+            cls._initializer(instance, key)
 
-        cls._instance_cache[lookup_key] = instance
+            cls._instance_cache.put(lookup_key, instance)
 
-        return instance
+            return instance
 
     def __cached_init(cls, key):
         pass
 
-    decorated_cls._instance_cache = {}
+    decorated_cls._instance_cache = InstanceCache()
     decorated_cls._initializer = decorated_cls.__init__
     decorated_cls.__new__ = __cached_new
     decorated_cls.__init__ = __cached_init
+    _cached_classes.append(decorated_cls)
     return decorated_cls
 
 
+class _Flight(object):
+    __slots__ = ('done', 'result', 'error', 'waiters')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        # The event loops and futures of the coroutines waiting
+        self.waiters = []  # type: List[Tuple[Any, asyncio.Future]]
+
+
+class SingleFlight(object):
+    """Makes at most one call per key at a time, sharing its outcome.
+
+    Threads asking for a key that is already being called for wait for that
+    call to finish, and then return (or raise) what it did, instead of
+    making a call of their own. Coroutines do the same with `run_async`
+    (without blocking their event loop), sharing the calls of threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}  # type: Dict[Any, _Flight]
+
+    def _board(self, key, loop=None):
+        """The flight for a key, whether it was just started, and (if it was
+        joined from an event loop) a future of the loop to wait on."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                return flight, True, None
+            waiter = None
+            if loop is not None:
+                # Made now, as the flight may land any time after
+                waiter = loop.create_future()
+                flight.waiters.append((loop, waiter))
+            return flight, False, waiter
+
+    def _land(self, key, flight: _Flight) -> None:
+        with self._lock:
+            del self._flights[key]
+            flight.done.set()
+        for loop, waiter in flight.waiters:
+            loop.call_soon_threadsafe(_wake, waiter)
+
+    @staticmethod
+    def _outcome(flight: _Flight) -> Any:
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def run(self, key, fn: Callable[[], Any]) -> Any:
+        flight, leader, _ = self._board(key)
+        if not leader:
+            flight.done.wait()
+            return self._outcome(flight)
+
+        try:
+            flight.result = fn()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            self._land(key, flight)
+        return flight.result
+
+    async def run_async(self, key, fn: Callable[[], Awaitable]) -> Any:
+        """Like `run`, for a coroutine function."""
+        flight, leader, waiter = self._board(key,
+                                             asyncio.get_running_loop())
+        if not leader:
+            await waiter
+            return self._outcome(flight)
+
+        try:
+            flight.result = await fn()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            self._land(key, flight)
+        return flight.result
+
+    def in_flight(self) -> int:
+        """The number of calls currently being made."""
+        return len(self._flights)
+
+
 T = TypeVar('T')
 
+# Seconds past expiry that values may still be served while being refreshed
+_stale_grace = 0.0
+_refresh_workers = 4
+_refresher = None  # type: Optional[ThreadPoolExecutor]
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+def set_stale_while_revalidate(grace: float, max_workers: int = 4) -> None:
+    """Serve expired values for up to `grace` seconds while refreshing them.
+
+    Within the grace period, an expired value is returned immediately and a
+    refresh is made in the background (by at most `max_workers` threads),
+    instead of the caller waiting for it. Zero turns this off (the default).
+    Parts with a grace period of their own (see `Entity._graces`) keep it
+    regardless."""
+    global _stale_grace, _refresh_workers
+    _stale_grace = grace
+    _refresh_workers = max_workers
+
+
+_read_tracker = None  # type: Optional[Callable[[Any, str], None]]
+
+
+def set_read_tracker(
+        tracker: Optional[Callable[[Any, str], None]]) -> None:
+    """Have `tracker(entity, part)` called whenever a property is read.
+
+    Used by the `CacheWarmer` to tell which entities are hot (None to
+    stop)."""
+    global _read_tracker
+    _read_tracker = tracker
+
+
+def note_read(entity, part: str, outcome: str) -> None:
+    """Account for a read of a part of an entity, by either client.
+
+    `outcome` is how it was served: 'hit', 'stale', 'miss', 'expired', or
+    'negative' (its error raised again). Counts it, and unless negative,
+    tells the read tracker and notes when the data read expires (see
+    `rest.used_until`)."""
+    REQUESTED.inc(type(entity).__name__, part, outcome)
+    if outcome == 'negative':
+        return
+    if _read_tracker is not None:
+        _read_tracker(entity, part)
+    record = entity._record(part)
+    used_until(record.received + record.ttl)
+
+
+def _refresh(entity, part: str) -> None:
+    """Request a part of an entity in the background, unless already doing
+    so."""
+    global _refresher
+    with _refreshing_lock:
+        if (entity, part) in _refreshing:
+            return
+        _refreshing.add((entity, part))
+        if _refresher is None:
+            _refresher = ThreadPoolExecutor(max_workers=_refresh_workers,
+                                            thread_name_prefix='refresh')
+
+    def run():
+        try:
+            with priority(BACKGROUND):
+                entity._request(part)
+        except Exception:
+            logger.exception("Background refresh failed")
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard((entity, part))
+
+    _refresher.submit(run)
+
+
+class Record(object):
+    """Keeps the values received from one endpoint, and when they expire.
+
+    `data` is a tuple of the values of the properties of a part, in order.
+    Times are kept as timestamps and seconds, which are more compact than
+    datetimes and timedeltas. Instead of values, a record may keep the error
+    the endpoint answered with (`NotFound` or `Gone`), which then expires
+    the same way.
+    """
+    __slots__ = ('received', 'ttl', 'data', 'validators', 'error')
+
+    def __init__(self, ttl: float = 7200) -> None:
+        self.received = None  # type: Optional[float]
+        self.ttl = ttl
+        self.data = None  # type: Optional[tuple]
+        self.validators = None
+        self.error = None  # type: Optional[Exception]
+
+    def has_data(self) -> bool:
+        """Check if there are non-expired values available."""
+        return self.received is not None and self.error is None and \
+            time.time() - self.received < self.ttl
+
+    def has_error(self) -> bool:
+        """Check if there is a non-expired error instead of values."""
+        return self.received is not None and self.error is not None and \
+            time.time() - self.received < self.ttl
+
+    def is_stale(self, grace: Optional[float] = None) -> bool:
+        """Check if there are expired values within the grace period.
+
+        The global grace period is used unless one is given (see
+        `set_stale_while_revalidate`)."""
+        if grace is None:
+            grace = _stale_grace
+        return bool(grace) and self.received is not None and \
+            self.error is None and \
+            self.ttl <= time.time() - self.received < self.ttl + grace
+
+
+EMPTY = Record()
+"""Stands in for the record of a part that has not been received yet."""
+
+
+class Field(object):
+    """Declares a property of an entity, filled in from the given part.
+
+    Reading the property from an entity gives a `Requested` for it.
+    """
+
+    def __init__(self, part: str) -> None:
+        self.part = part
+        self.name = None  # type: Optional[str]
+        self.index = None  # type: Optional[int]
+
+    def __set_name__(self, owner, name) -> None:
+        self.name = name
+
+    def __get__(self, entity, owner=None):
+        if entity is None:
+            return self
+        return Requested(entity, self.part, self.index)
+
 
 class Requested(Generic[T]):
-    """Keeps cached values. Does not flush expired values."""
-    requester: Callable[[], None]
-    received: Optional[datetime]
-    data: Optional[T]
-
-    def __init__(self, requester: Callable[[], None], ttl=7200) -> None:
-        """Initialize an expiring value with a requester function."""
-        self.requester = requester
-        self.received = None
-        self.data = None
-        self.ttl = timedelta(seconds=ttl)
-
-    def has_data(self):
+    """A property of an entity, as kept in the record of its part.
+
+    Calling it returns the value, fetching it first if needed. These are
+    made when the property is read, and do not keep anything of their own.
+    """
+    __slots__ = ('entity', 'part', 'index')
+
+    def __init__(self, entity, part: str, index: int) -> None:
+        self.entity = entity
+        self.part = part
+        self.index = index
+
+    def _record(self) -> Record:
+        return self.entity._record(self.part)
+
+    def has_data(self) -> bool:
         """Chech if there is a non-expired value available."""
-        return self.received and self.age() < self.ttl
+        return self._record().has_data()
 
-    def __call__(self) -> T:
-        """Return the value, fetching it first if needed."""
-        if self.has_data():
-            return self.data
-        else:
-            self.requester()
-            if not self.has_data():
-                raise Exception()
-            else:
-                return self.data
+    def is_stale(self) -> bool:
+        """Check if there is an expired value that may still be served."""
+        return self._record().is_stale(self.entity._graces.get(self.part))
+
+    def has_error(self) -> bool:
+        """Check if the entity was found missing, not long ago."""
+        return self._record().has_error()
 
-    def receive(self, data: T) -> None:
-        """Store a value."""
-        self.received = datetime.now()
-        self.data = data
+    @property
+    def data(self) -> Optional[T]:
+        data = self._record().data
+        return data[self.index] if data is not None else None
+
+    @property
+    def received(self) -> Optional[datetime]:
+        received = self._record().received
+        return datetime.fromtimestamp(received) if received else None
+
+    @property
+    def ttl(self) -> timedelta:
+        return timedelta(seconds=self._record().ttl)
+
+    @property
+    def validators(self):
+        return self._record().validators
+
+    def __call__(self, fresh=False, revalidate=False) -> T:
+        """Return the value, fetching it first if needed.
+
+        Unless `fresh` is set, a stale value is returned while it is refreshed
+        in the background, and if the entity was found missing (see
+        `Record`), that error is raised again without calling the API. With
+        `revalidate` set (which implies `fresh`), the value is requested
+        again even if it has not expired, conditionally on its validators
+        (and those of the response cache)."""
+        fresh = fresh or revalidate
+        record = self._record()
+        if record.has_data() and not revalidate:
+            outcome = 'hit'
+        elif not fresh and record.has_error():
+            note_read(self.entity, self.part, 'negative')
+            raise record.error
+        elif not fresh and self.is_stale():
+            outcome = 'stale'
+            _refresh(self.entity, self.part)
+        else:
+            outcome = 'miss' if record.data is None else \
+                'revalidated' if record.has_data() else 'expired'
+            before = record.received
+            self.entity._request(self.part, revalidate)
+            # Not checking freshness again, as a response not to be cached
+            # (with a max-age of 0) is expired as soon as received
+            record = self._record()
+            if record.data is None or record.error is not None or \
+                    record.received == before:
+                raise UpstreamError(self.entity._endpoint(self.part))
+        note_read(self.entity, self.part, outcome)
+        return self._record().data[self.index]
 
     def age(self, until=None) -> Optional[timedelta]:
         """The age of the value, if any."""
-        if not self.received:
+        received = self.received
+        if not received:
             return None
 
         if not until:
             until = datetime.now()
 
-        return until - self.received
+        return until - received
@@ -1,93 +1,125 @@
-from typing import Optional, Iterable, List
+from typing import Optional, Iterable, List, Iterator, Sequence, Union
 from enum import Enum, unique
 from datetime import datetime
 
 from .rest import request_json, key_from_url
-from .cache import cached, Requested
+from .stream import iter_json_items
+from .cache import cached, Requested, Field
+from .entity import Entity
 
 
 @cached
-class Club(object):
-    # Profile properties
-    name: Requested[str]
-    club_id: Requested[int]
-    icon: Requested[str]
-    country: Requested['Country']
-    created: Requested[datetime]
-    last_activity: Requested[datetime]
-    visibility: Requested[bool]
-    join_request: Requested[str]
-    admin: Requested[List['Player']]
-    description: Requested[Optional[str]]
-
-    # Member properties
-    members: Requested[List['Player']]
-
-    def __init__(self, key):
-        self.key = key
+class Club(Entity):
+    __slots__ = ()
 
-        def profile_request():
-            self._profile_request()
+    _endpoints = {
+        'profile': "club/{key}",
+        'members': "club/{key}/members",
+    }
 
-        self.name = Requested(profile_request)
-        """Human-readable name of this club."""
+    # Profile properties
+    name: Requested[str] = Field('profile')
+    """Human-readable name of this club."""
 
-        self.club_id = Requested(profile_request)
-        """Non-changing Chess.com ID of this club."""
+    club_id: Requested[int] = Field('profile')
+    """Non-changing Chess.com ID of this club."""
 
-        self.icon = Requested(profile_request)
-        """Optional URL of a 200x200 image."""
+    icon: Requested[str] = Field('profile')
+    """Optional URL of a 200x200 image."""
 
-        self.country = Requested(profile_request)
-        """The club's country."""
+    country: Requested['Country'] = Field('profile')
+    """The club's country."""
 
-        self.created = Requested(profile_request)
-        """Timestamp of creation on Chess.com"""
+    created: Requested[datetime] = Field('profile')
+    """Timestamp of creation on Chess.com"""
 
-        self.last_activity = Requested(profile_request)
-        """Timestamp of the most recent post, match, etc."""
+    last_activity: Requested[datetime] = Field('profile')
+    """Timestamp of the most recent post, match, etc."""
 
-        self.visibility = Requested(profile_request)
-        """Whether the club is public or private."""
+    visibility: Requested[bool] = Field('profile')
+    """Whether the club is public or private."""
 
-        self.join_request = Requested(profile_request)
-        """Location to submit a request to join this club."""
+    join_request: Requested[str] = Field('profile')
+    """Location to submit a request to join this club."""
 
-        self.admin = Requested(profile_request)
-        """List of the club's admins."""
+    admin: Requested[List['Player']] = Field('profile')
+    """List of the club's admins."""
 
-        self.description = Requested(profile_request)
-        """Text description of the club."""
+    description: Requested[Optional[str]] = Field('profile')
+    """Text description of the club."""
 
-        def member_request():
-            self._member_request()
+    # Member properties
+    member_keys: Requested[List[str]] = Field('members')
+    """Usernames of the members of the club."""
 
-        self.members = Requested(member_request)
+    def members(self, fresh=False) -> List['Player']:
         """Members of the club"""
+        return list(map(Player, self.member_keys(fresh)))
 
     def _profile_request(self):
+        self._request('profile')
+
+    def _receive_profile(self, d):
         def get_admin(s):
             return Player(key_from_url(s))
 
-        d = request_json(f"club/{self.key}")
-        self.name.receive(d['name'])
-        self.club_id.receive(d['club_id'])
-        self.icon.receive(d.get('icon', None))
-        self.country.receive(Country(key_from_url(d['country'])))
-        self.created.receive(datetime.fromtimestamp(d['created']))
-        self.last_activity.receive(datetime.fromtimestamp(d['last_activity']))
-        self.visibility.receive(d['visibility'])
-        self.join_request.receive(d['join_request'])
-        self.admin.receive(list(map(get_admin, d['admin'])))
-        # TODO: Report that 'description' is not always present
-        self.description.receive(d.get('description', None))
+        self._store('profile',
+                    name=d['name'],
+                    club_id=d['club_id'],
+                    icon=d.get('icon', None),
+                    country=Country(key_from_url(d['country'])),
+                    created=datetime.fromtimestamp(d['created']),
+                    last_activity=datetime.fromtimestamp(d['last_activity']),
+                    visibility=d['visibility'],
+                    join_request=d['join_request'],
+                    admin=list(map(get_admin, d['admin'])),
+                    # TODO: Report that 'description' is not always present
+                    description=d.get('description', None))
 
     def _member_request(self):
-        d = request_json(f"club/{self.key}/members")
-        members = []
+        self._request('members')
+
+    def _receive_members(self, d):
+        # Only usernames, so that long lists do not fill the identity cache
+        # of players (see `members`)
+        usernames = []
         for timeframe in d.keys():
-            members.extend(map(lambda x: Player(x['username']), d[timeframe]))
-        self.members.receive(members)
+            usernames.extend(x['username'] for x in d[timeframe])
+        self._store('members', member_keys=usernames)
+
+    def iter_members(self,
+                     keys: bool = False) -> Iterator[Union['Player', str]]:
+        """Iterate over the members of the club, as they arrive.
+
+        Unlike `members()`, the list is not kept, but streamed from the API
+        (unless it has been received already), so the first members are
+        available right away and memory use does not grow with the size of
+        the club. With `keys` set, usernames are given instead of players.
+        """
+        if self.member_keys.has_data():
+            usernames = iter(self.member_keys())
+            return usernames if keys else map(Player, usernames)
+        usernames = (member['username'] for _, member in
+                     iter_json_items(self._endpoint('members')))
+        return usernames if keys else map(Player, usernames)
+
+    def rating_columns(self, categories: Optional[Sequence[str]] = None,
+                       max_workers: int = 8) -> 'RatingColumns':
+        """The ratings of the members of the club, as arrays.
+
+        Requires `numpy`; see `chesscom.ratings.rating_columns`."""
+        from .ratings import rating_columns, CATEGORIES
+        return rating_columns(self.members(), categories or CATEGORIES,
+                              max_workers)
+
+    def ratings_frame(self, categories: Optional[Sequence[str]] = None,
+                      max_workers: int = 8) -> 'pandas.DataFrame':
+        """The ratings of the members of the club, as a DataFrame.
+
+        Requires `pandas`; see `chesscom.ratings.ratings_frame`."""
+        from .ratings import ratings_frame, CATEGORIES
+        return ratings_frame(self.members(), categories or CATEGORIES,
+                             max_workers)
 
 
 def lookup_club(key: str) -> Club:
@@ -1,61 +1,96 @@
-import requests
-
-from typing import Optional, List
+from typing import Optional, List, Iterator, Sequence, Union
 from enum import Enum, unique
 from datetime import datetime
 
 from chesscom.rest import request_json, key_from_url
-from .cache import cached, Requested
+from .stream import iter_json_items
+from .cache import cached, Requested, Field
+from .entity import Entity
 
 
 @cached
-class Country(object):
-    name: Requested[str]
-    code: Requested[str]
-    players: Requested[List['Player']]
-    clubs: Requested[List['Club']]
+class Country(Entity):
+    # NB. key must be uppercase
+    __slots__ = ()
 
-    def __init__(self, key):
-        # NB. key must be uppercase
-        self.key = key
+    _endpoints = {
+        'profile': "country/{key}",
+        'players': "country/{key}/players",
+        'clubs': "country/{key}/clubs",
+    }
 
-        def request_info():
-            self._request_info()
+    name: Requested[str] = Field('profile')
+    """The human-readable name of this country."""
 
-        self.name = Requested(request_info)
-        """The human-readable name of this country."""
+    code: Requested[str] = Field('profile')
+    """ISO-31661-1 2-character code."""
 
-        self.code = Requested(request_info)
-        """ISO-31661-1 2-character code."""
+    player_keys: Requested[List[str]] = Field('players')
+    """Usernames of the active players in this country."""
 
-        def request_players():
-            self._request_players()
+    clubs: Requested[List['Club']] = Field('clubs')
+    """List of clubs associated with this country."""
 
-        self.players = Requested(request_players)
+    def players(self, fresh=False) -> List['Player']:
         """List of active players in this country."""
-
-        def request_clubs():
-            self._request_clubs()
-
-        self.clubs = Requested(request_clubs)
-        """List of clubs associated with this country."""
+        return list(map(Player, self.player_keys(fresh)))
 
     def _request_info(self):
-        d = request_json(f"country/{self.key}")
-        self.name.receive(d['name'])
-        self.code.receive(d['code'])
+        self._request('profile')
+
+    def _receive_profile(self, d):
+        self._store('profile', name=d['name'], code=d['code'])
 
     def _request_players(self):
-        d = request_json(f"country/{self.key}/players")
-        self.players.receive(list(map(Player, d['players'])))
+        self._request('players')
+
+    def _receive_players(self, d):
+        # Only usernames, so that long lists do not fill the identity cache
+        # of players (see `players`)
+        self._store('players', player_keys=d['players'])
+
+    def iter_players(self,
+                     keys: bool = False) -> Iterator[Union['Player', str]]:
+        """Iterate over the active players in this country, as they arrive.
+
+        Unlike `players()`, the list is not kept, but streamed from the API
+        (unless it has been received already), so the first players are
+        available right away and memory use does not grow with the length of
+        the list. With `keys` set, usernames are given instead of players.
+        """
+        if self.player_keys.has_data():
+            usernames = iter(self.player_keys())
+            return usernames if keys else map(Player, usernames)
+        usernames = (username for _, username in
+                     iter_json_items(self._endpoint('players')))
+        return usernames if keys else map(Player, usernames)
 
     def _request_clubs(self):
-        d = request_json(f"country/{self.key}/clubs")
+        self._request('clubs')
 
+    def _receive_clubs(self, d):
         def get_club(url):
             return Club(key_from_url(url))
 
-        self.clubs.receive(list(map(get_club, d['clubs'])))
+        self._store('clubs', clubs=list(map(get_club, d['clubs'])))
+
+    def rating_columns(self, categories: Optional[Sequence[str]] = None,
+                       max_workers: int = 8) -> 'RatingColumns':
+        """The ratings of the active players in the country, as arrays.
+
+        Requires `numpy`; see `chesscom.ratings.rating_columns`."""
+        from .ratings import rating_columns, CATEGORIES
+        return rating_columns(self.players(), categories or CATEGORIES,
+                              max_workers)
+
+    def ratings_frame(self, categories: Optional[Sequence[str]] = None,
+                      max_workers: int = 8) -> 'pandas.DataFrame':
+        """The ratings of the active players in the country, as a DataFrame.
+
+        Requires `pandas`; see `chesscom.ratings.ratings_frame`."""
+        from .ratings import ratings_frame, CATEGORIES
+        return ratings_frame(self.players(), categories or CATEGORIES,
+                             max_workers)
 
 
 def lookup_country(key: str) -> Country:
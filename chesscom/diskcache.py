@@ -0,0 +1,201 @@
+from typing import Optional
+import threading
+import sqlite3
+import uuid
+import json
+import time
+import zlib
+import os
+
+from .rest import Fetched
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+VACUUM_PAGES = 1024
+"""Free pages returned to the file system at a time by `compact()`."""
+
+
+class DiskCache(object):
+    """Persistent cache of endpoint responses, kept in an SQLite database.
+
+    Responses are stored compressed together with the time they were
+    received, when they expire, and their validators, so that a restarted
+    process can serve still valid data without calling the API (and
+    revalidate expired data cheaply). Entries expired for more than
+    `keep_stale` seconds are removed by `compact()` (run every
+    `compact_every` stores), which also evicts the oldest responses while
+    the stored total exceeds `max_bytes`, and then shrinks the database by
+    the space freed, a few pages at a time, without blocking the cache.
+
+    Processes on the same host may share the directory: they then serve
+    each other's responses, and lock endpoints while fetching them (see
+    `acquire`), so that each is fetched by one of them only.
+
+    Install with `chesscom.rest.set_response_cache`.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 1 << 30,
+                 keep_stale: float = 86400, compact_every: int = 1000):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, 'responses.sqlite3')
+        self.max_bytes = max_bytes
+        self.keep_stale = keep_stale
+        self.compact_every = compact_every
+        self._stores = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False,
+                                   isolation_level=None)
+        # Only takes effect on creating the database (see
+        # `enable_incremental_vacuum` for older ones)
+        self._db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS responses ("
+                         "endpoint TEXT PRIMARY KEY, "
+                         "received REAL NOT NULL, "
+                         "expires REAL NOT NULL, "
+                         "body BLOB NOT NULL)")
+        columns = [row[1] for row in
+                   self._db.execute("PRAGMA table_info(responses)")]
+        for column in ('etag', 'last_modified'):
+            if column not in columns:
+                self._db.execute(f"ALTER TABLE responses "
+                                 f"ADD COLUMN {column} TEXT")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_received "
+                         "ON responses (received)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS leases ("
+                         "endpoint TEXT PRIMARY KEY, "
+                         "token TEXT NOT NULL, "
+                         "expires REAL NOT NULL)")
+        self._incremental = self._is_incremental()
+        if not self._incremental:
+            logger.warning("%s was created without incremental vacuuming, "
+                           "so space freed is not returned to the file "
+                           "system; see DiskCache.enable_incremental_vacuum",
+                           self.path)
+        self.compact()
+
+    def _is_incremental(self) -> bool:
+        return self._db.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+    def enable_incremental_vacuum(self) -> None:
+        """Have space freed returned to the file system by `compact()`, for
+        a database created without it (by an earlier version).
+
+        Rewrites the whole database, which is locked meanwhile: run it for
+        maintenance, while no other process uses the directory."""
+        with self._lock:
+            self._db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            self._db.execute("VACUUM")
+            self._incremental = self._is_incremental()
+
+    def get(self, endpoint: str) -> Optional[Fetched]:
+        """The last response to an endpoint, if any (it may have expired)."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT body, received, expires, etag, last_modified "
+                "FROM responses WHERE endpoint = ?", (endpoint,)).fetchone()
+        if row is None:
+            return None
+        body, received, expires, etag, last_modified = row
+        return Fetched(json.loads(zlib.decompress(body).decode()), received,
+                       expires - received, etag, last_modified)
+
+    def put(self, endpoint: str, fetched: Fetched) -> None:
+        """Store the response to an endpoint."""
+        body = zlib.compress(json.dumps(fetched.data).encode())
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (endpoint, received, "
+                "expires, body, etag, last_modified) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (endpoint, fetched.received, fetched.expires, body,
+                 fetched.etag, fetched.last_modified))
+            self._stores += 1
+            due = self._stores % self.compact_every == 0
+        if due:
+            self.compact()
+
+    def acquire(self, endpoint: str, ttl: float) -> Optional[str]:
+        """Lock an endpoint for `ttl` seconds at most, across processes.
+
+        Returns a token to release the lock with, or None if it is held."""
+        token = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._db.execute("DELETE FROM leases "
+                             "WHERE endpoint = ? AND expires <= ?",
+                             (endpoint, now))
+            acquired = self._db.execute("INSERT OR IGNORE INTO leases "
+                                        "VALUES (?, ?, ?)",
+                                        (endpoint, token, now + ttl)
+                                        ).rowcount
+        return token if acquired else None
+
+    def release(self, endpoint: str, token: str) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM leases "
+                             "WHERE endpoint = ? AND token = ?",
+                             (endpoint, token))
+
+    def size(self) -> int:
+        """Total bytes of stored responses."""
+        with self._lock:
+            return self._db.execute("SELECT COALESCE(SUM(LENGTH(body)), 0) "
+                                    "FROM responses").fetchone()[0]
+
+    def compact(self) -> None:
+        """Remove long expired responses and enforce the size cap."""
+        with self._lock:
+            expired = self._db.execute("DELETE FROM responses "
+                                       "WHERE expires <= ?",
+                                       (time.time() - self.keep_stale,)
+                                       ).rowcount
+            total = self._db.execute("SELECT COALESCE(SUM(LENGTH(body)), 0) "
+                                     "FROM responses").fetchone()[0]
+            evicted = 0
+            if total > self.max_bytes:
+                rows = self._db.execute("SELECT endpoint, LENGTH(body) "
+                                        "FROM responses ORDER BY received"
+                                        ).fetchall()
+                endpoints = []
+                for endpoint, size in rows:
+                    if total <= self.max_bytes:
+                        break
+                    endpoints.append((endpoint,))
+                    total -= size
+                self._db.executemany("DELETE FROM responses "
+                                     "WHERE endpoint = ?", endpoints)
+                evicted = len(endpoints)
+        if (expired or evicted) and self._incremental:
+            self._vacuum()
+        logger.debug("Compacted %s: %d expired, %d evicted", self.path,
+                     expired, evicted)
+
+    def _vacuum(self) -> None:
+        """Return the free pages of the database to the file system.
+
+        Through a connection of its own, so that the cache can be used in
+        the meantime, and `VACUUM_PAGES` at a time, so that writers are not
+        kept waiting for long."""
+        db = sqlite3.connect(self.path, isolation_level=None)
+        try:
+            free = db.execute("PRAGMA freelist_count").fetchone()[0]
+            while free:
+                # Unlike execute(), runs the pragma to completion
+                db.executescript(f"PRAGMA incremental_vacuum({VACUUM_PAGES})")
+                left = db.execute("PRAGMA freelist_count").fetchone()[0]
+                if left >= free:
+                    break
+                free = left
+        finally:
+            db.close()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM responses")
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,257 @@
+from typing import Dict, Tuple, Iterable, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import logging
+
+from .rest import APIError, NotFound, Gone, Fetched, fetch_json, priority, \
+    api_error, INTERACTIVE, BACKGROUND, DEFAULT_TTL
+from .cache import SingleFlight, Record, Field, EMPTY
+
+logger = logging.getLogger(__name__)
+
+# Requests in flight, per (entity, part)
+_flights = SingleFlight()
+
+_records_lock = threading.Lock()
+
+# Seconds to remember that a part was not found (see `set_negative_ttl`)
+_negative_ttl = 900.0
+
+
+class Entity(object):
+    """Base class for entities whose properties are filled in per endpoint.
+
+    Subclasses describe the endpoints they use in `_endpoints`, mapping the
+    name of each part to its endpoint (formatted with the entity's key), and
+    declare their properties as `Field`s of a part. Each part is received by
+    a `_receive_<part>` method taking the decoded response and passing the
+    values of its properties to `_store`, so the same parsing is shared by
+    the blocking and the asyncio clients.
+
+    The values of a part are kept together in one `Record`, made when the
+    part is first received, so that entities that are merely referred to
+    (eg., in a long list of players) take up little memory.
+    """
+    __slots__ = ('key', '_records', '__weakref__')
+
+    key: str
+
+    _endpoints = {}  # type: Dict[str, str]
+
+    # Names of the properties of each part, in order (from the Fields)
+    _fields = {}  # type: Dict[str, Tuple[str, ...]]
+    _parts = ()  # type: Tuple[str, ...]
+
+    # Seconds to keep parts for, overriding the max-age sent by the API
+    _ttls = {}  # type: Dict[str, float]
+
+    # Seconds to serve expired parts for while refreshing them, overriding
+    # the global setting (see `set_stale_while_revalidate`)
+    _graces = {}  # type: Dict[str, float]
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._parts = tuple(cls._endpoints)
+        fields = {part: [] for part in cls._parts}
+        for name, value in vars(cls).items():
+            if isinstance(value, Field):
+                value.index = len(fields[value.part])
+                fields[value.part].append(name)
+        cls._fields = {part: tuple(names) for part, names in fields.items()}
+
+    def __init__(self, key):
+        self.key = key
+        self._records = None  # type: Optional[List[Record]]
+
+    def _endpoint(self, part: str) -> str:
+        """The endpoint to call for the given part."""
+        return self._endpoints[part].format(key=self.key)
+
+    @classmethod
+    def _part_of(cls, name: str) -> str:
+        """The part filling in the property with the given name."""
+        field = getattr(cls, name, None)
+        if not isinstance(field, Field):
+            raise KeyError(name)
+        return field.part
+
+    def _record(self, part: str) -> Record:
+        """The record of a part (`EMPTY` if not received yet)."""
+        if self._records is None:
+            return EMPTY
+        return self._records[self._parts.index(part)] or EMPTY
+
+    def _has_data(self, part: str) -> bool:
+        """Check if the given part has non-expired data."""
+        return self._record(part).has_data()
+
+    def _can_serve(self, part: str) -> bool:
+        """Check if the given part has non-expired or servable stale data."""
+        record = self._record(part)
+        return record.has_data() or record.is_stale(self._graces.get(part))
+
+    def _has_error(self, part: str) -> bool:
+        """Check if the given part was found missing, not long ago."""
+        return self._record(part).has_error()
+
+    def _is_known(self, part: str) -> bool:
+        """Check if the given part can be read without requesting it: it
+        has servable data, or was found missing."""
+        return self._can_serve(part) or self._has_error(part)
+
+    def _receive(self, part: str, d: dict) -> None:
+        """Fill in the properties of a part from its response."""
+        getattr(self, '_receive_' + part)(d)
+
+    def _made_record(self, part: str) -> Record:
+        """The record of a part, made if not received yet."""
+        if self._records is None:
+            with _records_lock:
+                if self._records is None:
+                    self._records = [None] * len(self._parts)
+        index = self._parts.index(part)
+        record = self._records[index]
+        if record is None:
+            record = Record(self._ttls.get(part, DEFAULT_TTL))
+            self._records[index] = record
+        return record
+
+    def _store(self, part: str, **values) -> None:
+        """Keep the values of the properties of a part, received just now."""
+        record = self._made_record(part)
+        if record.error is not None:
+            record.error = None
+            record.ttl = self._ttls.get(part, DEFAULT_TTL)
+        record.data = tuple(values[name] for name in self._fields[part])
+        record.received = time.time()
+
+    def _receive_error(self, part: str, error: Exception) -> None:
+        """Remember for a while that a part was not found (404 or 410).
+
+        Until then, reading its properties raises the error again instead of
+        calling the API (see `Requested`). Other errors are not kept."""
+        if not isinstance(error, (NotFound, Gone)):
+            return
+        record = self._made_record(part)
+        record.data = None
+        record.validators = None
+        record.error = error
+        record.ttl = _negative_ttl
+        record.received = time.time()
+
+    def _validators(self, part: str):
+        """Validators of the (possibly expired) data of a part, if any."""
+        record = self._record(part)
+        return record.validators if record.received else None
+
+    def _receive_fetched(self, part: str, fetched: Fetched) -> None:
+        """Fill in a part from a response, with its caching metadata.
+
+        Only the expiry is refreshed for a response that was not modified.
+        """
+        if fetched.data is not None:
+            self._receive(part, fetched.data)
+        elif not self._validators(part):
+            raise api_error(self._endpoint(part), 304)
+
+        record = self._record(part)
+        record.received = fetched.received
+        record.ttl = fetched.ttl
+        record.validators = fetched.validators
+
+    def _request(self, part: str, revalidate: bool = False) -> None:
+        """Call the endpoint of a part and fill in its properties.
+
+        Concurrent calls for the same part share one request. With
+        `revalidate` set, a fresh response in the response cache is
+        revalidated rather than used."""
+        _flights.run((self, part), lambda: self._fetch(part, revalidate))
+
+    def _fetch(self, part: str, revalidate: bool = False) -> None:
+        try:
+            fetched = fetch_json(self._endpoint(part), self._ttls.get(part),
+                                 self._validators(part), revalidate)
+        except APIError as e:
+            self._receive_error(part, e)
+            raise
+        self._receive_fetched(part, fetched)
+
+
+def override_ttl(entity_class, part: str, ttl: Optional[float]) -> None:
+    """Keep the given part of entities for `ttl` seconds.
+
+    Overrides the max-age sent by the API (or reverts to it, if None)."""
+    entity_class._ttls = dict(entity_class._ttls)
+    if ttl is None:
+        entity_class._ttls.pop(part, None)
+    else:
+        entity_class._ttls[part] = ttl
+
+
+def set_negative_ttl(ttl: float) -> None:
+    """Remember for `ttl` seconds that an entity was not found.
+
+    Reading its properties meanwhile raises `NotFound` (or `Gone`) again
+    without calling the API; zero turns this off. Defaults to 15 minutes."""
+    global _negative_ttl
+    _negative_ttl = ttl
+
+
+def request_parts(jobs: Iterable[Tuple[Entity, str]], max_workers: int = 8,
+                  level: int = INTERACTIVE,
+                  revalidate: bool = False) -> List[Optional[Exception]]:
+    """Request the given (entity, part) pairs concurrently.
+
+    The requests are made with the given priority (see `Entity._request`
+    for `revalidate`). Returns, for each pair, the exception raised when
+    requesting it, or None if it succeeded.
+    """
+    def run(job):
+        entity, part = job
+        try:
+            with priority(level):
+                entity._request(part, revalidate)
+        except Exception as e:
+            logger.info("Failed to request %s: %r", entity._endpoint(part), e)
+            return e
+        return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(run, jobs))
+
+
+def prefetch(entities: Iterable[Entity],
+             parts: Iterable[str] = ('profile', 'stats', 'clubs'),
+             max_workers: int = 8,
+             level: int = BACKGROUND) -> Dict[Entity, Exception]:
+    """Fill in the given parts of many entities concurrently.
+
+    Calls the endpoints of every part an entity has (and does not already
+    have data for) from a pool of `max_workers` threads, so that accessing
+    the corresponding properties afterwards does not need any further
+    requests. The requests are made with background priority by default,
+    giving way to interactive ones. A failing request does not abort the
+    batch: the returned dictionary maps each entity that could not be fully
+    fetched to the (first) exception raised for it. Parts found missing
+    recently are not requested again (see `set_negative_ttl`), but their
+    entities are mapped to the error they were found missing with.
+    """
+    parts = tuple(parts)
+    errors = {}
+    # Duplicates are dropped, keeping the order of the entities
+    jobs = []
+    for job in dict.fromkeys(
+            (entity, part) for entity in entities for part in parts
+            if part in entity._endpoints and not entity._has_data(part)):
+        entity, part = job
+        if entity._has_error(part):
+            errors.setdefault(entity, entity._record(part).error)
+        else:
+            jobs.append(job)
+
+    for (entity, _), error in zip(jobs, request_parts(jobs, max_workers,
+                                                      level)):
+        if error is not None:
+            errors.setdefault(entity, error)
+    return errors
@@ -0,0 +1,213 @@
+from typing import Optional, Iterable, List, Dict, Tuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import threading
+import time
+
+from .rest import fetch_json, key_from_url, priority, BACKGROUND
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+IMMUTABLE_TTL = 10 * 365 * 86400
+"""Seconds to keep the games of past months for (they do not change)."""
+
+SETTLED_MONTHS = 64
+"""Months of games kept in memory once settled, at most (see
+`set_settled_months`)."""
+
+# Games of a month may still be added for a while after it ends
+_SETTLE_SECONDS = 86400
+
+
+class GamePlayer(object):
+    """One side of a game."""
+    __slots__ = ('player', 'rating', 'result')
+
+    player: 'Player'
+    rating: int
+    result: str
+
+    def __init__(self, d: dict):
+        self.player = Player(key_from_url(d['@id']))
+        self.rating = d['rating']
+        self.result = d['result']
+        """Eg., 'win', 'checkmated', 'resigned', 'timeout', or 'agreed'."""
+
+
+class Game(object):
+    """A finished game, as listed in the monthly archive of a player."""
+    __slots__ = ('url', 'pgn', 'time_control', 'end_time', 'rated', 'fen',
+                 'time_class', 'rules', 'white', 'black')
+
+    url: str
+    pgn: Optional[str]
+    time_control: str
+    end_time: datetime
+    rated: bool
+    fen: Optional[str]
+    time_class: str
+    rules: str
+    white: GamePlayer
+    black: GamePlayer
+
+    def __init__(self, d: dict):
+        """Initialize from JSON dictionary."""
+        self.url = d['url']
+        self.pgn = d.get('pgn', None)
+        self.time_control = d['time_control']
+        self.end_time = datetime.fromtimestamp(d['end_time'])
+        self.rated = d['rated']
+        self.fen = d.get('fen', None)
+        self.time_class = d['time_class']
+        self.rules = d['rules']
+        self.white = GamePlayer(d['white'])
+        self.black = GamePlayer(d['black'])
+
+
+def is_settled(year: int, month: int, now: Optional[float] = None) -> bool:
+    """Check if the archive of a month will not change anymore."""
+    if month == 12:
+        year, month = year + 1, 1
+    else:
+        month += 1
+    end = datetime(year, month, 1, tzinfo=timezone.utc).timestamp()
+    return end + _SETTLE_SECONDS < (now or time.time())
+
+
+def month_of(timestamp: float) -> Tuple[int, int]:
+    """The (year, month) of the archive a game ending at a time is in."""
+    t = datetime.fromtimestamp(timestamp, timezone.utc)
+    return t.year, t.month
+
+
+# Games of settled months, per (username, year, month), least recently
+# read first
+_settled = OrderedDict()  # type: OrderedDict[Tuple[str, int, int], List[Game]]
+_settled_lock = threading.Lock()
+
+
+def set_settled_months(n: int) -> None:
+    """Keep the games of up to `n` settled months in memory (0 for none).
+
+    The least recently read are dropped first. Defaults to 64 months."""
+    global SETTLED_MONTHS
+    with _settled_lock:
+        SETTLED_MONTHS = n
+        while len(_settled) > n:
+            _settled.popitem(last=False)
+
+
+def request_games(username: str, year: int, month: int) -> List[Game]:
+    """Fetch the games a player finished in the given month.
+
+    Settled months are kept in memory (see `set_settled_months`), and by
+    the response cache, if set, for good."""
+    settled = is_settled(year, month)
+    key = (username.lower(), year, month)
+    if settled:
+        with _settled_lock:
+            games = _settled.get(key)
+            if games is not None:
+                _settled.move_to_end(key)
+                return list(games)
+    games, _ = fetch_games(username, year, month)
+    if settled and SETTLED_MONTHS:
+        with _settled_lock:
+            _settled[key] = list(games)
+            while len(_settled) > SETTLED_MONTHS:
+                _settled.popitem(last=False)
+    return games
+
+
+def fetch_games(username: str, year: int, month: int,
+                validators=None) -> Tuple[Optional[List[Game]], tuple]:
+    """Fetch the games a player finished in the given month, unless they
+    have not changed.
+
+    The request is conditional on the given validators (ETag and
+    Last-Modified) of an earlier response, if the response cache does not
+    have one: the games are then None if the month has not changed since.
+    Also gives the validators of the response."""
+    fetched = fetch_json(f"player/{username}/games/{year:04}/{month:02}",
+                         IMMUTABLE_TTL if is_settled(year, month) else None,
+                         validators)
+    games = None if fetched.data is None else \
+        list(map(Game, fetched.data['games']))
+    return games, (fetched.validators if any(fetched.validators)
+                   else tuple(validators or (None, None)))
+
+
+class GameSync(object):
+    """Fetches only the games players finished since the last sync.
+
+    Keeps, for each player synced, the end time of the last game received
+    (as a timestamp) and the validators (ETag and Last-Modified) of the
+    archives of the months looked at, in the dictionary `state`, which can
+    be saved (eg., as JSON) and given back to continue later. A sync only
+    looks at the months from that of the last game on, whose archives
+    (unless settled and cached already) are fetched conditionally, so that
+    an unchanged month costs a 304 and no download.
+    """
+
+    def __init__(self, state: Optional[Dict[str, dict]] = None):
+        self.state = dict(state or {})
+        self._lock = threading.Lock()
+
+    def new_games(self, player: 'Player') -> List[Game]:
+        """The games a player finished since the last sync, oldest first."""
+        entry = self.state.get(player.key)
+        if isinstance(entry, (int, float)):
+            # Saved before validators were kept
+            entry = {'last': entry}
+        entry = dict(entry or {})
+        last = entry.get('last')
+        validators = entry.get('validators') or {}
+
+        months = player.archives(revalidate=True)
+        if last is not None:
+            months = [m for m in months if m >= month_of(last)]
+        games = []
+        kept = {}
+        for year, month in months:
+            name = f"{year:04}/{month:02}"
+            received, kept[name] = fetch_games(
+                player.key, year, month, tuple(validators.get(name) or ()))
+            if received is not None:
+                games.extend(game for game in received
+                             if last is None or
+                             game.end_time.timestamp() > last)
+
+        if games:
+            entry['last'] = max(game.end_time.timestamp() for game in games)
+        # As lists, like they would be read back from JSON
+        entry['validators'] = {name: list(month_validators)
+                               for name, month_validators in kept.items()
+                               if any(month_validators)}
+        with self._lock:
+            self.state[player.key] = entry
+        return games
+
+    def sync(self, players: Iterable['Player'],
+             max_workers: int = 8) -> Dict['Player', List[Game]]:
+        """Get the new games of many players concurrently.
+
+        The requests are made with background priority. Players whose
+        games could not be fetched are left out (and synced next time)."""
+        def run(player):
+            try:
+                with priority(BACKGROUND):
+                    return player, self.new_games(player)
+            except Exception as e:
+                logger.info("Failed to sync games of %s: %r", player.key, e)
+                return player, None
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return {player: games
+                    for player, games in pool.map(run, players)
+                    if games is not None}
+
+
+from .player import Player
@@ -0,0 +1,206 @@
+"""Counters and histograms of what the client does, for Prometheus.
+
+Metrics are kept in process and rendered in the Prometheus text format by
+`exposition()`, eg. to be served on a `/metrics` route. Values that are
+cheap to read when asked for (such as the sizes of the caches) are given by
+gauges calling a function at exposition time instead of being updated.
+"""
+from typing import Callable, Dict, Iterator, Sequence, Tuple
+import threading
+import bisect
+
+_metrics = []
+_registry_lock = threading.Lock()
+
+Labels = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str],
+                   extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"'
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"') \
+        .replace('\n', r'\n')
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    """A named family of values, one per combination of label values."""
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str,
+                 labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _metrics.append(self)
+
+    def _lines(self) -> Iterator[str]:
+        raise NotImplementedError()
+
+    def exposition(self) -> str:
+        return '\n'.join([f"# HELP {self.name} {self.documentation}",
+                          f"# TYPE {self.name} {self.kind}",
+                          *self._lines()])
+
+
+class Counter(Metric):
+    """A count that only goes up, eg. of requests made."""
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str,
+                 labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values = {}  # type: Dict[Labels, float]
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        with self._lock:
+            self._values[label_values] = \
+                self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values) -> float:
+        return self._values.get(label_values, 0)
+
+    def total(self) -> float:
+        """The sum of the values for all label values."""
+        with self._lock:
+            return sum(self._values.values())
+
+    def _lines(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield (f"{self.name}{_format_labels(self.labels, label_values)} "
+                   f"{_format_value(value)}")
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, float('inf'))
+
+
+class Histogram(Metric):
+    """The distribution of observed values, eg. of latencies in seconds."""
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str,
+                 labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        if self.buckets[-1] != float('inf'):
+            self.buckets += (float('inf'),)
+        # Per label values: counts per bucket (not cumulative), and the sum
+        self._values = {}  # type: Dict[Labels, Tuple[list, list]]
+
+    def observe(self, value: float, *label_values) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(
+                label_values, ([0] * len(self.buckets), [0.0]))
+            counts[i] += 1
+            total[0] += value
+
+    def _lines(self):
+        with self._lock:
+            values = sorted((label_values, (list(counts), total[0]))
+                            for label_values, (counts, total)
+                            in self._values.items())
+        for label_values, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                yield (f"{self.name}_bucket"
+                       f"{_format_labels(self.labels, label_values, le)} "
+                       f"{cumulative}")
+            labels = _format_labels(self.labels, label_values)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Gauge(Metric):
+    """A value read when exposed, from a function giving it per labels.
+
+    Counts kept elsewhere (eg., in the stats of a cache) can be exposed the
+    same way with `kind` 'counter'."""
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str,
+                 labels: Sequence[str] = (),
+                 read: Callable[[], Dict[Labels, float]] = dict,
+                 kind: str = 'gauge'):
+        super().__init__(name, documentation, labels)
+        self.read = read
+        self.kind = kind
+
+    def _lines(self):
+        for label_values, value in sorted(self.read().items()):
+            yield (f"{self.name}{_format_labels(self.labels, label_values)} "
+                   f"{_format_value(value)}")
+
+
+def exposition() -> str:
+    """All metrics, in the Prometheus text format."""
+    with _registry_lock:
+        metrics = list(_metrics)
+    return '\n'.join(metric.exposition() for metric in metrics) + '\n'
+
+
+def endpoint_family(endpoint: str) -> str:
+    """The endpoint with its key and numbers replaced by placeholders.
+
+    Eg., 'player/{key}/games/{n}/{n}' for 'player/hikaru/games/2020/01', so
+    that metrics are kept per kind of endpoint rather than per entity."""
+    parts = endpoint.split('/')
+    if len(parts) > 1:
+        parts[1] = '{key}'
+    return '/'.join('{n}' if part.isdigit() else part for part in parts)
+
+
+# Upstream calls (per endpoint family)
+
+UPSTREAM_REQUESTS = Counter(
+    'chesscom_upstream_requests_total',
+    "Requests made to the API, by endpoint family and status code "
+    "(or 'error' for failed connections)", ('endpoint', 'status'))
+
+UPSTREAM_SECONDS = Histogram(
+    'chesscom_upstream_request_seconds',
+    "Time taken by requests to the API, by endpoint family", ('endpoint',))
+
+UPSTREAM_BYTES = Counter(
+    'chesscom_upstream_response_bytes_total',
+    "Bytes of response bodies received from the API (as sent), by endpoint "
+    "family", ('endpoint',))
+
+UPSTREAM_RETRIES = Counter(
+    'chesscom_upstream_retries_total',
+    "Requests to the API retried, by endpoint family", ('endpoint',))
+
+# Caching
+
+REQUESTED = Counter(
+    'chesscom_requested_total',
+    "Reads of entity properties, by entity type, part and outcome: 'hit' "
+    "(fresh), 'stale' (served while refreshed), 'expired' (refetched), "
+    "'revalidated' (refetched before expiring, on demand), 'miss' (fetched "
+    "for the first time) or 'negative' (known to be missing)",
+    ('entity', 'part', 'outcome'))
+
+RESPONSE_CACHE = Counter(
+    'chesscom_response_cache_total',
+    "Lookups in the response cache, by endpoint family and outcome: 'hit' "
+    "(fresh), 'stale' (revalidated) or 'miss'", ('endpoint', 'outcome'))
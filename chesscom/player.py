@@ -1,9 +1,10 @@
-from typing import Optional, Iterable, List, Dict
+from typing import Optional, Iterable, Iterator, List, Dict, Tuple, Union
 from enum import Enum, unique
 from datetime import datetime
 
 from .rest import request_json, key_from_url
-from .cache import cached, Requested
+from .cache import cached, Requested, Field
+from .entity import Entity
 
 
 @unique
@@ -31,6 +32,8 @@ class Status(Enum):
 
 
 class ClubActivity(object):
+    __slots__ = ('club', 'joined', 'last_activity')
+
     club: 'Club'
     joined: datetime
     last_activity: datetime
@@ -42,6 +45,10 @@ class ClubActivity(object):
 
 
 class RatingStats(object):
+    __slots__ = ('category', 'date', 'rating', 'rd', 'best_date',
+                 'best_rating', 'wins', 'losses', 'draws', 'time_per_move',
+                 'timeout_percent')
+
     # Current stats
     category: str
     date: datetime
@@ -76,107 +83,86 @@ class RatingStats(object):
 
 
 @cached
-class Player(object):
-    # Profile properties
-    url: Requested[str]
-    username: Requested[str]
-    original_username: Requested[str]
-    player_id: Requested[int]
-    title: Requested[Optional[Title]]
-    status: Requested[Status]
-    name: Requested[Optional[str]]
-    avatar: Requested[Optional[str]]
-    location: Requested[Optional[str]]
-    country: Requested['Country']
-    joined: Requested[datetime]
-    last_online: Requested[datetime]
-    followers: Requested[int]
-    is_streamer: Requested[bool]
-    # TODO: Report that `twitch_url` is optional
-    twitch_url: Requested[Optional[str]]
-
-    # Club properties
-    clubs: Requested[List['Club']]
-    _activity: Requested[Dict[str, ClubActivity]]
-
-    # Stats properties
-    _stats: Requested[Dict[str, RatingStats]]
+class Player(Entity):
+    __slots__ = ()
+
+    _endpoints = {
+        'profile': "player/{key}",
+        'clubs': "player/{key}/clubs",
+        'stats': "player/{key}/stats",
+        'online': "player/{key}/is-online",
+        'archives': "player/{key}/games/archives",
+    }
+    _ttls = {'online': 300}
+    _graces = {'online': 0}
 
-    # Online properties
-    is_online: Requested[bool]
-
-    def __init__(self, key):
-        self.key = key
-
-        def profile_request():
-            self._profile_request()
-
-        self.url = Requested(profile_request)
-        """URL of the Player's profile page."""
-
-        self.username = Requested(profile_request)
-        """Username of this player."""
-
-        self.original_username = Requested(profile_request)
-        """Capitalization-preserved username of this player."""
+    # Profile properties
+    url: Requested[str] = Field('profile')
+    """URL of the Player's profile page."""
 
-        self.player_id = Requested(profile_request)
-        """User ID."""
+    username: Requested[str] = Field('profile')
+    """Username of this player."""
 
-        self.title = Requested(profile_request)
-        """Optional title."""
+    original_username: Requested[str] = Field('profile')
+    """Capitalization-preserved username of this player."""
 
-        self.status = Requested(profile_request)
-        """Status."""
+    player_id: Requested[int] = Field('profile')
+    """User ID."""
 
-        self.name = Requested(profile_request)
-        """Optional name."""
+    title: Requested[Optional[Title]] = Field('profile')
+    """Optional title."""
 
-        self.avatar = Requested(profile_request)
-        """Optional URL to avatar (200x200 image)."""
+    status: Requested[Status] = Field('profile')
+    """Status."""
 
-        self.location = Requested(profile_request)
-        """Optional location."""
+    name: Requested[Optional[str]] = Field('profile')
+    """Optional name."""
 
-        self.country = Requested(profile_request)
-        """Country of the player"""
+    avatar: Requested[Optional[str]] = Field('profile')
+    """Optional URL to avatar (200x200 image)."""
 
-        self.joined = Requested(profile_request)
-        """Timestamp of registration on Chess.com."""
+    location: Requested[Optional[str]] = Field('profile')
+    """Optional location."""
 
-        self.last_online = Requested(profile_request)
-        """Timestamp of the most recent login."""
+    country: Requested['Country'] = Field('profile')
+    """Country of the player"""
 
-        self.followers = Requested(profile_request)
-        """The number of players tracking this player's activity."""
+    joined: Requested[datetime] = Field('profile')
+    """Timestamp of registration on Chess.com."""
 
-        self.is_streamer = Requested(profile_request)
-        """If the member is a Chess.com streamer."""
+    last_online: Requested[datetime] = Field('profile')
+    """Timestamp of the most recent login."""
 
-        self.twitch_url = Requested(profile_request)
-        """Twitch.tv URL."""
+    followers: Requested[int] = Field('profile')
+    """The number of players tracking this player's activity."""
 
-        def club_request():
-            self._club_request()
+    is_streamer: Requested[bool] = Field('profile')
+    """If the member is a Chess.com streamer."""
 
-        self.clubs = Requested(club_request)
-        """List of clubs the player is a member of."""
+    # TODO: Report that `twitch_url` is optional
+    twitch_url: Requested[Optional[str]] = Field('profile')
+    """Twitch.tv URL."""
 
-        self._activity = Requested(club_request)
+    # Club properties
+    clubs: Requested[List['Club']] = Field('clubs')
+    """List of clubs the player is a member of."""
 
-        def stats_request():
-            self._stats_request()
+    _activity: Requested[Dict[str, ClubActivity]] = Field('clubs')
 
-        self._stats = Requested(stats_request)
+    # Stats properties
+    _stats: Requested[Dict[str, RatingStats]] = Field('stats')
 
-        def online_request():
-            self._online_request()
+    # Online properties
+    is_online: Requested[bool] = Field('online')
 
-        self.is_online = Requested(online_request, ttl=300)
+    # Game properties
+    archives: Requested[List[Tuple[int, int]]] = Field('archives')
+    """The (year, month) of each month the player finished games in."""
 
     def _club_request(self):
-        d = request_json(f"player/{self.key}/clubs")
+        self._request('clubs')
 
+    def _receive_clubs(self, d):
         def get_activity(d):
             return ClubActivity(club=Club(key_from_url(d['url'])),
                                 joined=datetime.fromtimestamp(d['joined']),
@@ -184,8 +170,9 @@ class Player(object):
                                     d['last_activity']))
 
         activity = list(map(get_activity, d['clubs']))
-        self._activity.receive({a.club.key: a for a in activity})
-        self.clubs.receive(list(map(lambda a: a.club, activity)))
+        self._store('clubs',
+                    clubs=list(map(lambda a: a.club, activity)),
+                    _activity={a.club.key: a for a in activity})
 
     def joined_club(self, key: str) -> Optional[datetime]:
         """Timestamp of joining club."""
@@ -204,30 +191,39 @@ class Player(object):
             return None
 
     def _profile_request(self):
-        d = request_json(f"player/{self.key}")
-        self.url.receive(d['url'])
-        self.username.receive(d['username'])
-        self.original_username.receive(key_from_url(d['url']))
-        self.player_id.receive(d['player_id'])
-        self.title.receive(d.get('title', None))
-        self.status.receive(Status(d['status']))
-        self.name.receive(d.get('name', None))
-        self.avatar.receive(d.get('avatar', None))
-        self.location.receive(d.get('location', None))
-        self.country.receive(Country(key_from_url(d['country'])))
-        # TODO: Investigate time zone
-        self.joined.receive(datetime.fromtimestamp(d['joined']))
-        self.last_online.receive(datetime.fromtimestamp(d['last_online']))
-        self.followers.receive(d['followers'])
-        self.is_streamer.receive(d['is_streamer'])
-        self.twitch_url.receive(d.get('twitch_url', None))
+        self._request('profile')
+
+    def _receive_profile(self, d):
+        self._store('profile',
+                    url=d['url'],
+                    username=d['username'],
+                    original_username=key_from_url(d['url']),
+                    player_id=d['player_id'],
+                    title=d.get('title', None),
+                    status=Status(d['status']),
+                    name=d.get('name', None),
+                    avatar=d.get('avatar', None),
+                    location=d.get('location', None),
+                    country=Country(key_from_url(d['country'])),
+                    # TODO: Investigate time zone
+                    joined=datetime.fromtimestamp(d['joined']),
+                    last_online=datetime.fromtimestamp(d['last_online']),
+                    followers=d['followers'],
+                    is_streamer=d['is_streamer'],
+                    twitch_url=d.get('twitch_url', None))
 
     def _stats_request(self):
-        d = request_json(f"player/{self.key}/stats")
+        self._request('stats')
+
+    def _receive_stats(self, d):
         categories = {}
-        for category in d.keys():
-            categories[category] = RatingStats(category, d[category])
-        self._stats.receive(categories)
+        for category, stats in d.items():
+            # Skip eg. 'fide', 'tactics' and 'puzzle_rush', which are not
+            # shaped like the ratings of games
+            if isinstance(stats, dict) and 'last' in stats and \
+                    'record' in stats:
+                categories[category] = RatingStats(category, stats)
+        self._store('stats', _stats=categories)
 
     def rating(self, category: str) -> Optional[int]:
         stats = self._stats()
@@ -237,13 +233,55 @@ class Player(object):
         return stats[category].rating
 
     def _online_request(self):
-        d = request_json(f"player/{self.key}/is-online")
-        self.is_online.receive(d['online'])
+        self._request('online')
+
+    def _receive_online(self, d):
+        self._store('online', is_online=d['online'])
+
+    def _receive_archives(self, d):
+        def get_month(url):
+            path = url.rstrip('/').split('/')
+            return int(path[-2]), int(path[-1])
+
+        self._store('archives', archives=list(map(get_month, d['archives'])))
+
+    def games(self, year: int, month: int) -> List['Game']:
+        """Games finished in the given month.
+
+        Months that have ended are kept in memory (the last read, see
+        `game.set_settled_months`), and for good by the response cache if
+        set (see `set_response_cache`); the current one as long as the API
+        says."""
+        return request_games(self.key, year, month)
+
+    def iter_games(self,
+                   since: Optional[datetime] = None) -> Iterator['Game']:
+        """Iterate over the games of the player, oldest first.
+
+        Only one month of games is fetched (and kept in memory) at a time.
+        With `since`, only games finished after it are given (and only the
+        months from then on fetched)."""
+        first = month_of(since.timestamp()) if since else (0, 0)
+        for year, month in self.archives():
+            if (year, month) < first:
+                continue
+            for game in self.games(year, month):
+                if since is None or game.end_time > since:
+                    yield game
+
+    def pgn(self, year: int, month: int) -> str:
+        """The games finished in the given month, in PGN."""
+        return '\n\n'.join(game.pgn for game in self.games(year, month)
+                            if game.pgn)
+
 
+def titled_players(title: Title,
+                   keys: bool = False) -> Iterable[Union[Player, str]]:
+    """Players with the given title.
 
-def titled_players(title: Title) -> Iterable[Player]:
+    With `keys` set, a list of their usernames is given instead."""
     d = request_json(f"titled/{title.value}")
-    return map(Player, d['players'])
+    return d['players'] if keys else map(Player, d['players'])
 
 
 def lookup_player(key: str) -> Player:
@@ -252,3 +290,4 @@ def lookup_player(key: str) -> Player:
 
 from .country import Country
 from .club import Club
+from .game import Game, request_games, month_of
@@ -0,0 +1,102 @@
+"""Ratings of many players as columnar arrays (requires `numpy`).
+
+Rather than reading the ratings of players one at a time, eg.
+
+    [member.rating('chess_blitz') for member in club.members()]
+
+their stats are fetched concurrently, and the ratings, RDs and records are
+collected straight into typed arrays, eg.
+
+    columns = rating_columns(club.members(), ['chess_blitz', 'chess_rapid'])
+    columns.rating[0][~columns.missing[0]].mean()
+
+`ratings_frame` makes a `pandas` DataFrame of them (requires `pandas`).
+"""
+from typing import Iterable, Sequence, Dict, List
+
+import numpy as np
+
+from .entity import prefetch
+
+CATEGORIES = ('chess_bullet', 'chess_blitz', 'chess_rapid', 'chess_daily')
+
+FIELDS = ('rating', 'rd', 'wins', 'losses', 'draws')
+
+
+class RatingColumns(object):
+    """The stats of players in some categories, as arrays.
+
+    Each of `rating`, `rd`, `wins`, `losses` and `draws` is an int32 array
+    with a row per category and a column per player (in the order of
+    `categories` and `keys`). `missing` is a boolean array of the same shape
+    telling which players have no stats in a category (or whose stats could
+    not be fetched); their values are zero.
+    """
+    keys: List[str]
+    categories: Sequence[str]
+    rating: np.ndarray
+    rd: np.ndarray
+    wins: np.ndarray
+    losses: np.ndarray
+    draws: np.ndarray
+    missing: np.ndarray
+
+    def __init__(self, keys: List[str], categories: Sequence[str]):
+        self.keys = keys
+        self.categories = tuple(categories)
+        shape = (len(self.categories), len(keys))
+        for field in FIELDS:
+            setattr(self, field, np.zeros(shape, dtype=np.int32))
+        self.missing = np.ones(shape, dtype=bool)
+
+    def __len__(self):
+        return len(self.keys)
+
+
+def rating_columns(players: Iterable['Player'],
+                   categories: Sequence[str] = CATEGORIES,
+                   max_workers: int = 8) -> RatingColumns:
+    """Fetch the stats of players concurrently, and collect them as arrays.
+
+    Stats are requested from a pool of `max_workers` threads (see
+    `prefetch`), so the time taken grows with the number of players divided
+    by the size of the pool."""
+    players = list(players)
+    errors = prefetch(players, parts=['stats'], max_workers=max_workers)
+
+    columns = RatingColumns([player.key for player in players], categories)
+    rows = {category: i for i, category in enumerate(columns.categories)}
+    for j, player in enumerate(players):
+        if player in errors:
+            continue
+        for category, stats in player._stats().items():
+            i = rows.get(category)
+            if i is None:
+                continue
+            columns.rating[i, j] = stats.rating
+            columns.rd[i, j] = stats.rd
+            columns.wins[i, j] = stats.wins
+            columns.losses[i, j] = stats.losses
+            columns.draws[i, j] = stats.draws
+            columns.missing[i, j] = False
+    return columns
+
+
+def ratings_frame(players: Iterable['Player'],
+                  categories: Sequence[str] = CATEGORIES,
+                  max_workers: int = 8) -> 'pandas.DataFrame':
+    """The stats of players as a DataFrame (requires `pandas`).
+
+    Indexed by username, with a column for each (field, category), eg.
+    `frame['rating']['chess_blitz']`, of the nullable Int32 type (missing
+    stats are NA)."""
+    import pandas as pd
+
+    columns = rating_columns(players, categories, max_workers)
+    data = {}  # type: Dict[tuple, pd.arrays.IntegerArray]
+    for field in FIELDS:
+        values = getattr(columns, field)
+        for i, category in enumerate(columns.categories):
+            data[(field, category)] = pd.arrays.IntegerArray(
+                values[i], columns.missing[i])
+    return pd.DataFrame(data, index=pd.Index(columns.keys, name='username'))
@@ -1,6 +1,21 @@
 import requests
+from requests.adapters import HTTPAdapter
 from urllib.parse import urlparse
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from typing import Optional, Tuple, List, Dict, Any
+from contextlib import contextmanager, asynccontextmanager
+from contextvars import ContextVar
 import posixpath
+import asyncio
+import itertools
+import threading
+import random
+import heapq
+import time
+
+from .metrics import Gauge, endpoint_family, UPSTREAM_REQUESTS, \
+    UPSTREAM_SECONDS, UPSTREAM_BYTES, UPSTREAM_RETRIES, RESPONSE_CACHE
 
 import logging
 
@@ -9,19 +24,684 @@ logger = logging.getLogger(__name__)
 BASE_URL = "https://api.chess.com/pub/"
 
 
+class APIError(Exception):
+    """Raised when an endpoint does not return a usable response."""
+
+    def __init__(self, endpoint: str, status_code: Optional[int] = None):
+        super().__init__(f"{endpoint}: status {status_code}")
+        self.endpoint = endpoint
+        self.status_code = status_code
+
+
+class NotFound(APIError):
+    """The entity does not exist (404), eg. a renamed or closed account."""
+
+
+class Gone(APIError):
+    """The entity no longer exists (410)."""
+
+
+class RateLimited(APIError):
+    """The API kept answering 429, even after backing off."""
+
+
+class UpstreamError(APIError):
+    """The API failed (eg. with a 5xx) or gave an unexpected response."""
+
+
+_ERRORS = {404: NotFound, 410: Gone, 429: RateLimited}
+
+
+def api_error(endpoint: str, status_code: Optional[int] = None) -> APIError:
+    """The error to raise for an unusable response to an endpoint."""
+    return _ERRORS.get(status_code, UpstreamError)(endpoint, status_code)
+
+
+class Retrying(object):
+    """Retry policy shared by the blocking and the asyncio transports."""
+
+    RETRY_STATUS = frozenset([429, 500, 502, 503, 504])
+
+    def __init__(self, retries=4, backoff=0.5, max_backoff=30.0):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def _backoff(self, attempt: int) -> float:
+        # "Full jitter": spreads out retries from concurrent callers
+        return random.uniform(0, min(self.max_backoff,
+                                     self.backoff * 2 ** attempt))
+
+    def _retry_after(self, headers) -> Optional[float]:
+        value = headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            seconds = float(value)
+        except ValueError:
+            try:
+                when = parsedate_to_datetime(value)
+            except (TypeError, ValueError):
+                return None
+            seconds = (when - datetime.now(timezone.utc)).total_seconds()
+        return min(self.max_backoff, max(0.0, seconds))
+
+
+INTERACTIVE = 0
+"""Priority of requests that someone is waiting for."""
+
+BACKGROUND = 1
+"""Priority of batch and prefetch requests."""
+
+_PRIORITY_NAMES = {INTERACTIVE: 'interactive', BACKGROUND: 'background'}
+
+_priority = ContextVar('priority', default=INTERACTIVE)
+
+
+@contextmanager
+def priority(level: int):
+    """Make the requests in this context with the given priority."""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class Scheduler(object):
+    """Paces the requests made to the API.
+
+    Requests wait for a slot, given out in order of priority (and then of
+    arrival): there are at most `max_in_flight` requests at a time, and, if
+    `rate` is set, they are started at most `rate` per second on average
+    (with bursts of up to `burst`). A 429 from the API pauses everything for
+    the requested time and halves the rate and concurrency, which then
+    recover gradually with each successful response.
+
+    Threads wait for a slot with `slot`, and coroutines with `async_slot`,
+    in the same queue.
+    """
+
+    def __init__(self, rate: Optional[float] = None,
+                 burst: Optional[int] = None, max_in_flight: int = 8,
+                 recovery: float = 0.05):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate or 1))
+        self.max_in_flight = max_in_flight
+        self.recovery = recovery
+        self.throttled = 0
+        self._cond = threading.Condition()
+        self._queue = []  # type: List[Tuple[int, int]]
+        self._arrivals = itertools.count()
+        self._in_flight = 0
+        self._tokens = float(self.burst)
+        self._refilled = time.monotonic()
+        self._factor = 1.0
+        self._paused_until = 0.0
+        # Number, total and maximum of waits, per priority
+        self._waits = {}  # type: Dict[int, List[float]]
+        # Coroutines waiting for a slot: (event loop, future to wake)
+        self._waiters = []  # type: List[Tuple[Any, asyncio.Future]]
+
+    @contextmanager
+    def slot(self, level: Optional[int] = None):
+        """Wait for a slot to make a request in."""
+        if level is None:
+            level = _priority.get()
+        start = time.monotonic()
+        with self._cond:
+            entry = (level, next(self._arrivals))
+            heapq.heappush(self._queue, entry)
+            while True:
+                delay = self._delay(entry)
+                if delay == 0:
+                    break
+                self._cond.wait(delay)
+            self._take(level, start)
+        try:
+            yield
+        finally:
+            self._release()
+
+    @asynccontextmanager
+    async def async_slot(self, level: Optional[int] = None):
+        """Wait for a slot on the event loop, like `slot`."""
+        if level is None:
+            level = _priority.get()
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        with self._cond:
+            entry = (level, next(self._arrivals))
+            heapq.heappush(self._queue, entry)
+        try:
+            while True:
+                with self._cond:
+                    delay = self._delay(entry)
+                    if delay == 0:
+                        self._take(level, start)
+                        break
+                    waiter = loop.create_future()
+                    self._waiters.append((loop, waiter))
+                await asyncio.wait([waiter], timeout=delay)
+        except BaseException:
+            # Cancelled while queued
+            with self._cond:
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+                self._notify()
+            raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _take(self, level: int, start: float) -> None:
+        """Take the slot of the first in line (holding the lock)."""
+        heapq.heappop(self._queue)
+        self._in_flight += 1
+        if self.rate:
+            self._tokens -= 1
+        wait = time.monotonic() - start
+        waits = self._waits.setdefault(level, [0, 0.0, 0.0])
+        waits[0] += 1
+        waits[1] += wait
+        waits[2] = max(waits[2], wait)
+        # The next in line may be able to go as well
+        self._notify()
+
+    def _release(self) -> None:
+        with self._cond:
+            self._in_flight -= 1
+            self._notify()
+
+    def _notify(self) -> None:
+        """Wake up the threads and coroutines waiting for a slot (holding
+        the lock)."""
+        self._cond.notify_all()
+        for loop, waiter in self._waiters:
+            loop.call_soon_threadsafe(_wake, waiter)
+        self._waiters = []
+
+    def _delay(self, entry) -> Optional[float]:
+        """Seconds to wait before a queued request may go (None: unknown)."""
+        if self._queue[0] != entry:
+            return None
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self._in_flight >= max(1, int(self.max_in_flight * self._factor)):
+            return None
+        if self.rate:
+            rate = self.rate * self._factor
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._refilled) * rate)
+            self._refilled = now
+            if self._tokens < 1:
+                return (1 - self._tokens) / rate
+        return 0
+
+    def throttle(self, delay: float) -> None:
+        """Back off after the API asked us to slow down."""
+        with self._cond:
+            self.throttled += 1
+            self._factor = max(0.1, self._factor / 2)
+            self._paused_until = max(self._paused_until,
+                                     time.monotonic() + delay)
+            logger.warning("Throttled by the API; pausing for %.2fs", delay)
+
+    def succeeded(self) -> None:
+        """Recover from throttling after a successful response."""
+        if self._factor < 1.0:
+            with self._cond:
+                self._factor = min(1.0, self._factor + self.recovery)
+
+    def stats(self) -> Dict[str, Any]:
+        """Current queue depths and load, and wait times so far."""
+        with self._cond:
+            queued = {name: 0 for name in _PRIORITY_NAMES.values()}
+            for level, _ in self._queue:
+                name = _PRIORITY_NAMES.get(level, str(level))
+                queued[name] = queued.get(name, 0) + 1
+            waits = {_PRIORITY_NAMES.get(level, str(level)):
+                     {'count': count, 'total': total,
+                      'mean': total / count if count else 0.0, 'max': max_}
+                     for level, (count, total, max_) in self._waits.items()}
+            return {'queued': queued,
+                    'in_flight': self._in_flight,
+                    'max_in_flight': max(1, int(self.max_in_flight *
+                                                self._factor)),
+                    'rate': self.rate and self.rate * self._factor,
+                    'throttled': self.throttled,
+                    'waits': waits}
+
+
+def _wake(waiter: asyncio.Future) -> None:
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+_scheduler = None  # type: Optional[Scheduler]
+
+
+def get_scheduler() -> Scheduler:
+    """Return the scheduler shared by all transports, creating it if needed."""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = Scheduler()
+    return _scheduler
+
+
+def set_scheduler(scheduler: Optional[Scheduler]) -> None:
+    """Replace the shared scheduler (None to reset)."""
+    global _scheduler
+    _scheduler = scheduler
+
+
+Gauge('chesscom_scheduler_queued',
+      "Requests waiting for a slot of the shared scheduler, by priority",
+      ('priority',),
+      lambda: {(name,): count for name, count
+               in get_scheduler().stats()['queued'].items()})
+Gauge('chesscom_scheduler_in_flight',
+      "Requests in flight through the shared scheduler",
+      read=lambda: {(): get_scheduler().stats()['in_flight']})
+Gauge('chesscom_scheduler_max_in_flight',
+      "Requests allowed in flight at once (lowered while throttled)",
+      read=lambda: {(): get_scheduler().stats()['max_in_flight']})
+Gauge('chesscom_scheduler_throttled_total',
+      "Responses that made the shared scheduler back off",
+      read=lambda: {(): get_scheduler().stats()['throttled']},
+      kind='counter')
+
+
+class Transport(Retrying):
+    """Performs GET requests against the API over a pooled session.
+
+    Connections are kept alive and shared between calls (and threads), and
+    responses are requested gzipped. Transient failures — connection errors,
+    timeouts, 5xx responses, and 429 (honoring `Retry-After`) — are retried
+    with jittered exponential backoff.
+
+    Requests are paced by the given `Scheduler`, or by the shared one (see
+    `set_scheduler`) if none is given.
+
+    Anything with a compatible `get(endpoint, headers=None, stream=False)`
+    method returning a `requests.Response`-like object can be installed with
+    `set_transport`.
+    """
+
+    def __init__(self, base_url=BASE_URL, pool_size=16, timeout=30.0,
+                 scheduler: Optional[Scheduler] = None, **retrying):
+        super().__init__(**retrying)
+        self.base_url = base_url
+        self.timeout = timeout
+        self.scheduler = scheduler
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Accept-Encoding': 'gzip, deflate',
+                                     'Connection': 'keep-alive'})
+
+    def get(self, endpoint: str, headers=None,
+            stream=False) -> requests.Response:
+        """Get the endpoint, retrying transient failures.
+
+        With `stream` set, the body is left to be read as it arrives."""
+        scheduler = self.scheduler or get_scheduler()
+        family = endpoint_family(endpoint)
+        attempt = 0
+        while True:
+            try:
+                with scheduler.slot():
+                    start = time.perf_counter()
+                    r = self.session.get(self.base_url + endpoint,
+                                         headers=headers, stream=stream,
+                                         timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                UPSTREAM_REQUESTS.inc(family, 'error')
+                if attempt >= self.retries:
+                    raise
+                delay = self._backoff(attempt)
+                logger.info("Retrying %s in %.2fs after %r", endpoint, delay,
+                            e)
+            else:
+                _count_response(family, r.status_code, r.headers,
+                                time.perf_counter() - start,
+                                None if stream else r.content)
+                delay = self._retry_after(r.headers)
+                if delay is None:
+                    delay = self._backoff(attempt)
+                if r.status_code == 429:
+                    # Pauses all requests, including the retry below
+                    scheduler.throttle(delay)
+                    delay = 0
+                else:
+                    scheduler.succeeded()
+                if r.status_code not in self.RETRY_STATUS or \
+                        attempt >= self.retries:
+                    return r
+                r.close()
+                logger.info("Retrying %s in %.2fs after status %d", endpoint,
+                            delay, r.status_code)
+            UPSTREAM_RETRIES.inc(family)
+            time.sleep(delay)
+            attempt += 1
+
+
+def _count_response(family: str, status: int, headers, seconds: float,
+                    body: Optional[bytes] = None) -> None:
+    """Count a response from the API in the metrics."""
+    UPSTREAM_REQUESTS.inc(family, str(status))
+    UPSTREAM_SECONDS.observe(seconds, family)
+    length = headers.get('Content-Length')
+    if length is not None and length.isdigit():
+        UPSTREAM_BYTES.inc(family, amount=int(length))
+    elif body is not None:
+        UPSTREAM_BYTES.inc(family, amount=len(body))
+
+
+_transport = None  # type: Optional[Transport]
+
+
+def get_transport() -> Transport:
+    """Return the transport used by `request_json`, creating it if needed."""
+    global _transport
+    if _transport is None:
+        _transport = Transport()
+    return _transport
+
+
+def set_transport(transport: Optional[Transport]) -> None:
+    """Replace the transport used by `request_json` (None to reset)."""
+    global _transport
+    _transport = transport
+
+
 def request_json(endpoint: str) -> dict:
     """Call the given endpoint and return the response as a dict.
 
-    In case of error, raises an unhelpful exception for now."""
-    r = requests.get(BASE_URL + endpoint)
+    Raises `APIError` if no successful response could be had."""
+    replayed = replayed_response(endpoint)
+    if replayed is not None:
+        return replayed.data
     logger.debug("Getting endpoint: %s", endpoint)
-    if r.status_code is not 200:
-        raise Exception()
+    r = get_transport().get(endpoint)
+    if r.status_code != 200:
+        record_response(endpoint, r.status_code, None)
+        raise api_error(endpoint, r.status_code)
     d = r.json()
     assert type(d) is dict
+    record_response(endpoint, 200, d)
+    ttl = max_age(r.headers)
+    used_until(time.time() + (DEFAULT_TTL if ttl is None else ttl))
     return d
 
 
+DEFAULT_TTL = 7200
+"""Seconds to keep responses for which the API does not give a max-age."""
+
+
+class Fetched(object):
+    """A response to an endpoint, along with how long it may be cached.
+
+    `data` is None for a response that was not modified since the one that
+    the given validators came from (ie., a 304)."""
+
+    def __init__(self, data: Optional[dict], received: float, ttl: float,
+                 etag: Optional[str] = None,
+                 last_modified: Optional[str] = None):
+        self.data = data
+        self.received = received
+        self.ttl = ttl
+        self.etag = etag
+        self.last_modified = last_modified
+
+    @property
+    def expires(self) -> float:
+        return self.received + self.ttl
+
+    @property
+    def validators(self) -> Tuple[Optional[str], Optional[str]]:
+        return self.etag, self.last_modified
+
+    def is_fresh(self) -> bool:
+        return time.time() < self.expires
+
+
+class Expiry(object):
+    """The earliest expiry of the data used in a context."""
+
+    def __init__(self):
+        self.expires = float('inf')
+
+    def used(self, expires: float) -> None:
+        self.expires = min(self.expires, expires)
+
+
+_expiry = ContextVar('expiry', default=None)
+
+
+@contextmanager
+def tracking_expiry():
+    """Track when the data used in this context expires.
+
+    Gives an `Expiry`, whose `expires` is the earliest expiry (as a
+    timestamp) of the properties read and the responses received in the
+    context, eg. to know how long something computed from them holds."""
+    expiry = Expiry()
+    token = _expiry.set(expiry)
+    try:
+        yield expiry
+    finally:
+        _expiry.reset(token)
+
+
+def used_until(expires: float) -> None:
+    """Note that data used in this context expires at the given time."""
+    expiry = _expiry.get()
+    if expiry is not None:
+        expiry.used(expires)
+
+
+def max_age(headers) -> Optional[float]:
+    """The max-age of a response per its Cache-Control header, if any."""
+    for directive in headers.get('Cache-Control', '').split(','):
+        name, _, value = directive.strip().partition('=')
+        name = name.lower()
+        if name in ('no-cache', 'no-store'):
+            return 0.0
+        if name in ('max-age', 's-maxage'):
+            try:
+                return max(0.0, float(value.strip('"')))
+            except ValueError:
+                pass
+    return None
+
+
+_response_cache = None
+
+
+def set_response_cache(cache) -> None:
+    """Keep responses in the given cache, eg. a `DiskCache` (None for none).
+
+    A cache has `get(endpoint)` returning the last `Fetched` response
+    (expired or not) and `put(endpoint, fetched)`. A cache shared with other
+    processes may also have `acquire(endpoint, ttl)` and `release(endpoint,
+    token)` (see `fetching`)."""
+    global _response_cache
+    _response_cache = cache
+
+
+def get_response_cache():
+    """The cache responses are kept in, if any."""
+    return _response_cache
+
+
+_snapshot = None
+
+
+def set_snapshot(snapshot) -> None:
+    """Record the responses read into a snapshot, or serve them from one
+    (None for neither); see `chesscom.snapshot`.
+
+    A snapshot being recorded has `record(endpoint, status, data)`, and one
+    being replayed `replay(endpoint)`, giving the `Fetched` response
+    recorded or raising an `APIError`."""
+    global _snapshot
+    _snapshot = snapshot
+
+
+def replayed_response(endpoint: str) -> Optional[Fetched]:
+    """The response to an endpoint in the snapshot being replayed, if any.
+
+    Raises the `APIError` recorded, or one for an endpoint not recorded."""
+    replay = getattr(_snapshot, 'replay', None)
+    return replay(endpoint) if replay is not None else None
+
+
+def is_recording() -> bool:
+    return hasattr(_snapshot, 'record')
+
+
+def record_response(endpoint: str, status: int,
+                    data: Optional[dict]) -> None:
+    """Note a response in the snapshot being recorded, if any."""
+    record = getattr(_snapshot, 'record', None)
+    if record is not None:
+        record(endpoint, status, data)
+
+
+LOCK_TIMEOUT = 30.0
+"""Seconds to wait for another process fetching an endpoint, at most."""
+
+LOCK_POLL = 0.05
+
+
+@contextmanager
+def fetching(endpoint: str):
+    """Hold the lock of the response cache on fetching an endpoint, if any.
+
+    Caches shared between processes can lock endpoints: `acquire(endpoint,
+    ttl)` gives a token (or None if another process holds the lock), which
+    is passed to `release` when done. Only one process at a time then
+    fetches an endpoint, and the others use its response. Yields whether
+    another process held the lock (and may have fetched the endpoint)."""
+    cache = _response_cache
+    acquire = getattr(cache, 'acquire', None)
+    if acquire is None:
+        yield False
+        return
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    token = acquire(endpoint, LOCK_TIMEOUT)
+    waited = token is None
+    while token is None and time.monotonic() < deadline:
+        time.sleep(LOCK_POLL)
+        token = acquire(endpoint, LOCK_TIMEOUT)
+    try:
+        yield waited
+    finally:
+        if token is not None:
+            cache.release(endpoint, token)
+
+
+def prepare_request(endpoint: str, validators=None,
+                    revalidate: bool = False):
+    """Find out how to fetch an endpoint from what is known about it.
+
+    Returns a fresh cached response if there is one (and no request needs
+    to be made), the stale cached response if any, and the headers to make
+    the request conditional on the stale or the given validators. With
+    `revalidate` set, a fresh cached response is treated as stale.
+
+    While replaying a snapshot, the response recorded is given as fresh (or
+    its error raised)."""
+    replayed = replayed_response(endpoint)
+    if replayed is not None:
+        return replayed, replayed, {}
+    if is_recording():
+        # A response is recorded with its body, not as a 304
+        validators = None
+    cached = _response_cache.get(endpoint) if _response_cache else None
+    if _response_cache is not None:
+        RESPONSE_CACHE.inc(endpoint_family(endpoint),
+                           'miss' if cached is None else
+                           'hit' if cached.is_fresh() else 'stale')
+    if cached is not None and cached.is_fresh() and not revalidate:
+        record_response(endpoint, 200, cached.data)
+        return cached, cached, {}
+    if cached is not None:
+        validators = cached.validators
+    etag, last_modified = validators or (None, None)
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    return None, cached, headers
+
+
+def complete_request(endpoint: str, status: int, headers,
+                     d: Optional[dict], ttl: Optional[float],
+                     stale: Optional[Fetched]) -> Fetched:
+    """Turn a response (with `d` its decoded body) into a `Fetched`.
+
+    The response is kept for `ttl` seconds if given, otherwise for as long as
+    its max-age says. A 304 reuses the stale cached body, if any."""
+    if status == 304:
+        d = stale.data if stale is not None else None
+    elif status != 200:
+        record_response(endpoint, status, None)
+        raise api_error(endpoint, status)
+    else:
+        assert type(d) is dict
+    if d is not None:
+        record_response(endpoint, 200, d)
+    if ttl is None:
+        ttl = max_age(headers)
+        if ttl is None:
+            ttl = DEFAULT_TTL
+    fetched = Fetched(d, time.time(), ttl,
+                      headers.get('ETag') or (stale and stale.etag),
+                      headers.get('Last-Modified') or
+                      (stale and stale.last_modified))
+    if _response_cache is not None and d is not None:
+        _response_cache.put(endpoint, fetched)
+    return fetched
+
+
+def fetch_json(endpoint: str, ttl: Optional[float] = None,
+               validators=None, revalidate: bool = False) -> Fetched:
+    """Fetch an endpoint, observing HTTP caching.
+
+    Fresh responses are served from the response cache, if one is set
+    (unless `revalidate` is set). Otherwise the request is made conditional
+    on the validators (ETag and Last-Modified) of a cached response or the
+    given ones, so that an unchanged response only costs a 304. Responses
+    are kept for `ttl` seconds, or per the server's max-age if not given.
+    With a response cache shared between processes, only one of them at a
+    time fetches an endpoint (see `fetching`). Notes when the response
+    expires (see `used_until`)."""
+    fetched, stale, headers = prepare_request(endpoint, validators,
+                                              revalidate)
+    if fetched is None:
+        with fetching(endpoint) as waited:
+            if waited:
+                fetched, stale, headers = prepare_request(endpoint,
+                                                          validators,
+                                                          revalidate)
+            if fetched is None:
+                logger.debug("Getting endpoint: %s", endpoint)
+                r = get_transport().get(endpoint, headers)
+                d = r.json() if r.status_code == 200 else None
+                fetched = complete_request(endpoint, r.status_code,
+                                           r.headers, d, ttl, stale)
+    used_until(fetched.expires)
+    return fetched
+
+
 def key_from_url(url):
     """Retrieve the last component of an URL."""
     path = urlparse(url).path
@@ -0,0 +1,388 @@
+"""Response caches shared between the processes and hosts of a deployment.
+
+With several workers (or several hosts) each keeping its own responses, an
+endpoint read everywhere is fetched by each of them. The caches here are
+shared instead, and lock endpoints while they are fetched (see
+`rest.fetching`), so that one fetch serves the whole fleet:
+
+- `DiskCache` is shared by the processes of a host using the same
+  directory;
+- a `CacheServer` (`python -m chesscom.sharedcache`) keeps responses for
+  several hosts, which reach it with a `RemoteCache`;
+- a `ShardedCache` spreads endpoints over several cache servers;
+- a `TieredCache` keeps a local copy of what is read from a shared cache.
+
+For instance, with two cache servers:
+
+    set_response_cache(TieredCache(MemoryCache(), ShardedCache([
+        RemoteCache('http://cache-1:8100'),
+        RemoteCache('http://cache-2:8100')])))
+
+A cache server that cannot be reached is skipped (as a miss, without a
+lock) rather than failing requests.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+from urllib.parse import parse_qsl, quote, unquote, urlsplit
+import threading
+import argparse
+import hashlib
+import json
+import time
+import uuid
+
+import requests
+
+from .rest import Fetched
+from .diskcache import DiskCache
+from .metrics import Counter
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+SHARED_CACHE_ERRORS = Counter(
+    'chesscom_shared_cache_errors_total',
+    "Operations on a remote cache that failed, by operation ('get', 'put', "
+    "'acquire' or 'release')", ('operation',))
+
+
+def fetched_to_json(fetched: Fetched) -> dict:
+    return {'data': fetched.data, 'received': fetched.received,
+            'ttl': fetched.ttl, 'etag': fetched.etag,
+            'last_modified': fetched.last_modified}
+
+
+def fetched_from_json(d: dict) -> Fetched:
+    return Fetched(d['data'], d['received'], d['ttl'], d.get('etag'),
+                   d.get('last_modified'))
+
+
+class MemoryCache(object):
+    """Responses kept in this process, the least recently used evicted.
+
+    Its locks only hold within the process: for a `CacheServer`, or as the
+    local tier of a `TieredCache`."""
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._responses = OrderedDict()  # type: OrderedDict[str, Fetched]
+        # Per endpoint locked: (token, expiry)
+        self._leases = {}  # type: Dict[str, Tuple[str, float]]
+
+    def get(self, endpoint: str) -> Optional[Fetched]:
+        with self._lock:
+            fetched = self._responses.get(endpoint)
+            if fetched is not None:
+                self._responses.move_to_end(endpoint)
+            return fetched
+
+    def put(self, endpoint: str, fetched: Fetched) -> None:
+        with self._lock:
+            self._responses[endpoint] = fetched
+            self._responses.move_to_end(endpoint)
+            while len(self._responses) > self.max_entries:
+                self._responses.popitem(last=False)
+
+    def acquire(self, endpoint: str, ttl: float) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            lease = self._leases.get(endpoint)
+            if lease is not None and lease[1] > now:
+                return None
+            token = uuid.uuid4().hex
+            self._leases[endpoint] = (token, now + ttl)
+            return token
+
+    def release(self, endpoint: str, token: str) -> None:
+        with self._lock:
+            lease = self._leases.get(endpoint)
+            if lease is not None and lease[0] == token:
+                del self._leases[endpoint]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._responses.clear()
+
+
+class TieredCache(object):
+    """A local cache in front of a shared one.
+
+    Responses are read from the local cache if fresh there, else from the
+    shared one (and kept locally); they are stored in both. Endpoints are
+    locked in the shared cache."""
+
+    def __init__(self, local, shared):
+        self.local = local
+        self.shared = shared
+
+    def get(self, endpoint: str) -> Optional[Fetched]:
+        fetched = self.local.get(endpoint)
+        if fetched is not None and fetched.is_fresh():
+            return fetched
+        shared = self.shared.get(endpoint)
+        if shared is None or (fetched is not None and
+                              fetched.received >= shared.received):
+            return fetched
+        self.local.put(endpoint, shared)
+        return shared
+
+    def put(self, endpoint: str, fetched: Fetched) -> None:
+        self.local.put(endpoint, fetched)
+        self.shared.put(endpoint, fetched)
+
+    def acquire(self, endpoint: str, ttl: float) -> Optional[str]:
+        return self.shared.acquire(endpoint, ttl)
+
+    def release(self, endpoint: str, token: str) -> None:
+        self.shared.release(endpoint, token)
+
+
+class ShardedCache(object):
+    """Spreads endpoints over several caches (eg. `RemoteCache`s).
+
+    Each endpoint goes to the shard with the highest hash of its name and
+    the endpoint (rendezvous hashing), so that every process picks the same
+    shard, and adding or removing one only moves the endpoints it gets or
+    had. Shards are named by their `url` if they have one."""
+
+    def __init__(self, shards: Sequence, names: Sequence[str] = None):
+        if not shards:
+            raise ValueError("No shards")
+        self.shards = list(shards)
+        self.names = list(names) if names is not None else [
+            getattr(shard, 'url', str(i)) for i, shard in enumerate(shards)]
+
+    def shard(self, endpoint: str):
+        """The cache that the endpoint goes to."""
+        def weight(i):
+            key = f"{self.names[i]}\0{endpoint}".encode()
+            return hashlib.blake2b(key, digest_size=8).digest()
+
+        return self.shards[max(range(len(self.shards)), key=weight)]
+
+    def get(self, endpoint: str) -> Optional[Fetched]:
+        return self.shard(endpoint).get(endpoint)
+
+    def put(self, endpoint: str, fetched: Fetched) -> None:
+        self.shard(endpoint).put(endpoint, fetched)
+
+    def acquire(self, endpoint: str, ttl: float) -> Optional[str]:
+        return self.shard(endpoint).acquire(endpoint, ttl)
+
+    def release(self, endpoint: str, token: str) -> None:
+        self.shard(endpoint).release(endpoint, token)
+
+
+class RemoteCache(object):
+    """The cache of a `CacheServer`, over HTTP.
+
+    Failed operations are counted and logged, and treated as misses (for
+    `get`) or as granted locks (for `acquire`), so that a cache server
+    being down only costs calls to the API. After a failure, the server is
+    left alone for `retry_after` seconds."""
+
+    def __init__(self, url: str, timeout: float = 1.0,
+                 retry_after: float = 10.0):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self._session = requests.Session()
+        self._down_until = 0.0
+
+    def _url(self, kind: str, endpoint: str) -> str:
+        return f"{self.url}/{kind}/{quote(endpoint)}"
+
+    def _is_down(self) -> bool:
+        return time.monotonic() < self._down_until
+
+    def _failed(self, operation: str, e: Exception) -> None:
+        SHARED_CACHE_ERRORS.inc(operation)
+        if not self._is_down():
+            logger.warning("Cache server %s failed to %s, skipping it for "
+                           "%ss: %s", self.url, operation, self.retry_after,
+                           e)
+        self._down_until = time.monotonic() + self.retry_after
+
+    def get(self, endpoint: str) -> Optional[Fetched]:
+        if self._is_down():
+            return None
+        try:
+            r = self._session.get(self._url('responses', endpoint),
+                                  timeout=self.timeout)
+            if r.status_code == 404:
+                return None
+            r.raise_for_status()
+            return fetched_from_json(r.json())
+        except (requests.RequestException, ValueError) as e:
+            self._failed('get', e)
+            return None
+
+    def put(self, endpoint: str, fetched: Fetched) -> None:
+        if self._is_down():
+            return
+        try:
+            self._session.put(self._url('responses', endpoint),
+                              json=fetched_to_json(fetched),
+                              timeout=self.timeout).raise_for_status()
+        except requests.RequestException as e:
+            self._failed('put', e)
+
+    def acquire(self, endpoint: str, ttl: float) -> Optional[str]:
+        if self._is_down():
+            return ''
+        try:
+            r = self._session.post(self._url('locks', endpoint),
+                                   params={'ttl': ttl}, timeout=self.timeout)
+            if r.status_code == 409:
+                return None
+            r.raise_for_status()
+            return r.text
+        except requests.RequestException as e:
+            self._failed('acquire', e)
+            return ''
+
+    def release(self, endpoint: str, token: str) -> None:
+        if not token:
+            return
+        try:
+            self._session.delete(self._url('locks', endpoint),
+                                 params={'token': token},
+                                 timeout=self.timeout).raise_for_status()
+        except requests.RequestException as e:
+            self._failed('release', e)
+
+
+def make_handler(cache):
+    class Handler(BaseHTTPRequestHandler):
+        def _route(self) -> Tuple[Optional[str], str, dict]:
+            url = urlsplit(self.path)
+            kind, _, endpoint = url.path.lstrip('/').partition('/')
+            if kind not in ('responses', 'locks') or not endpoint:
+                return None, '', {}
+            return kind, unquote(endpoint), dict(parse_qsl(url.query))
+
+        def _send(self, status: int, body: bytes = b'',
+                  content_type: str = 'text/plain') -> None:
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            kind, endpoint, _ = self._route()
+            fetched = cache.get(endpoint) if kind == 'responses' else None
+            if fetched is None:
+                self._send(404)
+            else:
+                self._send(200, json.dumps(fetched_to_json(fetched)).encode(),
+                           'application/json')
+
+        def do_PUT(self):
+            kind, endpoint, _ = self._route()
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if kind != 'responses':
+                self._send(404)
+                return
+            try:
+                fetched = fetched_from_json(json.loads(body))
+            except (ValueError, KeyError, TypeError):
+                self._send(400)
+                return
+            cache.put(endpoint, fetched)
+            self._send(204)
+
+        def do_POST(self):
+            kind, endpoint, params = self._route()
+            if kind != 'locks':
+                self._send(404)
+                return
+            token = cache.acquire(endpoint, float(params.get('ttl', 30)))
+            if token is None:
+                self._send(409)
+            else:
+                self._send(200, token.encode())
+
+        def do_DELETE(self):
+            kind, endpoint, params = self._route()
+            if kind != 'locks':
+                self._send(404)
+                return
+            cache.release(endpoint, params.get('token', ''))
+            self._send(204)
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    return Handler
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class CacheServer(object):
+    """Serves a cache (by default a `MemoryCache`) to `RemoteCache`s.
+
+    Runs in a background thread while used as a context manager."""
+
+    def __init__(self, cache=None, host: str = '127.0.0.1', port: int = 0):
+        self.cache = cache if cache is not None else MemoryCache()
+        self.httpd = _HTTPServer((host, port), make_handler(self.cache))
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def shared_cache(urls: List[str], local_entries: int = 0):
+    """A cache over the cache servers at the given URLs.
+
+    Sharded if there are several, and with a local `MemoryCache` of
+    `local_entries` in front if any."""
+    shared = ShardedCache([RemoteCache(url) for url in urls]) \
+        if len(urls) > 1 else RemoteCache(urls[0])
+    if local_entries:
+        return TieredCache(MemoryCache(local_entries), shared)
+    return shared
+
+
+def main():
+    """Serve a shared cache until interrupted."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--directory',
+                        help="keep responses in a disk cache there "
+                             "(default: in memory)")
+    parser.add_argument('--max-entries', type=int, default=100000,
+                        help="responses kept in memory")
+    args = parser.parse_args()
+
+    cache = DiskCache(args.directory) if args.directory \
+        else MemoryCache(args.max_entries)
+    with CacheServer(cache, args.host, args.port) as server:
+        print(f"Serving on {server.url}")
+        try:
+            server.thread.join()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+"""Recording the responses of the API into a snapshot archive, and
+replaying them.
+
+For analyses to run many times over the same data (without calling the
+API again, and with the same results every time), record the responses
+received while crawling once:
+
+    with recording('clubs.snapshot'):
+        for key in keys:
+            prefetch(lookup_club(key).members(), parts=['profile'])
+
+and then serve every lookup from the archive:
+
+    with replaying('clubs.snapshot'):
+        ...
+
+Every response read while recording is kept, including those served from
+the response cache, and "not found" (404) and "gone" (410) answers, but not
+the properties already in memory: record from a fresh process. While
+replaying, no request is made: endpoints that were not recorded raise
+`NotRecorded`.
+
+An archive is a single file of compressed blocks of responses, followed by
+an index of the endpoints sorted by hash. It is read through a memory map,
+looking endpoints up by binary search in the index, so that archives with
+millions of responses open at once and are read at the speed of the disk.
+Blocks are compressed with zlib, the last few read being kept
+decompressed for reading in sequence. `python -m chesscom.snapshot`
+describes an archive, or prints the responses it has for endpoints.
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from .rest import APIError, Fetched, api_error, set_snapshot
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'CCSNAP\x00\x01'
+
+BLOCK_SIZE = 16 * 1024
+"""Bytes of responses compressed together, before compression."""
+
+RECORDED_STATUSES = (200, 404, 410)
+"""Status codes of the responses recorded; others are transient."""
+
+# Endpoint hash, then block offset and (compressed) length, and the offset,
+# length and status code of the response in the block
+_ENTRY = struct.Struct('<8sQIIIH')
+# Index offset, entries and time of recording
+_FOOTER = struct.Struct('<QQd8s')
+
+
+def _digest(endpoint: str) -> bytes:
+    return hashlib.blake2b(endpoint.encode(), digest_size=8).digest()
+
+
+class NotRecorded(APIError):
+    """The endpoint was not recorded in the snapshot being replayed."""
+
+    def __init__(self, endpoint: str):
+        super().__init__(endpoint)
+        self.args = (f"{endpoint}: not recorded",)
+
+
+class SnapshotWriter(object):
+    """Writes responses into a new snapshot archive.
+
+    The archive is written next to `path` and only moved there once
+    closed, so that an interrupted recording does not leave a broken
+    archive behind. Recording an endpoint again replaces its response."""
+
+    def __init__(self, path: str, block_size: int = BLOCK_SIZE,
+                 level: int = 6):
+        self.path = path
+        self.block_size = block_size
+        self.level = level
+        self._lock = threading.Lock()
+        self._partial = f"{path}.partial"
+        self._file = open(self._partial, 'wb')
+        self._file.write(MAGIC)
+        self._offset = len(MAGIC)
+        self._block = bytearray()
+        # Of the responses in the block: endpoint, offset, length and status
+        self._pending = []  # type: List[Tuple[str, int, int, int]]
+        # Per endpoint: block offset and length, offset, length and status
+        self._index = {}  # type: Dict[str, Tuple[int, int, int, int, int]]
+        self.created = time.time()
+
+    def record(self, endpoint: str, status: int,
+               data: Optional[dict]) -> None:
+        """Add the response to an endpoint (with its decoded body)."""
+        if status not in RECORDED_STATUSES:
+            return
+        body = json.dumps(data if status == 200 else None,
+                          separators=(',', ':'))
+        payload = f"{endpoint}\n{body}".encode()
+        with self._lock:
+            if self._file is None:
+                raise ValueError("Snapshot closed")
+            self._pending.append((endpoint, len(self._block), len(payload),
+                                  status))
+            self._block += payload
+            if len(self._block) >= self.block_size:
+                self._flush()
+
+    def _flush(self) -> None:
+        if not self._block:
+            return
+        compressed = zlib.compress(bytes(self._block), self.level)
+        self._file.write(compressed)
+        for endpoint, offset, length, status in self._pending:
+            self._index[endpoint] = (self._offset, len(compressed), offset,
+                                     length, status)
+        self._offset += len(compressed)
+        self._block = bytearray()
+        self._pending = []
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._index) + len(self._pending)
+
+    def close(self) -> None:
+        """Write the index, and move the archive into place."""
+        with self._lock:
+            if self._file is None:
+                return
+            self._flush()
+            entries = sorted((_digest(endpoint), *entry)
+                             for endpoint, entry in self._index.items())
+            for entry in entries:
+                self._file.write(_ENTRY.pack(*entry))
+            self._file.write(_FOOTER.pack(self._offset, len(entries),
+                                          self.created, MAGIC))
+            self._file.close()
+            self._file = None
+            os.replace(self._partial, self.path)
+        logger.info("Recorded %d responses into %s", len(entries), self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SnapshotReader(object):
+    """Reads the responses of a snapshot archive.
+
+    Safe to use from several threads. Keeps the last `cached_blocks` blocks
+    read decompressed."""
+
+    def __init__(self, path: str, cached_blocks: int = 16):
+        self.path = path
+        self.cached_blocks = cached_blocks
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < len(MAGIC) + _FOOTER.size or \
+                self._map[:len(MAGIC)] != MAGIC:
+            self._map.close()
+            raise ValueError(f"Not a snapshot archive: {path}")
+        self._index, self._count, self.created, magic = _FOOTER.unpack_from(
+            self._map, len(self._map) - _FOOTER.size)
+        if magic != MAGIC:
+            self._map.close()
+            raise ValueError(f"Not a snapshot archive: {path}")
+        self._lock = threading.Lock()
+        self._blocks = OrderedDict()  # type: OrderedDict[int, bytes]
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _entry(self, i: int):
+        return _ENTRY.unpack_from(self._map, self._index + i * _ENTRY.size)
+
+    def _block(self, offset: int, length: int) -> bytes:
+        with self._lock:
+            block = self._blocks.get(offset)
+            if block is not None:
+                self._blocks.move_to_end(offset)
+                return block
+        block = zlib.decompress(self._map[offset:offset + length])
+        with self._lock:
+            self._blocks[offset] = block
+            while len(self._blocks) > self.cached_blocks:
+                self._blocks.popitem(last=False)
+        return block
+
+    def get(self, endpoint: str) -> Optional[Tuple[int, Optional[dict]]]:
+        """The status code and body recorded for an endpoint, if any."""
+        digest = _digest(endpoint)
+        # The first entry with the hash of the endpoint
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._entry(middle)[0] < digest:
+                low = middle + 1
+            else:
+                high = middle
+        prefix = endpoint.encode() + b'\n'
+        for i in range(low, self._count):
+            entry_digest, block_offset, block_length, offset, length, \
+                status = self._entry(i)
+            if entry_digest != digest:
+                break
+            payload = self._block(block_offset, block_length)[
+                offset:offset + length]
+            # Hashes may collide
+            if payload.startswith(prefix):
+                return status, json.loads(payload[len(prefix):])
+        return None
+
+    def __contains__(self, endpoint: str) -> bool:
+        return self.get(endpoint) is not None
+
+    def endpoints(self) -> Iterator[str]:
+        """The endpoints recorded (in no particular order)."""
+        for i in range(self._count):
+            _, block_offset, block_length, offset, length, _ = \
+                self._entry(i)
+            payload = self._block(block_offset, block_length)[
+                offset:offset + length]
+            yield payload.split(b'\n', 1)[0].decode()
+
+    def replay(self, endpoint: str) -> Fetched:
+        """The response recorded for an endpoint, as if just fetched (and
+        never expiring).
+
+        Raises the `APIError` recorded, or `NotRecorded`."""
+        found = self.get(endpoint)
+        if found is None:
+            raise NotRecorded(endpoint)
+        status, data = found
+        if status != 200:
+            raise api_error(endpoint, status)
+        return Fetched(data, self.created, float('inf'))
+
+    def close(self) -> None:
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+@contextmanager
+def recording(path: str, **kwargs):
+    """Record the responses read in this context into an archive.
+
+    Gives the `SnapshotWriter`; the archive is written on leaving."""
+    writer = SnapshotWriter(path, **kwargs)
+    set_snapshot(writer)
+    try:
+        yield writer
+    finally:
+        set_snapshot(None)
+        writer.close()
+
+
+@contextmanager
+def replaying(path: str, **kwargs):
+    """Serve the responses read in this context from an archive.
+
+    Gives the `SnapshotReader`."""
+    reader = SnapshotReader(path, **kwargs)
+    set_snapshot(reader)
+    try:
+        yield reader
+    finally:
+        set_snapshot(None)
+        reader.close()
+
+
+def main():
+    """Describe a snapshot archive, or print the responses it has."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('archive')
+    parser.add_argument('endpoints', nargs='*',
+                        help="print the responses to these")
+    args = parser.parse_args()
+
+    with SnapshotReader(args.archive) as reader:
+        if not args.endpoints:
+            recorded = time.strftime('%Y-%m-%d %H:%M:%S',
+                                     time.localtime(reader.created))
+            print(f"{len(reader)} responses recorded on {recorded}, "
+                  f"{os.path.getsize(args.archive)} bytes")
+        for endpoint in args.endpoints:
+            found = reader.get(endpoint)
+            if found is None:
+                print(f"{endpoint}: not recorded")
+            elif found[0] != 200:
+                print(f"{endpoint}: {found[0]}")
+            else:
+                print(json.dumps(found[1], indent=2))
+
+
+if __name__ == '__main__':
+    main()
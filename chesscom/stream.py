@@ -0,0 +1,136 @@
+from typing import Iterator, Iterable, Tuple, Any
+import codecs
+import json
+
+from .rest import api_error, get_transport, is_recording, record_response, \
+    replayed_response
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+_NUMBER = '0123456789.eE+-'
+
+
+class _ItemParser(object):
+    """Incrementally parses a JSON object whose values are arrays.
+
+    Only the item being parsed (and the current chunk) is kept in memory, so
+    arbitrarily long arrays can be iterated over as they arrive.
+    """
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._decode = codecs.getincrementaldecoder('utf-8')().decode
+        self._buffer = ''
+        self._pos = 0
+        self._exhausted = False
+
+    def _fill(self) -> bool:
+        """Read another chunk, returning False at the end of the input."""
+        if self._exhausted:
+            return False
+        self._buffer = self._buffer[self._pos:]
+        self._pos = 0
+        for chunk in self._chunks:
+            text = self._decode(chunk)
+            if text:
+                self._buffer += text
+                return True
+        self._buffer += self._decode(b'', final=True)
+        self._exhausted = True
+        return False
+
+    def _peek(self) -> str:
+        """The next non-whitespace character ('' at the end)."""
+        while True:
+            while self._pos < len(self._buffer) and \
+                    self._buffer[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, chars: str) -> str:
+        c = self._peek()
+        if not c or c not in chars:
+            raise ValueError(f"Expected one of {chars!r}, got {c!r}")
+        self._pos += 1
+        return c
+
+    def _value(self) -> Any:
+        self._peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number at the end of the buffer may continue in the next one
+            if self._buffer[end:].strip(_NUMBER) or not self._fill():
+                self._pos = end
+                return value
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        """Yield (key, item) for each item of each array in the object."""
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            if self._peek() == '[':
+                self._pos += 1
+                if self._peek() == ']':
+                    self._pos += 1
+                else:
+                    while True:
+                        yield key, self._value()
+                        if self._expect(',]') == ']':
+                            break
+            else:
+                # Not an array: skip it
+                self._value()
+            if self._expect(',}') == '}':
+                return
+
+
+def iter_json_items(endpoint: str) -> Iterator[Tuple[str, Any]]:
+    """Stream the items of the arrays in the response to an endpoint.
+
+    Yields (key, item) for each item of each array value of the response
+    object, eg. ('players', username) for `country/{code}/players`, as soon
+    as it has been received. Responses are not cached (but are recorded
+    into a snapshot, the arrays only, and replayed from one).
+
+    Raises `APIError` if no successful response could be had."""
+    replayed = replayed_response(endpoint)
+    if replayed is not None:
+        for key, value in replayed.data.items():
+            if isinstance(value, list):
+                yield from ((key, item) for item in value)
+        return
+
+    logger.debug("Streaming endpoint: %s", endpoint)
+    r = get_transport().get(endpoint, stream=True)
+    try:
+        if r.status_code != 200:
+            record_response(endpoint, r.status_code, None)
+            raise api_error(endpoint, r.status_code)
+        if not is_recording():
+            yield from _ItemParser(r.iter_content(CHUNK_SIZE)).items()
+            return
+        # Kept whole, to be recorded once completely received
+        arrays = {}
+        for key, item in _ItemParser(r.iter_content(CHUNK_SIZE)).items():
+            arrays.setdefault(key, []).append(item)
+            yield key, item
+        record_response(endpoint, 200, arrays)
+    finally:
+        r.close()
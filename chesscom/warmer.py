@@ -0,0 +1,174 @@
+"""Refreshing the parts of entities read most often before they expire.
+
+Without it, whoever reads a property just after it expired waits for it to
+be fetched again, however popular the entity. A `CacheWarmer` counts the
+reads of each part of each entity and, in the background, revalidates the
+hottest parts shortly before they expire, within a budget of calls to the
+API, eg.
+
+    warmer = CacheWarmer(calls_per_hour=1200)
+    warmer.start()
+
+Parts that are rarely read are left to expire, and forgotten once their
+counts have decayed.
+"""
+from typing import Any, Dict, List, Optional, Tuple
+import threading
+import weakref
+import time
+
+from .cache import set_read_tracker
+from .entity import Entity, request_parts
+from .metrics import Counter, Gauge
+from .rest import BACKGROUND
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+WARMED = Counter(
+    'chesscom_warmer_refreshes_total',
+    "Parts refreshed by the cache warmer before they expired, by outcome "
+    "('ok' or 'error')", ('outcome',))
+
+
+class CacheWarmer(object):
+    """Refreshes hot parts of entities before they expire.
+
+    Reads of properties are counted per (entity, part), the counts halving
+    every `half_life` seconds. Every `interval` seconds, the parts with a
+    count of at least `min_reads` that expire within `lead` seconds (or have
+    expired already) are revalidated, hottest first, making at most
+    `calls_per_hour` calls to the API on average. Parts kept for no longer
+    than `lead` (such as `is_online`) are not warmed. Counts below
+    `forget_below` are dropped, as are those of entities no longer in use.
+    """
+
+    def __init__(self, calls_per_hour: float = 600, interval: float = 60,
+                 lead: float = 300, half_life: float = 3600,
+                 min_reads: float = 2, forget_below: float = 0.1,
+                 max_workers: int = 4):
+        self.calls_per_hour = calls_per_hour
+        self.interval = interval
+        self.lead = lead
+        self.half_life = half_life
+        self.min_reads = min_reads
+        self.forget_below = forget_below
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        # Per entity and part: [count, time of last update]
+        self._counts = weakref.WeakKeyDictionary()  # type: Dict[Entity, dict]
+        self._allowance = 0.0
+        self._stopped = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+
+    def _decayed(self, count: float, since: float, now: float) -> float:
+        return count * 0.5 ** ((now - since) / self.half_life)
+
+    def record(self, entity: Entity, part: str) -> None:
+        """Count a read of a part of an entity."""
+        now = time.time()
+        with self._lock:
+            parts = self._counts.get(entity)
+            if parts is None:
+                parts = self._counts[entity] = {}
+            entry = parts.get(part)
+            if entry is None:
+                parts[part] = [1.0, now]
+            else:
+                entry[0] = self._decayed(entry[0], entry[1], now) + 1
+                entry[1] = now
+
+    def hot(self, now: Optional[float] = None) \
+            -> List[Tuple[float, Entity, str]]:
+        """The parts counted, as (count, entity, part), hottest first.
+
+        Forgets those that have gone cold."""
+        now = now or time.time()
+        hot = []
+        with self._lock:
+            for entity, parts in list(self._counts.items()):
+                for part, (count, since) in list(parts.items()):
+                    count = self._decayed(count, since, now)
+                    if count < self.forget_below:
+                        del parts[part]
+                    else:
+                        hot.append((count, entity, part))
+                if not parts:
+                    del self._counts[entity]
+        hot.sort(key=lambda entry: entry[0], reverse=True)
+        return hot
+
+    def _expiring(self, entity: Entity, part: str, now: float) -> bool:
+        record = entity._record(part)
+        return record.data is not None and record.ttl > self.lead and \
+            record.received + record.ttl - now < self.lead
+
+    def warm(self, now: Optional[float] = None) -> int:
+        """Refresh the hottest parts about to expire, within the budget.
+
+        Called every `interval` seconds once started. Returns the number of
+        parts refreshed."""
+        now = now or time.time()
+        per_round = self.calls_per_hour * self.interval / 3600
+        # Unused calls carry over to the next round only
+        self._allowance = min(self._allowance + per_round,
+                              max(per_round, 1.0))
+        jobs = []
+        for count, entity, part in self.hot(now):
+            if len(jobs) >= int(self._allowance) or count < self.min_reads:
+                break
+            if self._expiring(entity, part, now):
+                jobs.append((entity, part))
+        if not jobs:
+            return 0
+
+        self._allowance -= len(jobs)
+        errors = request_parts(jobs, self.max_workers, level=BACKGROUND,
+                               revalidate=True)
+        failed = sum(error is not None for error in errors)
+        WARMED.inc('ok', amount=len(jobs) - failed)
+        WARMED.inc('error', amount=failed)
+        logger.debug("Warmed %d parts (%d failed)", len(jobs), failed)
+        return len(jobs)
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                self.warm()
+            except Exception:
+                logger.exception("Warming failed")
+
+    def start(self) -> None:
+        """Start counting reads, and warming in a background thread."""
+        self._stopped.clear()
+        set_read_tracker(self.record)
+        _warmers.append(self)
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='cache-warmer')
+        self._thread.start()
+
+    def stop(self) -> None:
+        set_read_tracker(None)
+        if self in _warmers:
+            _warmers.remove(self)
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            tracked = sum(len(parts) for parts in self._counts.values())
+        return {'tracked': tracked,
+                'allowance': self._allowance,
+                'warmed': WARMED.value('ok'),
+                'failed': WARMED.value('error')}
+
+
+_warmers = []  # type: List[CacheWarmer]
+
+Gauge('chesscom_warmer_tracked',
+      "Parts of entities whose reads are counted by the cache warmer",
+      read=lambda: {(): sum(warmer.stats()['tracked']
+                            for warmer in _warmers)})
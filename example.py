@@ -1,4 +1,3 @@
-import pandas as pd
 import matplotlib.pyplot as plt
 import chesscom
 import click
@@ -6,11 +5,11 @@ import click
 
 def plot_club_rating_distribution(club_key):
     club = chesscom.lookup_club(club_key)
-    ratings = pd.DataFrame([{
-        'bullet': member.rating('chess_bullet'),
-        'blitz': member.rating('chess_blitz'),
-        'rapid': member.rating('chess_rapid')
-    } for member in club.members()])
+    ratings = club.ratings_frame(
+        categories=['chess_bullet', 'chess_blitz', 'chess_rapid'])['rating']
+    ratings = ratings.rename(columns=lambda c: c.replace('chess_', ''))
+    # Missing ratings (NA) are left out of the densities
+    ratings = ratings.astype(float)
     ratings.plot(kind='density')
     plt.title(f"Rating Distribution of {club.name()}")
     plt.xlabel('Rating')
@@ -0,0 +1,121 @@
+import multiprocessing
+import socket
+import time
+
+from benchmarks.stub_server import StubServer, StubAPI
+import chesscom
+from chesscom.diskcache import DiskCache
+from chesscom.rest import Fetched, fetch_json, set_response_cache
+from chesscom.sharedcache import CacheServer, MemoryCache, RemoteCache, \
+    ShardedCache, SHARED_CACHE_ERRORS
+
+
+def _fetch_through(cache_url: str, api_url: str, endpoint: str) -> dict:
+    """Fetch an endpoint as a worker process of a deployment would."""
+    chesscom.set_transport(chesscom.Transport(base_url=api_url))
+    set_response_cache(RemoteCache(cache_url))
+    return fetch_json(endpoint).data
+
+
+def _closed_url() -> str:
+    """The URL of a port nothing listens on."""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    return f"http://127.0.0.1:{port}"
+
+
+def test_remote_cache_round_trip():
+    with CacheServer() as server:
+        cache = RemoteCache(server.url)
+        assert cache.get('player/a') is None
+        cache.put('player/a', Fetched({'name': 'A'}, time.time(), 60,
+                                      '"etag"'))
+        fetched = cache.get('player/a')
+        assert fetched.data == {'name': 'A'}
+        assert fetched.validators == ('"etag"', None)
+
+
+def test_one_upstream_call_across_processes():
+    with StubServer(StubAPI(latency=0.3)) as api, CacheServer() as server:
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(2) as pool:
+            results = pool.starmap(
+                _fetch_through,
+                [(server.url, api.base_url, 'player/shared')] * 2)
+        assert results[0] == results[1]
+        assert api.api.calls == 1
+
+
+def test_remote_lock_is_exclusive():
+    with CacheServer() as server:
+        first, second = RemoteCache(server.url), RemoteCache(server.url)
+        token = first.acquire('player/a', 30)
+        assert token
+        assert second.acquire('player/a', 30) is None
+        first.release('player/a', token)
+        assert second.acquire('player/a', 30)
+
+
+def test_failed_shard_is_skipped():
+    with StubServer() as api, CacheServer() as server:
+        live, dead = RemoteCache(server.url), RemoteCache(_closed_url())
+        cache = ShardedCache([live, dead])
+        endpoints = [f"player/p{i}" for i in range(20)]
+        on_dead = [e for e in endpoints if cache.shard(e) is dead]
+        on_live = [e for e in endpoints if cache.shard(e) is live]
+        assert on_dead and on_live
+
+        chesscom.set_transport(chesscom.Transport(base_url=api.base_url))
+        set_response_cache(cache)
+        try:
+            errors = SHARED_CACHE_ERRORS.value('get')
+            for endpoint in endpoints:
+                fetch_json(endpoint)
+            # Missed, and not locked, without failing the requests
+            assert SHARED_CACHE_ERRORS.value('get') > errors
+            assert dead.acquire(on_dead[0], 30) == ''
+            assert api.api.calls == len(endpoints)
+            for endpoint in endpoints:
+                fetch_json(endpoint)
+            assert api.api.calls == len(endpoints) + len(on_dead)
+        finally:
+            set_response_cache(None)
+            chesscom.set_transport(None)
+
+
+def test_rendezvous_distribution():
+    shards = [MemoryCache() for _ in range(4)]
+    names = ['a', 'b', 'c', 'd']
+    cache = ShardedCache(shards, names)
+    endpoints = [f"player/p{i}" for i in range(4000)]
+    placed = {e: cache.shard(e) for e in endpoints}
+    for shard in shards:
+        assert 800 < sum(s is shard for s in placed.values()) < 1200
+
+    # Removing a shard only moves the endpoints it had
+    smaller = ShardedCache(shards[:3], names[:3])
+    for endpoint, shard in placed.items():
+        if shard is not shards[3]:
+            assert smaller.shard(endpoint) is shard
+
+
+def test_disk_cache_leases(tmp_path):
+    # Two caches over the same directory, as two processes would have
+    first, second = DiskCache(str(tmp_path)), DiskCache(str(tmp_path))
+    try:
+        token = first.acquire('player/a', 30)
+        assert token
+        assert second.acquire('player/a', 30) is None
+        second.release('player/a', 'not the token')
+        assert second.acquire('player/a', 30) is None
+        first.release('player/a', token)
+        assert second.acquire('player/a', 30)
+
+        # An expired lease is taken over
+        assert first.acquire('player/b', 0.05)
+        time.sleep(0.1)
+        assert second.acquire('player/b', 30)
+    finally:
+        first.close()
+        second.close()
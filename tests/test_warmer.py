@@ -0,0 +1,31 @@
+import asyncio
+
+from benchmarks.stub_server import StubServer
+import chesscom
+from chesscom import aio
+from chesscom.warmer import CacheWarmer
+
+
+def test_asyncio_reads_are_counted():
+    warmer = CacheWarmer(interval=3600)
+    warmer.start()
+    try:
+        with StubServer() as server:
+            async def read():
+                aio.set_transport(aio.AsyncTransport(base_url=server.base_url))
+                try:
+                    player = aio.lookup_player('warmer-async')
+                    # A miss, then a hit
+                    await player.name()
+                    await player.name()
+                finally:
+                    await aio.get_transport().close()
+                    aio.set_transport(None)
+
+            asyncio.run(read())
+    finally:
+        warmer.stop()
+
+    entity = chesscom.lookup_player('warmer-async')
+    counts = {(entity, part): count for count, entity, part in warmer.hot()}
+    assert round(counts[(entity, 'profile')]) == 2